@@ -1,6 +1,154 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
-from django.test import TestCase
+from django.test import SimpleTestCase
 
-# Create your tests here.
+from first_core.engines.catalog1lib import slow_sign
+from first_core.engines.catalog1sign import numpy_sign, c_sign, \
+                                            _load_library
+from first_core.engines.catalog1_index import Catalog1Index
+from first_core.disassembly import Disassembly, FLAG_CALL, FLAG_JUMP, \
+                                    get_handle
+
+import random
+import shutil
+import tempfile
+import threading
+
+
+class Catalog1SignTests(SimpleTestCase):
+    '''
+        The fast catalog1 signers have to produce the exact same
+        signatures as catalog1lib.slow_sign
+    '''
+    def _samples(self):
+        rand = random.Random(1337)
+        samples = [b'\x00\x00\x00\x00', b'\xff\xff\xff\xff', b'\x55\x8b\xec\x83\xec',
+                   b'\x90' * 64, b'\x55\x8b\xec' * 40]
+        for size in [4, 5, 7, 31, 128, 600]:
+            samples.append(bytes(rand.getrandbits(8) for i in range(size)))
+
+        return samples
+
+    def test_numpy_sign(self):
+        for data in self._samples():
+            self.assertEqual(numpy_sign(data, 64), slow_sign(data, 64))
+
+        self.assertEqual(numpy_sign(b'\x01\x02\x03\x04\x05', 7),
+                         slow_sign(b'\x01\x02\x03\x04\x05', 7))
+
+    def test_c_sign(self):
+        if not _load_library():
+            self.skipTest('Catalog1 C library is not built')
+
+        for data in self._samples():
+            self.assertEqual(c_sign(data, 64), slow_sign(data, 64))
+
+    def test_short_data(self):
+        for signer in [numpy_sign, slow_sign]:
+            with self.assertRaises(Exception):
+                signer(b'\x01\x02\x03', 64)
+
+
+class Catalog1IndexTests(SimpleTestCase):
+    def _index(self):
+        rand = random.Random(1337)
+        self.signature = [rand.getrandbits(32) for i in range(64)]
+        rows = []
+        for i in range(1, 51):
+            signature = list(self.signature)
+            for j in range(i):
+                signature[j] = rand.getrandbits(32)
+            rows.append(('intel32', i, signature))
+
+        rows.append(('arm', 100, list(self.signature)))
+        return Catalog1Index.build(rows, 64)
+
+    def test_query(self):
+        index = self._index()
+        self.assertEqual(len(index), 51)
+        self.assertEqual(index.query('intel32', self.signature, k=3),
+                         [(1, 63), (2, 62), (3, 61)])
+        self.assertEqual(index.query('intel32', self.signature, min_matches=60),
+                         [(1, 63), (2, 62), (3, 61), (4, 60)])
+        self.assertEqual(index.query('mips', self.signature), [])
+
+        index.add('intel32', 200, list(self.signature))
+        self.assertEqual(index.query('intel32', self.signature, k=1), [(200, 64)])
+        self.assertEqual(index.max_id, 200)
+
+    def test_update(self):
+        index = self._index()
+        index.add('intel32', 200, list(self.signature))
+
+        #   Rows already indexed, built or added, are skipped
+        index.update([('intel32', 1, list(self.signature)),
+                      ('intel32', 200, list(self.signature)),
+                      ('intel32', 150, list(self.signature)),
+                      ('intel32', 150, list(self.signature)),
+                      ('arm', 1, list(self.signature))])
+        self.assertEqual(len(index), 54)
+        self.assertEqual(sorted(index.query('intel32', self.signature, k=3)),
+                         [(1, 63), (150, 64), (200, 64)])
+        self.assertEqual(sorted(index.query('arm', self.signature)),
+                         [(1, 64), (100, 64)])
+
+    def test_snapshot(self):
+        path = tempfile.mkdtemp()
+        try:
+            index = self._index()
+            index.refreshed = 1234.5
+            index.save(path)
+            index = Catalog1Index.load(path)
+            self.assertEqual(len(index), 51)
+            self.assertEqual(index.max_id, 100)
+            self.assertEqual(index.refreshed, 1234.5)
+            self.assertEqual(index.query('arm', self.signature), [(100, 64)])
+            self.assertEqual(index.query('intel32', self.signature, k=2),
+                             [(1, 63), (2, 62)])
+        finally:
+            shutil.rmtree(path)
+
+        self.assertIsNone(Catalog1Index.load(path))
+
+
+class InstructionTableTests(SimpleTestCase):
+    #   push ebp; mov ebp, esp; call $+5; jmp dword ptr [0x40302010]; ret
+    code = bytes.fromhex('558bece800000000ff2510203040c3')
+
+    def test_table(self):
+        disassembly = Disassembly('intel32', self.code)
+        table = disassembly.table()
+        self.assertIs(table, disassembly.table())
+        self.assertEqual(table.mnemonics(), ['push', 'mov', 'call', 'jmp', 'ret'])
+        self.assertEqual(table.offsets.tolist(), [0, 1, 3, 8, 14])
+        self.assertEqual(table.flags.tolist(), [0, 0, FLAG_CALL, FLAG_JUMP, 0])
+        self.assertEqual(table.instruction_bytes(2), b'\xe8\x00\x00\x00\x00')
+        self.assertIsNone(table.op_types)
+
+        #   Operand data is only decoded for the requested rows
+        disassembly.table(detail=[2, 3])
+        self.assertEqual(table.detailed.tolist(), [False, False, True, True, False])
+        details = list(disassembly.instructions())
+        self.assertEqual(table.op_types[2], details[2].operands[0].type)
+        self.assertEqual(table.op_types[3], details[3].operands[0].type)
+        self.assertEqual(table.opcodes[3].tolist(), details[3].opcode)
+
+    def test_invalid_architecture(self):
+        disassembly = Disassembly('unknown', self.code)
+        self.assertEqual(len(disassembly.table(detail=True)), 0)
+        self.assertEqual(list(disassembly.instructions()), [])
+
+    def test_handle_pool(self):
+        handle = get_handle('intel32')
+        self.assertIs(handle, get_handle('intel32'))
+        self.assertIsNot(handle, get_handle('intel32', detail=True))
+        self.assertIsNot(handle, get_handle('intel64'))
+        self.assertTrue(get_handle('intel32', detail=True).detail)
+
+        #   Each thread gets its own handles
+        handles = []
+        thread = threading.Thread(target=lambda: handles.append(get_handle('intel32')))
+        thread.start()
+        thread.join()
+        self.assertIsNot(handle, handles[0])
@@ -106,6 +106,17 @@ DATABASES = {
     }
 }
 
+# Cache, used by the scan cache when "scan_cache" is set to django
+# https://docs.djangoproject.com/en/1.10/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': CONFIG.get('cache_backend',
+                              'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': CONFIG.get('cache_location', ''),
+    }
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/1.10/ref/settings/#auth-password-validators
 
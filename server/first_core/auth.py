@@ -42,6 +42,7 @@ from django.urls import reverse
 from first.settings import CONFIG
 from first_core.models import User
 from first_core.error import FIRSTError
+from first_core.cache import create_backend
 
 #   Thirdy Party
 import httplib2
@@ -57,12 +58,34 @@ class FIRSTAuthError(FIRSTError):
         super(FIRSTError, self).__init__(message)
 
 
+#   Cache of API key to User lookups, see first_core.cache. Changes made by
+#   other processes (user_shell) only reach the in-process lru cache once the
+#   entry expires, use the django cache to share invalidations.
+auth_cache, AUTH_CACHE_TTL = create_backend('auth_cache', 10000, 60)
+
+
+def _auth_cache_key(api_key):
+    return 'auth:{}'.format(str(api_key).lower())
+
+
 def verify_api_key(api_key):
-    users = User.objects.filter(api_key=api_key)
-    if not users:
-        return None
+    key = _auth_cache_key(api_key)
+    if auth_cache is not None:
+        user = auth_cache.get_many([key]).get(key)
+        if user:
+            return user
+
+    user = User.objects.filter(api_key=api_key).first()
+    if user and (auth_cache is not None):
+        auth_cache.set_many({key : user}, AUTH_CACHE_TTL)
+
+    return user
+
 
-    return users.get()
+def invalidate_api_key(api_key):
+    '''Drops the cached User of an API key, call when the User changes'''
+    if auth_cache is not None:
+        auth_cache.delete_many([_auth_cache_key(api_key)])
 
 
 def require_apikey(view_function):
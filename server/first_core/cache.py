@@ -0,0 +1,215 @@
+#-------------------------------------------------------------------------------
+#
+#   FIRST Scan Cache
+#
+#   Caches the results of FIRSTEngineManager.scan_many per function. Entries
+#   are keyed by the opcodes' sha256, architecture, APIs and the engine
+#   generation, so installing or enabling an engine starts a new cache.
+#
+#   Each entry records a version token for every function it matched and one
+#   for the scanned opcodes and architecture. FIRSTDB drops the token of a
+#   function when its metadata changes (added, deleted, applied or
+#   unapplied), which invalidates every entry that matched it. Adding
+#   metadata also drops the token of the function's opcodes and architecture,
+#   invalidating the entries of scans of that exact function whatever they
+#   matched. Other functions added after an entry was cached are only seen
+#   once the entry expires ("scan_cache_ttl").
+#
+#   The lru cache is invalidated only within the process changing the
+#   metadata, other processes serve their entries until they expire. Use
+#   django with a shared cache (memcached, Redis) when running several
+#   processes.
+#
+#   Configuration ("scan_cache", also used by "auth_cache" in first_core.auth):
+#   -   none:   Disabled (default)
+#   -   lru:    In-process LRU, bounded by "scan_cache_size" entries
+#   -   django: Django's cache framework, see "cache_backend" and
+#               "cache_location" to point it at memcached or Redis
+#
+#-------------------------------------------------------------------------------
+
+#   Python Modules
+import time
+import uuid
+import pickle
+import hashlib
+import threading
+from collections import OrderedDict
+
+#   FIRST Modules
+from first.settings import CONFIG
+
+
+class LRUCache(object):
+    '''In-process cache with a subset of Django's cache API'''
+    def __init__(self, max_size, timeout):
+        self._max_size = max_size
+        self._timeout = timeout
+        self._lock = threading.Lock()
+
+        #   {key : (expiration time, pickled value)}
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get_many(self, keys):
+        now = time.time()
+        values = {}
+        with self._lock:
+            for key in keys:
+                if key not in self._data:
+                    continue
+
+                expires, value = self._data[key]
+                if expires < now:
+                    del self._data[key]
+                    continue
+
+                self._data.move_to_end(key)
+                values[key] = pickle.loads(value)
+
+        return values
+
+    def set_many(self, data, timeout=None):
+        expires = time.time() + (self._timeout if timeout is None else timeout)
+        with self._lock:
+            for key, value in data.items():
+                self._data[key] = (expires, pickle.dumps(value))
+                self._data.move_to_end(key)
+
+            while len(self._data) > self._max_size:
+                self._data.popitem(last=False)
+
+    def delete_many(self, keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+
+class ScanCache(object):
+    def __init__(self, backend, timeout):
+        self._backend = backend
+        self._timeout = timeout
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(function, generation):
+        '''
+        Returns the cache key of a scanned function
+
+        @param function: Dictionary (keys: opcodes, architecture, apis)
+        @param generation: Value identifying the loaded engines
+        '''
+        data = '{}|{}|{}|{}'.format(hashlib.sha256(function['opcodes']).hexdigest(),
+                                    function['architecture'],
+                                    ','.join(sorted(set(function['apis']))),
+                                    generation)
+        return 'scan:' + hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def _version_key(function_id):
+        return 'scan-fn:{}'.format(function_id)
+
+    @staticmethod
+    def _scanned_key(sha256, architecture):
+        data = '{}|{}'.format(sha256, architecture)
+        return 'scan-op:' + hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+    def get_many(self, keys):
+        '''
+        Returns {key : cached scan result} for the keys with a valid entry
+        '''
+        entries = self._backend.get_many(keys)
+        versions = self._backend.get_many({x for entry in entries.values()
+                                            for x in entry['versions']})
+
+        results = {}
+        for key, entry in entries.items():
+            if all([versions.get(x) == v for x, v in entry['versions'].items()]):
+                results[key] = entry['result']
+
+        with self._lock:
+            self.hits += len(results)
+            self.misses += len(keys) - len(results)
+
+        return results
+
+    def set(self, key, result, function_ids, function=None):
+        '''
+        Caches a scan result, function_ids are the IDs of the functions the
+        result depends on
+
+        @param function: Dictionary. The scanned function
+                            (keys: opcodes, architecture)
+        '''
+        version_keys = {self._version_key(x) for x in function_ids}
+        if function is not None:
+            version_keys.add(self._scanned_key(
+                                hashlib.sha256(function['opcodes']).hexdigest(),
+                                function['architecture']))
+
+        versions = self._backend.get_many(version_keys)
+
+        new_versions = {}
+        entry_versions = {}
+        for version_key in version_keys:
+            if version_key not in versions:
+                versions[version_key] = new_versions[version_key] = uuid.uuid4().hex
+
+            entry_versions[version_key] = versions[version_key]
+
+        #   Version tokens outlive the entries that use them
+        if new_versions:
+            self._backend.set_many(new_versions, self._timeout * 2)
+
+        self._backend.set_many({key : {'versions' : entry_versions,
+                                       'result' : result}}, self._timeout)
+
+    def invalidate_functions(self, function_ids):
+        '''Invalidates every entry that matched one of the functions'''
+        self._backend.delete_many([self._version_key(x) for x in function_ids])
+
+    def invalidate_scans(self, sha256, architecture):
+        '''
+        Invalidates every entry of a scan of the opcodes (sha256) and
+        architecture, whichever APIs and engines it was scanned with
+        '''
+        self._backend.delete_many([self._scanned_key(sha256, architecture)])
+
+    def stats(self):
+        data = {'hits' : self.hits, 'misses' : self.misses}
+        if isinstance(self._backend, LRUCache):
+            data['entries'] = len(self._backend)
+
+        return data
+
+
+def create_backend(name, default_size, default_ttl):
+    '''
+    Returns a (cache backend, timeout) tuple built from the configuration
+    values <name>, <name>_size, <name>_ttl and <name>_alias. The backend is
+    None when disabled.
+    '''
+    backend = CONFIG.get(name, 'none')
+    timeout = int(CONFIG.get(name + '_ttl', default_ttl))
+
+    if backend == 'lru':
+        return (LRUCache(int(CONFIG.get(name + '_size', default_size)), timeout),
+                timeout)
+
+    if backend == 'django':
+        from django.core.cache import caches
+        return (caches[CONFIG.get(name + '_alias', 'default')], timeout)
+
+    if backend not in [None, 'none']:
+        print('[1stCache] Unknown {} "{}", disabling it'.format(name, backend))
+
+    return (None, timeout)
+
+
+#   None when the scan cache is disabled
+_backend, _timeout = create_backend('scan_cache', 10000, 300)
+scan_cache = ScanCache(_backend, _timeout) if _backend is not None else None
@@ -27,23 +27,34 @@
 import re
 import math
 import json
+import uuid
 import hashlib
+import datetime
 import configparser 
 from hashlib import md5
 
 #   Third Party Modules
 from django.utils import timezone
+from django.db import transaction
+from django.db.models import Count, Max, Min, F, Q
 from django.core.paginator import Paginator
 from django.core.exceptions import ObjectDoesNotExist, MultipleObjectsReturned
 
 #   FIRST Modules
 from first_core.dbs import AbstractDB
+from first_core.cache import scan_cache
+from first_core.opcodes import prefetch_opcodes
 from first_core.util import make_id, parse_id, separate_metadata, \
                             is_engine_metadata
 from first_core.models import User, Sample, \
                                 Engine, \
                                 Metadata, MetadataDetails, AppliedMetadata, \
-                                Function, FunctionApis
+                                Function, FunctionApis, FunctionFeatures, \
+                                EngineQueue, Architecture
+
+
+#   Maximum number of API name to ID mappings kept in memory
+API_ID_CACHE_SIZE = 100000
 
 
 class FIRSTDB(AbstractDB):
@@ -61,6 +72,8 @@ class FIRSTDB(AbstractDB):
         @param conf: configparser.RawConfigParser
         '''
         self._is_installed = True
+        self._api_ids = {}
+        self._architecture_ids = {}
         '''
         section = 'mongodb_settings'
 
@@ -76,13 +89,43 @@ class FIRSTDB(AbstractDB):
         '''
 
     def get_architectures(self):
-        field = 'architecture'
-        architectures = Function.objects.values(field).distinct()
-
         standards = FIRSTDB.standards.copy()
-        standards.update({x[field] for x in architectures})
+        standards.update(Architecture.objects.values_list('name', flat=True))
         return list(standards)
 
+    def get_architecture_ids(self, architectures, create=False):
+        '''Returns the IDs of the provided architecture names
+
+        IDs of architectures are never changed or reused, so known ones are
+        kept in memory and only unknown names are looked up. IDs used to
+        create rows (create) are always read from the Architecture table.
+
+        Args:
+            architectures (:obj:`list`): Architecture names
+            create (:obj:`bool`): Store the architectures not in FIRST yet
+
+        Returns:
+            dict: {architecture : Architecture ID} for the architectures
+                  stored in FIRST
+        '''
+        ids = {}
+        if not create:
+            ids = {x : self._architecture_ids[x] for x in architectures
+                    if x in self._architecture_ids}
+
+        missing = set(architectures) - set(ids.keys())
+        if missing:
+            if create:
+                Architecture.objects.bulk_create(
+                    [Architecture(name=x) for x in missing], ignore_conflicts=True)
+
+            found = dict(Architecture.objects.filter(name__in=missing)
+                                             .values_list('name', 'id'))
+            self._architecture_ids.update(found)
+            ids.update(found)
+
+        return ids
+
     def get_sample(self, md5_hash, crc32, create=False):
         try:
             #   Get Sample from DB
@@ -153,21 +196,79 @@ class FIRSTDB(AbstractDB):
         '''
         return Metadata.objects.filter(function__pk=_id)
 
+    def get_functions_metadata(self, function_ids):
+        '''Bulk version of get_function_metadata returning serialized
+        metadata, uses a fixed number of queries whatever the number of IDs
+
+        Args:
+            function_ids (:obj:`list`): IDs from Function model
+
+        Returns:
+            dict: {function_id : [dict, ...]}, each dict has the keys of
+                  Metadata.dump and the metadata's id. Lists are ordered by
+                  rank, highest first
+        '''
+        links = Function.metadata.through.objects.filter(
+                    function_id__in={int(x) for x in function_ids})
+        links = list(links.values_list('function_id', 'metadata_id'))
+        metadata_ids = {x[1] for x in links}
+        if not metadata_ids:
+            return {}
+
+        metadata = Metadata.objects.filter(pk__in=metadata_ids)
+        metadata = list(metadata.select_related('user', 'current_details')
+                                .order_by('-applied_count', 'pk'))
+        latest = {m.pk : m.current_details for m in metadata if m.current_details_id}
+
+        #   Metadata stored before current_details existed, ordered by commit
+        #   time so the last one seen is the latest
+        missing = [m.pk for m in metadata if not m.current_details_id]
+        if missing:
+            details = Metadata.details.through.objects.filter(metadata_id__in=missing)
+            details = details.select_related('metadatadetails')
+            for row in details.order_by('metadatadetails__committed'):
+                latest[row.metadata_id] = row.metadatadetails
+
+        functions = {}
+        for function_id, metadata_id in links:
+            functions.setdefault(metadata_id, []).append(function_id)
+
+        #   Metadata is ordered by rank, highest first
+        results = {}
+        for m in metadata:
+            if m.pk not in latest:
+                continue
+
+            data = {'creator' : m.user.user_handle,
+                    'name' : latest[m.pk].name,
+                    'prototype' : latest[m.pk].prototype,
+                    'comment' : latest[m.pk].comment,
+                    'rank' : m.applied_count,
+                    'id' : make_id(0, metadata=m.pk)}
+            for function_id in functions[m.pk]:
+                results.setdefault(function_id, []).append(data)
+
+        return results
+
     def get_function(self, opcodes, architecture, apis, create=False, **kwargs):
         sha256_hash = hashlib.sha256(opcodes).hexdigest()
         function = None
 
         try:
-            function = Function.objects.get(sha256=sha256_hash,
-                                            opcodes=opcodes,
-                                            architecture=architecture) #,
+            function = Function.objects.select_related('architecture').get(
+                                            sha256=sha256_hash,
+                                            architecture__name=architecture) #,
                                             #apis__api=apis)
+            #   Same sha256, the opcodes do not have to be loaded again
+            function._opcodes = opcodes
+
         except ObjectDoesNotExist:
             if create:
                 #   Create function and add it to sample
+                architectures = self.get_architecture_ids([architecture], create=True)
                 function = Function.objects.create( sha256=sha256_hash,
                                                     opcodes=opcodes,
-                                                    architecture=architecture)
+                                                    architecture_id=architectures[architecture])
 
                 apis_ = [FunctionApis.objects.get_or_create(api=x)[0] for x in apis]
                 for api in apis_:
@@ -182,20 +283,68 @@ class FIRSTDB(AbstractDB):
         except:
             return []
 
+    def iter_functions(self, batch_size=500, after_pk=0, architecture=None,
+                       fields=None, until_pk=None):
+        '''Iterates over functions ordered by primary key, one batch at a
+        time using keyset pagination so every query costs the same and only
+        one batch is held in memory
+
+        Args:
+            batch_size (:obj:`int`): Number of functions fetched per query
+            after_pk (:obj:`int`): Only functions with a greater ID
+            architecture (:obj:`str`): Only functions of the architecture
+            fields (:obj:`list`): Function fields to load, all when None. Leave
+                opcodes out to skip loading them, opcodes and APIs are
+                prefetched per batch when included
+            until_pk (:obj:`int`): Only functions with a lower or equal ID
+
+        Yields:
+            Function
+        '''
+        functions = Function.objects.select_related('architecture').order_by('pk')
+        if architecture is not None:
+            functions = functions.filter(architecture__name=architecture)
+
+        if until_pk is not None:
+            functions = functions.filter(pk__lte=until_pk)
+
+        if fields is not None:
+            functions = functions.only(*[x for x in fields
+                                            if x not in ['apis', 'opcodes']]
+                                       + ['architecture__name'])
+
+        if (fields is None) or ('apis' in fields):
+            functions = functions.prefetch_related('apis')
+
+        while True:
+            batch = list(functions.filter(pk__gt=after_pk)[:batch_size])
+            if not batch:
+                break
+
+            if (fields is None) or ('opcodes' in fields):
+                prefetch_opcodes(batch)
+
+            for function in batch:
+                yield function
+
+            after_pk = batch[-1].pk
+
     def find_function(self, _id=None, opcodes=None, apis=None, architecture=None, h_sha256=None):
         try:
             #   User function ID
             if None != _id:
-                return Function.objects.get(pk=_id)
+                return Function.objects.select_related('architecture').get(pk=_id)
 
             #   User opcodes and apis
             elif None not in [opcodes, apis]:
-                return Function.objects.get(opcodes=opcodes, apis=apis)
+                return Function.objects.get(sha256=hashlib.sha256(opcodes).hexdigest(),
+                                            apis=apis)
 
             #   Use hash, architecture
             elif None not in [architecture, h_sha256]:
-                return Function.objects.get(sha256=h_sha256,
-                                            architecture=architecture)
+                return Function.objects.select_related('architecture').get(
+                                            sha256=h_sha256,
+                                            architecture__name=architecture)
 
             else:
                 return None
@@ -207,6 +356,185 @@ class FIRSTDB(AbstractDB):
             #   TODO: Log
             raise
 
+    def find_functions(self, keys):
+        '''Bulk version of find_function using the hash and architecture
+
+        Args:
+            keys (:obj:`list`): List of (sha256, architecture) tuples
+
+        Returns:
+            dict: {(sha256, architecture) : Function}, APIs are prefetched
+        '''
+        keys = set(keys)
+        if not keys:
+            return {}
+
+        functions = Function.objects.filter(
+                        sha256__in={x[0] for x in keys},
+                        architecture__name__in={x[1] for x in keys})
+        functions = functions.select_related('architecture').prefetch_related('apis')
+
+        return {(f.sha256, f.architecture.name) : f for f in functions
+                if (f.sha256, f.architecture.name) in keys}
+
+    def existing_functions(self, ids):
+        '''Returns the subset of the provided Function IDs that exist
+
+        Args:
+            ids (:obj:`list`): IDs from Function model
+
+        Returns:
+            set: Function IDs
+        '''
+        return set(Function.objects.filter(pk__in=set(ids))
+                                   .values_list('pk', flat=True))
+
+    def get_api_ids(self, apis):
+        '''Returns the IDs of the provided API names
+
+        IDs of APIs are never changed or reused, so known ones are kept in
+        memory and only unknown names are looked up.
+
+        Args:
+            apis (:obj:`list`): API names
+
+        Returns:
+            dict: {api : FunctionApis ID} for the APIs stored in FIRST
+        '''
+        ids = {x : self._api_ids[x] for x in apis if x in self._api_ids}
+        missing = set(apis) - set(ids.keys())
+        if missing:
+            found = dict(FunctionApis.objects.filter(api__in=missing)
+                                             .values_list('api', 'id'))
+            if len(self._api_ids) > API_ID_CACHE_SIZE:
+                self._api_ids = {}
+
+            self._api_ids.update(found)
+            ids.update(found)
+
+        return ids
+
+    def functions_with_metadata(self, ids):
+        '''Returns the IDs of the provided functions that have metadata
+
+        Args:
+            ids (:obj:`list`): IDs from Function model
+
+        Returns:
+            set: Function IDs
+        '''
+        return set(Function.metadata.through.objects
+                       .filter(function_id__in=set(ids))
+                       .values_list('function_id', flat=True))
+
+    def get_functions_apis(self, ids):
+        '''Returns the API IDs of the provided functions that have metadata
+
+        Args:
+            ids (:obj:`list`): IDs from Function model
+
+        Returns:
+            dict: {function_id : frozenset of FunctionApis IDs}, functions
+                  without metadata are left out
+        '''
+        with_metadata = self.functions_with_metadata(ids)
+        apis = {x : set() for x in with_metadata}
+        if with_metadata:
+            for function_id, api_id in (Function.apis.through.objects
+                                            .filter(function_id__in=with_metadata)
+                                            .values_list('function_id', 'functionapis_id')):
+                apis[function_id].add(api_id)
+
+        return {k : frozenset(v) for k, v in apis.items()}
+
+    def get_top_ranked_functions(self, ids, limit):
+        '''Returns the functions with the highest ranked metadata
+
+        Args:
+            ids (:obj:`list`): IDs from Function model, or a query of them
+            limit (:obj:`int`): Maximum number of functions returned
+
+        Returns:
+            list: Function IDs ordered by the rank of their highest ranked
+                  metadata, functions without metadata are left out
+        '''
+        return list(Function.metadata.through.objects
+                        .filter(function_id__in=ids)
+                        .values('function_id')
+                        .annotate(rank=Max('metadata__applied_count'))
+                        .order_by('-rank', 'function_id')
+                        .values_list('function_id', flat=True)[:limit])
+
+    def get_top_metadata(self, ids):
+        '''Returns the highest ranked metadata of the provided functions
+
+        Args:
+            ids (:obj:`list`): IDs from Function model, or a query of them
+
+        Returns:
+            dict: Metadata (keys: name, prototype, comment, rank), None if
+                  the functions have no metadata
+        '''
+        metadata = (Metadata.objects.filter(function__in=ids)
+                        .select_related('current_details')
+                        .order_by('-applied_count', 'pk').first())
+        details = metadata.latest_details if metadata else None
+        if not details:
+            return None
+
+        return {'name' : details.name, 'prototype' : details.prototype,
+                'comment' : details.comment, 'rank' : metadata.rank}
+
+    def get_opcodes(self, ids):
+        '''Returns the opcodes of the provided Function IDs
+
+        Args:
+            ids (:obj:`list`): IDs from Function model
+
+        Returns:
+            dict: {function_id : opcodes}
+        '''
+        functions = list(Function.objects.filter(pk__in=set(ids))
+                                         .only('pk', 'sha256'))
+        prefetch_opcodes(functions)
+        return {f.pk : f.opcodes for f in functions if f.opcodes is not None}
+
+    def get_function_features(self, function_ids, version):
+        '''
+        Returns the stored features of the functions
+
+        @param function_ids: List of Function IDs
+        @param version: Integer. Only features computed with this version
+        @returns Dictionary. {<function_id> : Dictionary of features}
+                    (keys: see first_core.features.FEATURES)
+        '''
+        rows = FunctionFeatures.objects.filter(function_id__in=function_ids,
+                                               version=version)
+        features = {}
+        for x in rows.values('function_id', 'instructions', 'mnemonic_sha256',
+                             'masked_sha256', 'masked_changed', 'catalog1'):
+            if x['catalog1'] is not None:
+                x['catalog1'] = bytes(x['catalog1'])
+
+            features[x.pop('function_id')] = x
+
+        return features
+
+    def add_function_features(self, features, version):
+        '''
+        Stores the features of functions, replacing the features stored
+        with other versions
+
+        @param features: Dictionary. {<function_id> : Dictionary of features}
+        @param version: Integer. Version the features were computed with
+        '''
+        FunctionFeatures.objects.filter(function_id__in=features.keys()) \
+                                .exclude(version=version).delete()
+        FunctionFeatures.objects.bulk_create(
+            [FunctionFeatures(function_id=function_id, version=version, **x)
+                for function_id, x in features.items()],
+            ignore_conflicts=True)
+
     def add_function_to_sample(self, sample, function):
         if (not isinstance(sample, Sample)) or (not isinstance(function, Function)):
             return False
@@ -234,6 +562,14 @@ class FIRSTDB(AbstractDB):
                                                 prototype=prototype,
                                                 comment=comment)
             metadata.details.add(md)
+            metadata.current_details = md
+            metadata.save(update_fields=['current_details'])
+
+            #   Scans of this exact function may not have matched anything
+            if scan_cache:
+                scan_cache.invalidate_functions([function.id])
+                scan_cache.invalidate_scans(function.sha256,
+                                            function.architecture.name)
 
         return metadata.id
 
@@ -241,7 +577,8 @@ class FIRSTDB(AbstractDB):
         results = []
         metadata_ids, engine_metadata = separate_metadata(metadata)
 
-        for _id, metadata in Metadata.objects.in_bulk(metadata_ids).items():
+        metadata_objs = Metadata.objects.select_related('user', 'current_details')
+        for _id, metadata in metadata_objs.in_bulk(metadata_ids).items():
             data = metadata.dump()
             data['id'] = make_id(0, metadata=metadata.id)
             results.append(data)
@@ -271,6 +608,7 @@ class FIRSTDB(AbstractDB):
         metadata_id = user_metadata[0]
         try:
             metadata = Metadata.objects.get(pk=metadata_id, user=user)
+            self._invalidate_metadata_scans(metadata)
             metadata.delete()
             return True
 
@@ -284,7 +622,9 @@ class FIRSTDB(AbstractDB):
         if (page < 1) or (not isinstance(user, User)):
             return (results, pages)
 
-        p = Paginator(Metadata.objects.filter(user=user), max_metadata)
+        metadata = Metadata.objects.filter(user=user).order_by('pk')
+        metadata = metadata.select_related('user', 'current_details')
+        p = Paginator(metadata, max_metadata)
         pages = p.num_pages
 
         if page >  pages:
@@ -361,9 +701,17 @@ class FIRSTDB(AbstractDB):
                 #   Metadata does not exist
                 return False
 
-            r = AppliedMetadata.objects.get_or_create(  user=user,
+            with transaction.atomic():
+                r, created = AppliedMetadata.objects.get_or_create(
+                                                        user=user,
                                                         sample=sample,
                                                         metadata=metadata)
+                if created:
+                    Metadata.objects.filter(pk=metadata.pk).update(
+                        applied_count=F('applied_count') + 1)
+
+            if created:
+                self._invalidate_metadata_scans(metadata)
 
         return True
 
@@ -404,22 +752,114 @@ class FIRSTDB(AbstractDB):
                 #   Metadata does not exist
                 return False
 
-            try:
-                data = AppliedMetadata.objects.get( user=user,
-                                                    sample=sample,
-                                                    metadata=metadata)
-                data.delete()
-                return True
+            with transaction.atomic():
+                deleted, _ = AppliedMetadata.objects.filter(user=user,
+                                                            sample=sample,
+                                                            metadata=metadata).delete()
+                if deleted:
+                    Metadata.objects.filter(pk=metadata.pk).update(
+                        applied_count=F('applied_count') - deleted)
 
-            except ObjectDoesNotExist:
-                return True
+            if deleted:
+                self._invalidate_metadata_scans(metadata)
+
+            return True
 
 
         return False
 
+    def _invalidate_metadata_scans(self, metadata):
+        '''Invalidates cached scans matching functions with the metadata'''
+        if scan_cache:
+            scan_cache.invalidate_functions(
+                Function.objects.filter(metadata=metadata)
+                                .values_list('pk', flat=True))
+
     def engines(self, active=True):
         return Engine.objects.filter(active=bool(active))
 
+    def engines_token(self):
+        '''Returns a value that changes whenever an engine is installed,
+        deleted, enabled or disabled.
+
+        Returns:
+            string: Token built from the number of engines and the time the
+                    most recently modified engine was saved
+        '''
+        data = Engine.objects.aggregate(total=Count('id'),
+                                        modified=Max('modified'))
+        return '{0[total]}:{0[modified]}'.format(data)
+
+    def queue_functions(self, functions, engines=None):
+        '''
+        Queues functions to be added to the engines by the engine worker
+
+        @param functions: List of Function objects
+        @param engines: List of engine names, None for all active engines
+        '''
+        engines = ','.join(engines or [])
+        EngineQueue.objects.bulk_create([EngineQueue(function=f, engines=engines)
+                                            for f in functions])
+
+    def claim_queued(self, limit, lease, max_attempts):
+        '''
+        Claims queued jobs for a worker. A claimed job is hidden from other
+        workers for lease seconds, if it is not completed or retried by then
+        it can be claimed again (at least once processing).
+
+        @param limit: Maximum number of jobs to claim
+        @param lease: Number of seconds the jobs are claimed for
+        @param max_attempts: Jobs attempted this many times are not claimed
+        @returns List of EngineQueue objects
+        '''
+        now = timezone.now()
+        ids = list(EngineQueue.objects.filter(available__lte=now,
+                                              attempts__lt=max_attempts)
+                        .order_by('available', 'id')
+                        .values_list('id', flat=True)[:limit])
+        if not ids:
+            return []
+
+        #   Only rows still available are updated, so a row claimed by
+        #   another worker in the meantime is skipped
+        worker = str(uuid.uuid4())
+        EngineQueue.objects.filter(pk__in=ids, available__lte=now).update(
+            available=now + datetime.timedelta(seconds=lease),
+            attempts=F('attempts') + 1, worker=worker)
+
+        return list(EngineQueue.objects.filter(worker=worker).order_by('id'))
+
+    def complete_queued(self, jobs):
+        '''Removes processed jobs from the queue'''
+        EngineQueue.objects.filter(pk__in=[x.pk for x in jobs],
+                                   worker__in={x.worker for x in jobs}).delete()
+
+    def retry_queued(self, job, engines, error, delay):
+        '''
+        Makes a job available again after delay seconds, only for the
+        provided engine names
+        '''
+        EngineQueue.objects.filter(pk=job.pk, worker=job.worker).update(
+            engines=','.join(engines), last_error=str(error)[:1024],
+            available=timezone.now() + datetime.timedelta(seconds=delay),
+            worker='')
+
+    def queue_status(self, max_attempts):
+        '''
+        Returns a Dictionary describing the state of the engine queue
+        (keys: queued, ready, retrying, failed, oldest)
+        '''
+        now = timezone.now()
+        jobs = EngineQueue.objects
+        oldest = jobs.aggregate(oldest=Min('created'))['oldest']
+        return {'queued' : jobs.count(),
+                'ready' : jobs.filter(available__lte=now,
+                                      attempts__lt=max_attempts).count(),
+                'retrying' : jobs.filter(attempts__gt=0,
+                                         attempts__lt=max_attempts).count(),
+                'failed' : jobs.filter(attempts__gte=max_attempts).count(),
+                'oldest' : str(oldest) if oldest else None}
+
     def get_engine(self, engine_id):
         engines = Engine.objects.filter(pk=engine_id)
         if not engines.count():
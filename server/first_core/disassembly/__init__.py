@@ -1,4 +1,8 @@
+#   Python Modules
+import threading
+
 #   Third Party Modules
+import numpy
 
 from capstone import CS_MODE_32
 from capstone import CS_MODE_64
@@ -169,37 +173,188 @@ stack_offsets = {
 }
 
 
+#   Capstone handles of each thread, {(architecture, detail) : Cs}
+_handles = threading.local()
+
+
+def get_handle(architecture, detail=False):
+    '''
+    Returns the calling thread's Capstone handle for the architecture and
+    detail level. Handles are created once per thread and reused by every
+    Disassembly, they must not be passed to other threads.
+    '''
+    handles = getattr(_handles, 'handles', None)
+    if handles is None:
+        handles = _handles.handles = {}
+
+    key = (architecture, bool(detail))
+    if key not in handles:
+        md = Cs(*arch_mapping[architecture])
+        md.detail = bool(detail)
+        handles[key] = md
+
+    return handles[key]
+
+
+#   InstructionTable.flags bits
+FLAG_CALL = 1
+FLAG_JUMP = 2
+
+#   Mnemonics are interned so the instructions of every function share ids
+_mnemonics = []
+_mnemonic_ids = {}
+_mnemonic_lock = threading.Lock()
+
+
+def mnemonic_id(mnemonic):
+    '''Returns the interned ID of a mnemonic'''
+    try:
+        return _mnemonic_ids[mnemonic]
+
+    except KeyError:
+        with _mnemonic_lock:
+            if mnemonic not in _mnemonic_ids:
+                _mnemonics.append(mnemonic)
+                _mnemonic_ids[mnemonic] = len(_mnemonics) - 1
+
+            return _mnemonic_ids[mnemonic]
+
+
+def mnemonic_name(mnemonic_id):
+    '''Returns the mnemonic of an interned ID'''
+    return _mnemonics[mnemonic_id]
+
+
+class InstructionTable(object):
+    '''
+    Instructions of a function stored column by column, one NumPy array
+    entry per instruction:
+
+        offsets         uint32, offset of the instruction in the code
+        sizes           uint8, size of the instruction in bytes
+        ids             uint32, Capstone instruction ID
+        mnemonic_ids    uint32, interned mnemonic, see mnemonic_name
+        flags           uint8, FLAG_CALL and FLAG_JUMP bits
+
+    Operand data requires Capstone's detail mode and is only decoded for
+    the rows requested with Disassembly.table(detail=...), it is None
+    until then:
+
+        detailed        bool, whether the row's operand data was decoded
+        op_types        int32, type of the first operand, -1 without operands
+        opcodes         uint8 (N, 4), opcode bytes (x86 only, zero elsewhere)
+    '''
+    def __init__(self, code, instructions, architecture):
+        self.code = code
+
+        offsets, sizes, ids, mnemonic_ids = [], [], [], []
+        for i in instructions:
+            offsets.append(i.address)
+            sizes.append(i.size)
+            ids.append(i.id)
+            mnemonic_ids.append(mnemonic_id(i.mnemonic))
+
+        self.offsets = numpy.array(offsets, dtype=numpy.uint32)
+        self.sizes = numpy.array(sizes, dtype=numpy.uint8)
+        self.ids = numpy.array(ids, dtype=numpy.uint32)
+        self.mnemonic_ids = numpy.array(mnemonic_ids, dtype=numpy.uint32)
+
+        self.flags = numpy.zeros(len(ids), dtype=numpy.uint8)
+        self.flags[numpy.isin(self.ids, call_mapping.get(architecture, []))] |= FLAG_CALL
+        self.flags[numpy.isin(self.ids, jump_mapping.get(architecture, []))] |= FLAG_JUMP
+
+        self.detailed = None
+        self.op_types = None
+        self.opcodes = None
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def _add_detail(self, md, architecture, rows=None):
+        '''
+        Fills the operand columns of the rows (all if None) by decoding
+        their instructions with a detail mode Capstone handle
+        '''
+        if self.detailed is None:
+            self.detailed = numpy.zeros(len(self), dtype=bool)
+            self.op_types = numpy.full(len(self), -1, dtype=numpy.int32)
+            self.opcodes = numpy.zeros((len(self), 4), dtype=numpy.uint8)
+
+        if rows is None:
+            rows = range(len(self))
+            instructions = md.disasm(self.code, 0)
+
+        else:
+            rows = [x for x in rows if not self.detailed[x]]
+            instructions = (next(md.disasm(self.instruction_bytes(x),
+                                           int(self.offsets[x]), 1))
+                            for x in rows)
+
+        x86 = arch_mapping[architecture][0] == CS_ARCH_X86
+        for row, i in zip(rows, instructions):
+            operands = i.operands
+            if operands:
+                self.op_types[row] = operands[0].type
+
+            if x86:
+                self.opcodes[row] = i.opcode
+
+            self.detailed[row] = True
+
+    def instruction_bytes(self, row):
+        '''Returns the bytes of the instruction in the row'''
+        offset = int(self.offsets[row])
+        return self.code[offset:offset + int(self.sizes[row])]
+
+    def mnemonics(self):
+        '''Returns the mnemonic of each instruction as a list of Strings'''
+        return [_mnemonics[x] for x in self.mnemonic_ids.tolist()]
+
+
 class Disassembly(object):
     def __init__(self, architecture, code):
-        self.md = None
-        self.data = []
+        self.data = None
         self.code = code
-        self.iterator = None
         self.architecture = architecture
+        self._table = None
+        self._lock = threading.Lock()
 
-        self.valid = False
+        self.valid = architecture in arch_mapping
 
-        if architecture in arch_mapping:
-            arch, mode = arch_mapping[architecture]
-            self.md = Cs(arch, mode)
-            self.md.detail = True
-            self.iterator = self.md.disasm(self.code, 0)
-            self.valid = True
+    def table(self, detail=None):
+        '''
+        Returns the InstructionTable of the code, decoded once and shared by
+        every engine, engines may request it concurrently from different
+        threads.
 
+        @param detail: None, True to decode the operand data of every
+                        instruction or a list of rows to decode it for.
+                        Capstone's detail mode is only used for these rows.
+        '''
+        with self._lock:
+            if self._table is None:
+                instructions = []
+                if self.valid:
+                    instructions = get_handle(self.architecture).disasm(self.code, 0)
 
+                self._table = InstructionTable(self.code, instructions,
+                                               self.architecture)
 
-    def instructions(self):
-        #   When first called function will return cached instructions
-        for i in range(len(self.data)):
-            yield self.data[i]
+            if self.valid and (detail is not None) and (detail is not False):
+                self._table._add_detail(get_handle(self.architecture, True), self.architecture,
+                                        None if detail is True else detail)
 
-        #   Then iterate through non-cached instructions
-        if self.iterator:
-            for i in self.iterator:
-                self.data.append(i)
-                yield i
+        return self._table
 
-            self.iterator = None
+    def instructions(self):
+        '''Returns an iterator over the detailed Capstone instructions'''
+        with self._lock:
+            if self.data is None:
+                self.data = []
+                if self.valid:
+                    self.data = list(get_handle(self.architecture, True).disasm(self.code, 0))
+
+        return iter(self.data)
 
 
     def _check_mapping(self, mapping, operand, attr='type', equal=True):
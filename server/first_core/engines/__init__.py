@@ -13,15 +13,56 @@
 #   Python Modules
 import re
 import sys
+import time
+import heapq
 import functools
+import importlib
+import threading
+import concurrent.futures
+from collections import Counter
 
 #   First Modules
+from first.settings import CONFIG
 from first_core.error import FIRSTError
 from first_core.dbs import FIRSTDBManager
-from first_core.engines.results import Result
+from first_core.models import Architecture
+from first_core.cache import scan_cache
+from first_core.engines.results import Result, FunctionResult, EngineResult
 from first_core.disassembly import Disassembly
+from first_core.features import FEATURES_VERSION, compute_features
 
 #   Third Party Modules
+from django.db import connection, transaction, close_old_connections
+from django.db.models import Count, F
+
+#   Scan modes accepted by FIRSTEngineManager.scan_many
+SCAN_MODES = ['fast', 'thorough']
+
+#   Maximum number of candidates an engine returns per scanned function
+TOP_CANDIDATES = int(CONFIG.get('engine_top_candidates', 50))
+
+#   Hash bucket engines only score the BUCKET_FANOUT functions with the
+#   highest ranked metadata of a bucket. Buckets with more than STOPLIST_SIZE
+#   functions are too common to tell functions apart, they return a summary
+#   result instead of their functions.
+BUCKET_FANOUT = int(CONFIG.get('engine_bucket_fanout', 1000))
+STOPLIST_SIZE = int(CONFIG.get('engine_stoplist_size', 50000))
+
+
+def hash_key(sha256):
+    '''
+    Returns the key stored instead of a hex sha256 in the engines' entry
+    tables, the first 8 bytes of the hash as a signed 64 bit integer
+    '''
+    return int.from_bytes(bytes.fromhex(sha256[:16]), 'big', signed=True)
+
+
+def entry_functions(entry_model, sha256, architecture):
+    '''Returns the IDs of the functions an entry model stores for a hash'''
+    architectures = Architecture.objects.filter(name=architecture).values('id')
+    return list(entry_model.objects.filter(architecture__in=architectures,
+                                           hash_key=hash_key(sha256))
+                                   .values_list('function_id', flat=True))
 
 
 #   Class for FirstEngine related exceptions
@@ -50,6 +91,21 @@ class AbstractEngine(object):
                     'implementations')
     _required_db_names = []
 
+    #   Optional Class variables used by fast scans
+    #   _tier: Relative cost of a scan, engines in lower tiers run first
+    #   _sufficient_similarity: Similarity at which a hit from this engine
+    #       makes engines of more expensive tiers unnecessary, None if its
+    #       hits never do
+    #
+    #   Optional Class variable used when adding functions
+    #   _required_features: Names of the first_core.features the engine uses
+    #       (see _function_features), the engine manager provides the stored
+    #       features when an engine requires any
+    #--------------------------------------------------------------------------
+    _tier = 1
+    _sufficient_similarity = None
+    _required_features = []
+
     _is_operational = False
     _dbs = {}
 
@@ -68,6 +124,18 @@ class AbstractEngine(object):
     def description(self):
         return self._description
 
+    @property
+    def tier(self):
+        return self._tier
+
+    @property
+    def sufficient_similarity(self):
+        return self._sufficient_similarity
+
+    @property
+    def required_features(self):
+        return self._required_features
+
     #   Required Methods
     #   At the very least the _add and _scan functions have to be implemented
     #   If additional steps are needed to install or uninstall engine then
@@ -97,10 +165,48 @@ class AbstractEngine(object):
 
         self._add(function)
 
+    def add_many(self, functions):
+        '''
+        Adds several functions to the engine at once
+
+        @param functions: List of Dictionaries
+                            (keys: id, apis, opcodes, architecture, sha256,
+                             optional keys: disassembly, features)
+                          features is the Dictionary of stored features
+                          (see first_core.features) when available
+        '''
+        required_keys = {'id', 'apis', 'opcodes', 'architecture', 'sha256'}
+        valid = []
+        for function in functions:
+            if ((dict != type(function))
+                or not required_keys.issubset(list(function.keys()))):
+                print('Data provided is not the correct type or required keys not provided')
+                continue
+
+            valid.append(function)
+
+        if valid:
+            self._add_many(valid)
+
     def scan(self, opcodes, architecture, apis, **kwargs):
         '''Returns a list of Result objects'''
         results = self._scan(opcodes, architecture, apis, **kwargs)
+        return self._check_results(results)
 
+    def scan_many(self, functions):
+        '''
+        Returns a list containing a list of Result objects for each function
+
+        @param functions: List of Dictionaries
+                            (keys: opcodes, architecture, apis, disassembly)
+        '''
+        results = self._scan_many(functions)
+        if (type(results) != list) or (len(results) != len(functions)):
+            return [[] for f in functions]
+
+        return [self._check_results(x) for x in results]
+
+    def _check_results(self, results):
         if isinstance(results, Result):
             return [results]
 
@@ -128,14 +234,473 @@ class AbstractEngine(object):
 
             raise e
 
+    def upgrade(self):
+        try:
+            self._upgrade()
+        except FIRSTEngineError as e:
+            if str(e) == 'Not Implemented':
+                return
+
+            raise e
+
     def _add(self, function):
         '''Returns nothing'''
         raise FIRSTEngineError('Not Implemented')
 
+    def _add_many(self, functions):
+        '''
+        Returns nothing [Optional]
+
+        Engines able to store several functions with bulk queries should
+        implement this, by default each function is added on its own. The
+        remaining functions are still added when one fails, a
+        FIRSTEngineError listing the failures is raised afterwards.
+        '''
+        errors = []
+        for function in functions:
+            try:
+                self._add(function)
+
+            except FIRSTEngineError as e:
+                if str(e) == 'Not Implemented':
+                    raise e
+
+                errors.append((function['id'], e))
+
+            except Exception as e:
+                errors.append((function['id'], e))
+
+        if errors:
+            raise FIRSTEngineError('Unable to add {} of {} functions: {}'.format(
+                                    len(errors), len(functions),
+                                    ', '.join(['{}: {}'.format(*x)
+                                               for x in errors[:5]])))
+
+    def _function_features(self, function):
+        '''
+        Returns the features of a function (see first_core.features), the
+        stored ones provided by the engine manager or the engine's required
+        features computed when none were provided
+        '''
+        if function.get('features') is not None:
+            return function['features']
+
+        return compute_features(function, self.required_features)
+
+    def _bulk_add_functions(self, model, entry_model, buckets, count=False):
+        '''
+        Adds function IDs to hash rows using bulk queries within a single
+        transaction. Hash rows that do not exist yet are created and each
+        function gets one (architecture ID, hash key, function_id) entry
+        row, existing entries are left untouched (INSERT IGNORE).
+
+        @param model: Model with sha256 and architecture (Architecture
+                      foreign key) fields
+        @param entry_model: Model with architecture, hash_key and
+                            function_id fields, unique together
+        @param buckets: Dictionary.
+                    { (sha256, architecture) :
+                        (Dictionary of values used when creating the row,
+                         set of function IDs) }
+        @param count: Boolean. Increase the function_count column of the
+                      rows by the number of entries added to them. The
+                      same function added concurrently by two processes
+                      can be counted twice, see _recount_buckets.
+        @returns Tuple. ({ (sha256, architecture) : model obj },
+                         set of (sha256, architecture) created)
+        '''
+        if not buckets:
+            return ({}, set())
+
+        db = self._dbs['first_db']
+        architectures = db.get_architecture_ids({x[1] for x in buckets},
+                                                create=True)
+
+        def fetch(keys):
+            rows = model.objects.select_related('architecture').filter(
+                        sha256__in={x[0] for x in keys},
+                        architecture__in={architectures[x[1]] for x in keys}) \
+                        .order_by('pk')
+            found = {}
+            for row in rows:
+                key = (row.sha256, row.architecture.name)
+                if (key in keys) and (key not in found):
+                    found[key] = row
+
+            return found
+
+        with transaction.atomic():
+            objs = fetch(set(buckets.keys()))
+            created = set(buckets.keys()) - set(objs.keys())
+            if created:
+                model.objects.bulk_create(
+                    [model(sha256=key[0], architecture_id=architectures[key[1]],
+                           **buckets[key][0])
+                        for key in created],
+                    ignore_conflicts=True)
+                objs.update(fetch(created))
+
+            entries = {(architectures[key[1]], hash_key(key[0]), x) : key
+                        for key, (defaults, ids) in buckets.items() if key in objs
+                        for x in ids}
+            existing = set(entry_model.objects.filter(
+                                architecture__in={x[0] for x in entries},
+                                hash_key__in={x[1] for x in entries},
+                                function_id__in={x[2] for x in entries})
+                            .values_list('architecture', 'hash_key', 'function_id'))
+            added = [x for x in entries if x not in existing]
+            entry_model.objects.bulk_create(
+                [entry_model(architecture=x[0], hash_key=x[1], function_id=x[2])
+                    for x in added],
+                ignore_conflicts=True)
+
+            if count:
+                totals = Counter([objs[entries[x]].pk for x in added])
+                by_total = {}
+                for pk, total in totals.items():
+                    by_total.setdefault(total, []).append(pk)
+
+                for total, pks in by_total.items():
+                    model.objects.filter(pk__in=pks).update(
+                        function_count=F('function_count') + total)
+
+        return (objs, created & set(objs.keys()))
+
+    def _hash_functions(self, entry_model, keys):
+        '''
+        Returns {(sha256, architecture) : List of Function IDs} for the
+        provided keys with a single query on the entries' index
+        '''
+        functions = {}
+        wanted = self._entry_keys(keys)
+        if not wanted:
+            return functions
+
+        rows = entry_model.objects.filter(
+                    architecture__in={x[0] for x in wanted},
+                    hash_key__in={x[1] for x in wanted})
+        for architecture, key, function_id in rows.values_list(
+                'architecture', 'hash_key', 'function_id'):
+            if (architecture, key) in wanted:
+                functions.setdefault(wanted[(architecture, key)], []).append(function_id)
+
+        return functions
+
+    def _entry_keys(self, keys):
+        '''
+        Returns {(architecture ID, hash key) : (sha256, architecture)} for
+        the provided (sha256, architecture) keys, architectures not stored in
+        FIRST are left out
+        '''
+        db = self._dbs['first_db']
+        architectures = db.get_architecture_ids({x[1] for x in keys})
+        return {(architectures[x[1]], hash_key(x[0])) : x for x in keys
+                    if x[1] in architectures}
+
+    def _count_bucket_functions(self, model, entry_model, buckets):
+        '''
+        Stores the number of functions with each bucket's hash in the
+        bucket's function_count column, counting all their entries
+
+        @param model: Engine model with sha256, architecture and
+                      function_count fields
+        @param entry_model: Model of the bucket's function entries
+        @param buckets: List of model objects to update
+        '''
+        wanted = {(x.architecture_id, hash_key(x.sha256)) for x in buckets}
+        counts = {}
+        if wanted:
+            rows = (entry_model.objects.filter(
+                        architecture__in={x[0] for x in wanted},
+                        hash_key__in={x[1] for x in wanted})
+                    .values('architecture', 'hash_key').annotate(total=Count('pk')))
+            for row in rows:
+                counts[(row['architecture'], row['hash_key'])] = row['total']
+
+        for bucket in buckets:
+            bucket.function_count = counts.get((bucket.architecture_id,
+                                                hash_key(bucket.sha256)), 0)
+
+        model.objects.bulk_update(buckets, ['function_count'])
+
+    def _convert_text_tables(self, model, entry_model, links, new_models=[],
+                             legacy_tables=[]):
+        '''
+        Converts the hash table of older versions of the engine, storing the
+        sha256 and the architecture as text and linking functions through a
+        many to many table, see _upgrade. Like www migration 0010 the text
+        values are copied into the Sha256Field and Architecture columns: the
+        old table is renamed aside, the engine's tables are created, rows and
+        links are copied into them and the old tables are dropped. An
+        interrupted conversion continues from the renamed table.
+
+        @param model: Engine model with sha256 and architecture fields
+        @param entry_model: Model of the bucket's function entries
+        @param links: Tuple (many to many table, hash column, function column,
+                             function table) of the old version, the function
+                             table stores the function ID in its func column
+        @param new_models: Other models of the engine, created when their
+                            table does not exist
+        @param legacy_tables: Other tables of the old version, dropped once
+                                converted
+        @returns Boolean, True if tables were converted
+        '''
+        db = self._dbs['first_db']
+        table = model._meta.db_table
+        legacy = table + '_text'
+        quote = connection.ops.quote_name
+        links_table, hash_column, function_column, functions_table = links
+
+        with connection.cursor() as cursor:
+            tables = connection.introspection.table_names(cursor)
+            if legacy not in tables:
+                if table not in tables:
+                    return False
+
+                columns = [x.name for x in
+                    connection.introspection.get_table_description(cursor, table)]
+                if 'architecture' not in columns:
+                    return False
+
+            with connection.schema_editor() as schema_editor:
+                if legacy not in tables:
+                    schema_editor.alter_db_table(model, table, legacy)
+                    tables.remove(table)
+
+                for new_model in [model, entry_model] + new_models:
+                    if new_model._meta.db_table not in tables:
+                        schema_editor.create_model(new_model)
+
+            columns = [x.name for x in
+                connection.introspection.get_table_description(cursor, legacy)
+                if x.name != 'id']
+
+            #   Hash rows, other columns (BasicMasking's total_bytes) keep their name
+            print(' + Converting {}'.format(table))
+            last_id = 0
+            while True:
+                cursor.execute('SELECT id, {} FROM {} WHERE id > %s ORDER BY id '
+                               'LIMIT 5000'.format(
+                                    ', '.join([quote(x) for x in columns]),
+                                    quote(legacy)),
+                               [last_id])
+                batch = cursor.fetchall()
+                if not batch:
+                    break
+
+                last_id = batch[-1][0]
+                rows = [dict(zip(columns, x[1:])) for x in batch]
+                architectures = db.get_architecture_ids(
+                                    {x['architecture'] for x in rows}, create=True)
+                for row in rows:
+                    row['architecture_id'] = architectures[row.pop('architecture')]
+
+                model.objects.bulk_create([model(**row) for row in rows],
+                                          ignore_conflicts=True)
+
+            #   Functions linked to the hashes
+            print(' + Converting {}'.format(links_table))
+            last_id = 0
+            while True:
+                cursor.execute('SELECT l.id, h.sha256, h.architecture, f.func '
+                               'FROM {} l INNER JOIN {} h ON h.id = l.{} '
+                               'INNER JOIN {} f ON f.id = l.{} '
+                               'WHERE l.id > %s ORDER BY l.id LIMIT 5000'.format(
+                                    quote(links_table), quote(legacy),
+                                    quote(hash_column), quote(functions_table),
+                                    quote(function_column)),
+                               [last_id])
+                batch = cursor.fetchall()
+                if not batch:
+                    break
+
+                last_id = batch[-1][0]
+                architectures = db.get_architecture_ids({x[2] for x in batch},
+                                                        create=True)
+                entry_model.objects.bulk_create(
+                    [entry_model(architecture=architectures[architecture],
+                                 hash_key=hash_key(sha256),
+                                 function_id=function_id)
+                        for _, sha256, architecture, function_id in batch],
+                    ignore_conflicts=True)
+
+        with connection.schema_editor() as schema_editor:
+            for name in legacy_tables + [links_table, functions_table, legacy]:
+                if name in tables + [legacy]:
+                    schema_editor.execute(schema_editor.sql_delete_table
+                                            % {'table' : quote(name)})
+
+        return True
+
+    def _update_migrations(self):
+        '''
+        Records tables converted by _convert_text_tables in the engines app's
+        migrations. The tables already match the models, the migration is
+        created and marked as applied without running it. Models of every
+        installed engine are loaded so that the migration keeps them.
+        '''
+        from first_core.models import Engine
+        from django.core.management import call_command
+
+        for path in Engine.objects.values_list('path', flat=True):
+            try:
+                importlib.import_module(path)
+            except ImportError as e:
+                print('[1stEM] Unable to load {}: {}'.format(path, e))
+
+        call_command('makemigrations', 'engines', interactive=False)
+        call_command('migrate', 'engines', fake=True)
+
+    def _recount_buckets(self, model, entry_model):
+        '''Fills the function_count column of every bucket, see _upgrade'''
+        rows = model.objects.order_by('pk').only('sha256', 'architecture',
+                                                 'function_count')
+        total = rows.count()
+        msg = ' [Status] {0:.2f}% Completed ({1} out of {2})\r'
+
+        last_pk = 0
+        completed = 0
+        while True:
+            batch = list(rows.filter(pk__gt=last_pk)[:5000])
+            if not batch:
+                break
+
+            last_pk = batch[-1].pk
+            self._count_bucket_functions(model, entry_model, batch)
+
+            completed += len(batch)
+            sys.stdout.write(msg.format((completed / total) * 100, completed, total))
+            sys.stdout.flush()
+
+        sys.stdout.write('\n')
+
+    def _bucket_candidates(self, entry_model, buckets):
+        '''
+        Gets the candidate functions of hash buckets without loading every
+        function of large buckets
+
+        @param entry_model: Model of the bucket's function entries
+        @param buckets: List of model objects with sha256, architecture and
+                        function_count fields, the architecture selected
+                        with select_related
+        @returns Tuple of Dictionaries (candidates, summaries), keyed by
+                    (sha256, architecture)
+                    candidates: List of Function IDs, at most BUCKET_FANOUT,
+                                the functions with the highest ranked metadata
+                    summaries: Dictionary of metadata for an EngineResult,
+                               for stop-listed buckets
+        '''
+        db = self._dbs['first_db']
+
+        counts = {}
+        for bucket in buckets:
+            key = (bucket.sha256, bucket.architecture.name)
+            counts[key] = max(counts.get(key, 0), bucket.function_count)
+
+        summaries = {}
+        candidates = self._hash_functions(entry_model,
+                            {key for key, count in counts.items()
+                                if count <= BUCKET_FANOUT})
+
+        large = self._entry_keys({key for key, count in counts.items()
+                                    if count > BUCKET_FANOUT})
+        for (architecture, h), key in large.items():
+            count = counts[key]
+            functions = entry_model.objects.filter(architecture=architecture,
+                                                   hash_key=h) \
+                                           .values('function_id')
+            if count <= STOPLIST_SIZE:
+                candidates[key] = db.get_top_ranked_functions(functions,
+                                                              BUCKET_FANOUT)
+                continue
+
+            metadata = db.get_top_metadata(functions)
+            if metadata:
+                metadata['creator'] = self.name
+                metadata['comment'] = ('[Common function, {} matches] {}'.format(
+                                        count, metadata['comment']))[:512]
+                summaries[key] = metadata
+
+        return (candidates, summaries)
+
+    def _summary_result(self, metadata, similarity):
+        '''Returns the EngineResult summarizing a stop-listed bucket'''
+        return EngineResult(self.id, similarity, data=dict(metadata))
+
+    def _score_candidates(self, candidates, no_apis_similarity=0.0):
+        '''
+        Scores candidate functions by the overlap of their APIs with the
+        scanned function's APIs, up to 10% of the similarity. The APIs and
+        metadata of every candidate are loaded with bulk queries, APIs are
+        compared as sets of FunctionApis IDs.
+
+        @param candidates: List of tuples, one per scanned function
+                (<candidate Function IDs>, <scanned function's APIs>,
+                 <base similarity>)
+        @param no_apis_similarity: Similarity added to candidates without APIs
+        @returns List of FunctionResult lists, one per scanned function with
+                    its TOP_CANDIDATES best candidates. Candidates without
+                    metadata are left out.
+        '''
+        db = self._dbs['first_db']
+
+        function_ids = set()
+        apis = set()
+        for ids, function_apis, base_similarity in candidates:
+            function_ids.update(ids)
+            apis.update(function_apis)
+
+        api_ids = db.get_api_ids(apis)
+        functions_apis = db.get_functions_apis(function_ids)
+
+        results = []
+        for ids, function_apis, base_similarity in candidates:
+            wanted = {api_ids[x] for x in function_apis if x in api_ids}
+
+            scored = []
+            for function_id in set(ids):
+                if function_id not in functions_apis:
+                    continue
+
+                similarity = base_similarity
+                candidate_apis = functions_apis[function_id]
+                if candidate_apis:
+                    overlap = float(len(candidate_apis & wanted))
+                    similarity += (overlap / len(candidate_apis)) * 10
+
+                else:
+                    similarity += no_apis_similarity
+
+                scored.append((similarity, function_id))
+
+            results.append([FunctionResult(str(function_id), similarity)
+                            for similarity, function_id
+                            in heapq.nlargest(TOP_CANDIDATES, scored)])
+
+        return results
+
     def _scan(self, opcodes, architecture, apis, **kwargs):
         '''Returns List of function IDs'''
         raise FIRSTEngineError('Not Implemented')
 
+    def _scan_many(self, functions):
+        '''
+        Returns List of Result lists, one per function [Optional]
+
+        Engines able to look up several functions with a single query should
+        implement this, by default each function is scanned on its own.
+        '''
+        results = []
+        for function in functions:
+            try:
+                results.append(self.scan(**function))
+
+            except Exception as e:
+                print(e)
+                results.append([])
+
+        return results
+
     def _install(self):
         '''Additional functionality required for installing the Engine [Optional]'''
         raise FIRSTEngineError('Not Implemented')
@@ -144,6 +709,10 @@ class AbstractEngine(object):
         '''Additional functionality for uninstalling the Engine [Optional]'''
         raise FIRSTEngineError('Not Implemented')
 
+    def _upgrade(self):
+        '''Converts data stored by an older version of the Engine [Optional]'''
+        raise FIRSTEngineError('Not Implemented')
+
 
 
 class FIRSTEngineManager(object):
@@ -162,13 +731,79 @@ class FIRSTEngineManager(object):
 
         self.__db_manager = db_manager
 
+        #   Engine registry, built once and rebuilt only when the Engine
+        #   table's change token differs from the one it was built from
+        self.__engines = None
+        self.__generation = None
+        self.__last_check = 0.0
+        self.__lock = threading.Lock()
+        self.__check_interval = float(CONFIG.get('engine_check_interval', 10))
+
+        #   Engines run one after another (serial) or concurrently within a
+        #   thread pool (threads), each thread uses its own DB connection.
+        #   Engines still running after engine_timeout seconds are left out
+        #   of the scan's results.
+        self.__executor = None
+        self.__executor_type = CONFIG.get('engine_executor', 'serial')
+        self.__executor_workers = int(CONFIG.get('engine_workers', 8))
+        self.__timeout = float(CONFIG.get('engine_timeout', 10))
+        if self.__executor_type not in ['serial', 'threads']:
+            print('[1stEM] Unknown engine_executor "{}", using serial'.format(
+                    self.__executor_type))
+            self.__executor_type = 'serial'
+
+        #   Scan mode used when a request does not provide one. Fast scans run
+        #   the engines tier by tier and stop scanning a function once it has
+        #   scan_sufficient_hits hits at an engine's sufficient similarity
+        self.__scan_mode = CONFIG.get('scan_mode', 'thorough')
+        self.__sufficient_hits = int(CONFIG.get('scan_sufficient_hits', 1))
+        if self.__scan_mode not in SCAN_MODES:
+            print('[1stEM] Unknown scan_mode "{}", using thorough'.format(
+                    self.__scan_mode))
+            self.__scan_mode = 'thorough'
+
+        #   { <engine_name> : {'calls', 'errors', 'timeouts', 'total', 'max'} }
+        self.__stats = {}
+        self.__stats_lock = threading.Lock()
+
     @property
     def _engines(self):
-        #   Force reload to get any changes
         db = self.__db_manager.first_db
-        active_engines = db.engines()
 
-        #   Dynamically (re)load engines
+        with self.__lock:
+            now = time.time()
+            if ((self.__engines is not None)
+                and ((now - self.__last_check) < self.__check_interval)):
+                return self.__engines
+
+            self.__last_check = now
+            generation = db.engines_token()
+            if (self.__engines is None) or (generation != self.__generation):
+                self.__engines = self._load_engines(db.engines())
+                self.__generation = generation
+
+            return self.__engines
+
+    @property
+    def generation(self):
+        '''
+        @returns String. Change token of the Engine table the loaded engines
+                    were built from
+        '''
+        self._engines
+        return self.__generation
+
+    def reload(self):
+        '''
+        Drops the loaded engines, the next operation will rebuild them from
+        the Engine table
+        '''
+        with self.__lock:
+            self.__engines = None
+            self.__generation = None
+
+    def _load_engines(self, active_engines):
+        #   Dynamically load engines
         engines = []
         for e in active_engines:
             if e.path not in sys.modules:
@@ -217,33 +852,101 @@ class FIRSTEngineManager(object):
                                 (keys: id, apis, opcodes, architecture, sha256)
 
         '''
+        return self.add_many([function])
+
+    def add_many(self, functions, engines=None):
+        '''
+        Sends several functions to each engine at once, letting engines use
+        bulk queries.
+
+        @param functions: List of Dictionaries. Data from the Function model
+                                (keys: id, apis, opcodes, architecture, sha256)
+                            The disassembly and the stored features are
+                            added to each Dictionary
+                            (keys: disassembly, features)
+        @param engines: List of engine names to limit the engines used to,
+                        None for all active engines
+        @returns Dictionary. { <engine_name> : Exception }, None if the data
+                    provided is invalid
+        '''
         required_keys = {'id', 'apis', 'opcodes', 'architecture', 'sha256'}
-        if (dict != type(function)) or not required_keys.issubset(list(function.keys())):
-            print('[1stEM] Data provided is not the correct type or required keys not provided')
-            return None
+        for function in functions:
+            if (dict != type(function)) or not required_keys.issubset(list(function.keys())):
+                print('[1stEM] Data provided is not the correct type or required keys not provided')
+                return None
+
+        for function in functions:
+            dis = Disassembly(function['architecture'], function['opcodes'])
+            if dis:
+                function['disassembly'] = dis
+
+        if engines is not None:
+            engines = [e for e in self._engines if e.name in engines]
+        else:
+            engines = self._engines
 
-        dis = Disassembly(function['architecture'], function['opcodes'])
-        if dis:
-            function['disassembly'] = dis
+        self._add_features(functions, engines)
 
         #   Send function details to each registered engine
         errors = {}
-        for engine in self._engines:
+        for engine in engines:
             try:
-                engine.add(function)
+                engine.add_many(functions)
 
             except Exception as e:
                 errors[engine.name] = e
 
         return errors
 
-    def scan(self, user, opcodes, architecture, apis):
+    def _add_features(self, functions, engines):
+        '''
+        Sets the features of each function when one of the engines requires
+        any. Features not stored yet are computed and stored, so adding the
+        functions again, to the same engines or to ones installed later,
+        does not derive them again.
+        '''
+        db = self.__db_manager.first_db if self.__db_manager else None
+        if (not db) or (not [e for e in engines if e.required_features]):
+            return
+
+        try:
+            features = db.get_function_features([f['id'] for f in functions],
+                                                FEATURES_VERSION)
+        except Exception as e:
+            print('[1stEM] Unable to get function features: {}'.format(e))
+            return
+
+        missing = {}
+        for function in functions:
+            if function['id'] in features:
+                continue
+
+            try:
+                missing[function['id']] = compute_features(function)
+
+            except Exception as e:
+                print('[1stEM] Unable to compute features of function {}: {}'.format(
+                        function['id'], e))
+
+        try:
+            if missing:
+                db.add_function_features(missing, FEATURES_VERSION)
+
+        except Exception as e:
+            print('[1stEM] Unable to store function features: {}'.format(e))
+
+        features.update(missing)
+        for function in functions:
+            function['features'] = features.get(function['id'])
+
+    def scan(self, user, opcodes, architecture, apis, mode=None):
         '''
         Uses opcodes and/or info to find matches in db.
 
         @param      opcodes: String (binary data). All opcodes associated with the function
         @param architecture: String
         @param         apis: List of Strings
+        @param         mode: String. 'fast' or 'thorough', see scan_many
 
         @returns Tuple of (<engine_info:dictionary>, <metadata:list of dictionaries>
 
@@ -263,25 +966,275 @@ class FIRSTEngineManager(object):
                  Empty list if no signature can be made (Engine decided to skip) or nothing found
                  String error message on Failure
         '''
+        results = self.scan_many(user, [{'opcodes' : opcodes,
+                                        'architecture' : architecture,
+                                        'apis' : apis}], mode)
+        if results is None:
+            return None
+
+        return results[0]
+
+    def scan_many(self, user, functions, mode=None):
+        '''
+        Scans all functions in one pass, each engine receives the whole list
+        so it can look up every function with a single query.
+
+        @param functions: List of Dictionaries
+                                (keys: opcodes, architecture, apis)
+        @param mode: String. 'thorough' runs every engine, 'fast' runs the
+                        engines from the cheapest tier up and skips the
+                        remaining tiers for functions that already have
+                        enough sufficient hits. None uses scan_mode
+
+        @returns List of tuples, one per function in the same order.
+                    See scan for the format of each tuple.
+                 None if the FIRST DB is not available
+        '''
         db = self.__db_manager.first_db
         if not db:
             return None
 
-        engine_results = {}
+        mode = mode or self.__scan_mode
+        if mode not in SCAN_MODES:
+            mode = self.__scan_mode
+
         engines = self._engines
+        if not scan_cache:
+            return [x[0] for x in self._scan_many(db, engines, functions, mode)[0]]
 
-        dis = Disassembly(architecture, opcodes)
-        for i in range(len(engines)):
-            engine = engines[i]
+        generation = '{}:{}'.format(self.generation, mode)
+        keys = [scan_cache.key(f, generation) for f in functions]
+        cached = scan_cache.get_many(set(keys))
+
+        missing = [j for j in range(len(functions)) if keys[j] not in cached]
+        if missing:
+            scans, complete = self._scan_many(db, engines,
+                                              [functions[j] for j in missing],
+                                              mode)
+            for j, (result, function_ids) in zip(missing, scans):
+                #   Results missing an engine's hits are not cached
+                if complete:
+                    scan_cache.set(keys[j], result, function_ids, functions[j])
+
+                cached[keys[j]] = result
+
+        return [cached[key] for key in keys]
+
+    def _scan_many(self, db, engines, functions, mode='thorough'):
+        '''
+        Runs the engines over the functions, see scan_many
+
+        @returns Tuple. (List of tuples, one per function in the same order,
+                            (<scan tuple>, <list of IDs of the matched functions>),
+                         Boolean, False if an engine failed or timed out)
+        '''
+        functions = [dict(f, disassembly=Disassembly(f['architecture'],
+                                                        f['opcodes']))
+                        for f in functions]
+
+        if mode == 'fast':
+            engine_results, complete = self._run_tiers(db, engines, functions)
+        else:
+            engine_results, complete = self._run_engines(engines, functions)
+
+        merged = [self._merge_results(engines,
+                                        {i : hits[j] for i, hits
+                                            in engine_results.items()
+                                            if hits[j]})
+                    for j in range(len(functions))]
+
+        #   Get the metadata of every result of the scan at once
+        result_types = {}
+        for results in merged:
+            for result in results:
+                result_types.setdefault(type(result), []).append(result)
+
+        for result_type, results in result_types.items():
+            try:
+                result_type.prefetch_metadata(db, results)
+
+            except Exception as e:
+                print(e)
+
+        scans = []
+        for results in merged:
+            function_ids = []
+            for result in results:
+                if isinstance(result, FunctionResult):
+                    try:
+                        function_ids.append(int(result.id))
+                    except ValueError:
+                        pass
+
+            scans.append((self._metadata_hits(db, results), function_ids))
+
+        return (scans, complete)
+
+    def _run_engines(self, engines, functions):
+        '''
+        Scans the functions with every engine using the configured executor
+
+        @returns Tuple. (Dictionary {<engine index> : [[Result, ...], ...]},
+                         Boolean, False if an engine failed or timed out)
+                    Engines that failed or timed out are left out
+        '''
+        engine_results = {}
+        if self.__executor_type == 'serial':
+            for i in range(len(engines)):
+                try:
+                    engine_results[i] = self._run_engine(engines[i], functions)
+
+                except Exception as e:
+                    print(e)
+
+            return (engine_results, len(engine_results) == len(engines))
+
+        with self.__lock:
+            if self.__executor is None:
+                self.__executor = concurrent.futures.ThreadPoolExecutor(
+                                    self.__executor_workers)
+
+        futures = {self.__executor.submit(self._run_pooled_engine, engines[i],
+                                          functions) : i
+                    for i in range(len(engines))}
+        done, not_done = concurrent.futures.wait(futures, self.__timeout)
+
+        for future in not_done:
+            engine = engines[futures[future]]
+            self._record_stats(engine.name, timeout=True)
+            print('[1stEM] Engine "{}" timed out'.format(engine.name))
+
+        for future in done:
             try:
-                results = engine.scan(opcodes, architecture, apis,
-                                        disassembly=dis)
-                if results:
-                    engine_results[i] = results
+                engine_results[futures[future]] = future.result()
 
             except Exception as e:
                 print(e)
 
+        return (engine_results, len(engine_results) == len(engines))
+
+    def _run_tiers(self, db, engines, functions):
+        '''
+        Scans the functions tier by tier, cheapest first. A function is not
+        scanned by the following tiers once engines returned enough hits at
+        or above their sufficient similarity. Hits on functions without
+        metadata do not count, they are left out of the scan's results.
+
+        @returns Tuple. See _run_engines, functions an engine skipped have
+                    no hits
+        '''
+        tiers = {}
+        for i in range(len(engines)):
+            tiers.setdefault(engines[i].tier, []).append(i)
+
+        engine_results = {}
+        complete = True
+        sufficient = {}
+        pending = list(range(len(functions)))
+        for tier in sorted(tiers):
+            if not pending:
+                break
+
+            indices = tiers[tier]
+            results, tier_complete = self._run_engines([engines[i] for i in indices],
+                                                       [functions[j] for j in pending])
+            complete = complete and tier_complete
+
+            hits_found = {}
+            for k, hits in results.items():
+                engine = engines[indices[k]]
+                engine_results[indices[k]] = [[] for f in functions]
+                for j, function_hits in zip(pending, hits):
+                    engine_results[indices[k]][j] = function_hits
+
+                    if engine.sufficient_similarity is None:
+                        continue
+
+                    hits_found.setdefault(j, []).extend(
+                        [x for x in function_hits if isinstance(x, Result)
+                            and x.similarity >= engine.sufficient_similarity])
+
+            #   Function hits only count when the function has metadata
+            function_ids = set()
+            for function_hits in hits_found.values():
+                for x in function_hits:
+                    if isinstance(x, FunctionResult) and x.id.isdigit():
+                        function_ids.add(int(x.id))
+
+            with_metadata = db.functions_with_metadata(function_ids) \
+                                if function_ids else set()
+            for j, function_hits in hits_found.items():
+                sufficient.setdefault(j, set()).update(
+                    [x.id for x in function_hits
+                        if (not isinstance(x, FunctionResult))
+                            or (x.id.isdigit() and int(x.id) in with_metadata)])
+
+            pending = [j for j in pending
+                        if len(sufficient.get(j, [])) < self.__sufficient_hits]
+
+        return (engine_results, complete)
+
+    def _run_pooled_engine(self, engine, functions):
+        '''
+        _run_engine within a thread of the pool. Each thread uses its own DB
+        connection, handled like Django handles the connection of a request:
+        unusable or expired connections are closed before and after the scan.
+        '''
+        close_old_connections()
+        try:
+            return self._run_engine(engine, functions)
+
+        finally:
+            close_old_connections()
+
+    def _run_engine(self, engine, functions):
+        '''Scans the functions with one engine and records its latency'''
+        start = time.time()
+        try:
+            results = engine.scan_many(functions)
+
+        except Exception:
+            self._record_stats(engine.name, error=True)
+            raise
+
+        self._record_stats(engine.name, time.time() - start)
+        return results
+
+    def _record_stats(self, name, latency=None, error=False, timeout=False):
+        with self.__stats_lock:
+            stats = self.__stats.setdefault(name, {'calls' : 0, 'errors' : 0,
+                                                   'timeouts' : 0, 'total' : 0.0,
+                                                   'max' : 0.0})
+            if latency is not None:
+                stats['calls'] += 1
+                stats['total'] += latency
+                stats['max'] = max(stats['max'], latency)
+
+            stats['errors'] += int(error)
+            stats['timeouts'] += int(timeout)
+
+    def engine_stats(self):
+        '''
+        @returns Dictionary. Scan latency of each engine, in seconds
+                    { <engine_name> : {'calls', 'errors', 'timeouts',
+                                       'average', 'max'} }
+        '''
+        with self.__stats_lock:
+            return {name : {'calls' : x['calls'],
+                            'errors' : x['errors'],
+                            'timeouts' : x['timeouts'],
+                            'average' : (x['total'] / x['calls']) if x['calls'] else 0.0,
+                            'max' : x['max']}
+                    for name, x in self.__stats.items()}
+
+    def _merge_results(self, engines, engine_results):
+        '''
+        Merges the results each engine returned for a single function
+
+        @param engine_results: Dictionary. {<engine index> : [Result, ...]}
+
+        @returns List of Result objects ordered by similarity
+        '''
         results = {}
         for i, hits in engine_results.items():
             engine = engines[i]
@@ -299,8 +1252,14 @@ class FIRSTEngineManager(object):
 
         #   Order functions
         cmp_func = lambda x,y: (y.similarity > x.similarity) - (y.similarity < x.similarity)
-        ordered_functions = sorted(results.values(), key=functools.cmp_to_key(cmp_func))
+        return sorted(results.values(), key=functools.cmp_to_key(cmp_func))
 
+    def _metadata_hits(self, db, ordered_functions):
+        '''
+        Gets the metadata associated with the merged results of a function
+
+        @returns Tuple, see scan
+        '''
         #   Create Metadata list
         #   TODO: Narrow results to top 20 hits, use similarity and metadata rank
         #    to get more likely matches.
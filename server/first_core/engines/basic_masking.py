@@ -29,22 +29,80 @@ from hashlib import sha256
 
 #   FIRST Modules
 from first_core.error import FIRSTError
-from first_core.engines import AbstractEngine
+from first_core.engines import AbstractEngine, entry_functions
+from first_core.models import Sha256Field
 from first_core.engines.results import FunctionResult
+from first_core.disassembly import FLAG_CALL, FLAG_JUMP, jump_mapping, \
+                                    imm_mapping
 
 #   Third Party Modules
+import numpy
 from capstone import *
 from django.db import models
 from django.core.exceptions import ObjectDoesNotExist
 
 MIN_REQUIRED_INSTRUCTIONS = 8
 
+
+def normalize(disassembly):
+    '''
+    Returns (number of masked bytes, sha256 of the masked instructions) for
+    a Disassembly, (0, None) if it cannot be masked. Errors decoding the
+    instructions are raised to the caller.
+    '''
+    if not disassembly:
+        return (0, None)
+
+    #   Masking relies on the call/jump instruction IDs and x86 opcodes
+    if disassembly.architecture not in jump_mapping:
+        return (0, None)
+
+    changed_bytes = 0
+    table = disassembly.table()
+    if MIN_REQUIRED_INSTRUCTIONS > len(table):
+        return (0, None)
+
+    #   Only calls/jumps are masked, operand details are only decoded
+    #   for them
+    branches = numpy.nonzero(table.flags & (FLAG_CALL | FLAG_JUMP))[0]
+    if len(branches):
+        table = disassembly.table(detail=branches.tolist())
+
+    code = disassembly.code
+    normalized = [str(bytearray(code[o:o + n])) for o, n
+                    in zip(table.offsets.tolist(), table.sizes.tolist())]
+
+    #   Special mnemonic masking (Call, Jmp, JCC)
+    imm = imm_mapping[disassembly.architecture]
+    for row in branches.tolist():
+        op_type = int(table.op_types[row])
+        if -1 == op_type:
+            return (0, None)
+
+        instr = ''.join(chr(x) for x in table.opcodes[row].tolist() if x)
+        data = table.instruction_bytes(row)
+        if imm == op_type:
+            changed_bytes += len(data) - len(instr)
+
+        #    TODO: Add capability to mask off stack reg for more
+        #           than Intel
+        else:
+            instr += ''.join(chr(x) for x in data[len(instr):])
+
+        normalized[row] = instr
+
+    h_sha256 = sha256(''.join(normalized).encode('utf-8')).hexdigest()
+    return (changed_bytes, h_sha256)
+
+
 class BasicMasking(models.Model):
-    sha256 = models.CharField(max_length=64)
-    architecture = models.CharField(max_length=64)
+    sha256 = Sha256Field()
+    architecture = models.ForeignKey('www.Architecture', on_delete=models.PROTECT)
 
     total_bytes = models.IntegerField()
-    functions = models.ManyToManyField('BasicMaskingFunction')
+
+    #   Number of functions with the hash, maintained on add
+    function_count = models.IntegerField(default=0)
 
     class Meta:
         app_label = 'engines'
@@ -53,179 +111,94 @@ class BasicMasking(models.Model):
 
     def dump(self):
         return {'sha256' : self.sha256,
-                'architecture' : self.architecture,
+                'architecture' : self.architecture.name,
                 'total_bytes' : self.total_bytes,
-                'functions' : self.functions.all()}
+                'functions' : entry_functions(BasicMaskingEntry, self.sha256,
+                                              self.architecture.name)}
 
-class BasicMaskingFunction(models.Model):
-    func = models.BigIntegerField()
+class BasicMaskingEntry(models.Model):
+    #   Architecture ID and first_core.engines.hash_key of the sha256
+    architecture = models.SmallIntegerField()
+    hash_key = models.BigIntegerField()
+    function_id = models.BigIntegerField()
 
     class Meta:
         app_label = 'engines'
+        unique_together = ('architecture', 'hash_key', 'function_id')
 
 
 class BasicMaskingEngine(AbstractEngine):
     _name = 'BasicMasking'
     _description = ('Masks calls/jmps offsets. Requires at least 8 instructions.')
     _required_db_names = ['first_db']
+    _required_features = ['masked_sha256']
 
     def normalize(self, disassembly):
-        if not disassembly:
-            return (0, None)
-
-        changed_bytes = 0
-
-        try:
-            normalized = []
-            original = []
-            for i in disassembly.instructions():
-                import codecs
-                original.append(codecs.encode(i.bytes, 'hex'))
-                instr = ''.join(chr(x) for x in i.opcode if x)
-
-                #   Special mnemonic masking (Call, Jmp, JCC)
-                if disassembly.is_call(i) or disassembly.is_jump(i):
-                    operand = i.op_str
-
-                    if disassembly.is_op_imm(i.operands[0]):
-                        changed_bytes += len(i.bytes) - len(instr)
-
-                    #    TODO: Add capability to mask off stack reg for more
-                    #           than Intel
-                    #elif (disassembly.is_op_mem(i.operands[0])
-                    #    and disassembly.is_stack_offset(i.operands[0])):
-                    #    instr += i.reg_name(i.operands[0].value.reg)
-                    #    #changed_bits += i.operands[0].dispSize
-                    else:
-                        instr += ''.join(chr(x) for x in i.bytes[len(instr):])
-
-                    normalized.append(instr)
-                    continue
-
-                else:
-                    normalized.append(str(i.bytes))
-
-                '''
-                #   Below code is from Distorm3 version
-                #   TODO: Migrate to and understand how to accomplish in Capstone
-                operand_instrs = []
-                for operand_obj in i.operands:
-                    #   TODO
-                    #operand = operand_obj._toText()
-                    if ((re.match('^\[E(S|B)P', operand) or re.match('^\[R(I|S)P', operand))
-                        and operand_obj.dispSize):
-                        #   Offset from EBP/ESP and RIP/RSP
-                        masked = operand.replace(hex(operand_obj.disp), '0x')
-                        operand_instrs.append(masked)
-                        changed_bits += operand_obj.dispSize
-
-                    elif 'Immediate' == operand_obj.type:
-                        value = operand_obj.value
-                        #   Masking off immediates within the standard VA of the sample
-                        if ((0x400000 <= value <= 0x500000)
-                            or (0x10000000 <= value <= 0x20000000)
-                            or (0x1C0000000 <= value <= 0x1D0000000)
-                            or (0x140000000 <= value <= 0x150000000)):
-                            operand_instrs.append('0x')
-                            changed_bits += operand_obj.size
-
-                        else:
-                            operand_instrs.append(operand)
-
-                    elif 'AbsoluterMemoryAddress' == operand_obj.type:
-                        operand_instrs.append('0x')
-                        changed_bits += operand_obj.dispSize
-
-                    elif 'AbsoluteMemory' == operand_obj.type:
-                        masked = operand.replace(hex(operand_obj.disp), '0x')
-                        operand_instrs.append(masked)
-                        changed_bits += operand_obj.dispSize
-
-                    else:
-                        operand_instrs.append(operand)
-
-                normalized.append(instr + ', '.join(operand_instrs))
-            '''
-
-            if MIN_REQUIRED_INSTRUCTIONS > len(normalized):
-                print(145)
-                return (0, None)
-
-            h_sha256 = sha256(''.join(normalized).encode('utf-8')).hexdigest()
-            return (changed_bytes, h_sha256)
-
-        except Exception as e:
-            print(160, e)
-
-            return (0, None)
+        return normalize(disassembly)
 
     def _add(self, function):
         '''
         Masks specific details from the disassembly to provide a fuzzy hash.
         '''
-        opcodes_size = len(function['opcodes'])
-        architecture = function['architecture']
-        disassembly = function.get('disassembly')
-        changed, h_sha256 = self.normalize(disassembly)
+        self._add_many([function])
+
+    def _add_many(self, functions):
+        '''Adds the masked hashes of several functions with bulk queries'''
+        buckets = {}
+        for function in functions:
+            #   Stored features spare the disassembly
+            h_sha256 = self._function_features(function)['masked_sha256']
+            if not h_sha256:
+                continue
 
-        if not h_sha256:
-            return
+            key = (h_sha256, function['architecture'])
+            defaults = {'total_bytes' : len(function['opcodes'])}
+            buckets.setdefault(key, (defaults, set()))[1].add(function['id'])
 
-        try:
-            db_obj = BasicMasking.objects.get(sha256=h_sha256,
-                                                architecture=architecture)
-        except ObjectDoesNotExist:
-            db_obj = BasicMasking.objects.create(sha256=h_sha256,
-                                                    architecture=architecture,
-                                                    total_bytes=opcodes_size)
-
-        function_id = function['id']
-        count = BasicMasking.objects.filter(sha256=h_sha256,
-                                            architecture=architecture,
-                                            functions__func=function_id).count()
-
-        if not count:
-            func, _ = BasicMaskingFunction.objects.get_or_create(func=function_id)
-            db_obj.functions.add(func)
+        self._bulk_add_functions(BasicMasking, BasicMaskingEntry, buckets,
+                                 count=True)
 
     def _scan(self, opcodes, architecture, apis, disassembly):
         '''Returns List of tuples (function ID, similarity percentage)'''
-        db = self._dbs['first_db']
-        changed, h_sha256 = self.normalize(disassembly)
-
-        if not h_sha256:
-            return
-
-        try:
-            db_obj = BasicMasking.objects.get(sha256=h_sha256,
-                                                architecture=architecture)
-        except ObjectDoesNotExist:
-            return None
-
-
-        results = []
-        for f in db_obj.functions.all():
-            similarity = 75.0
-            function_id = f.func
-            function = db.find_function(_id=function_id)
-
-            if (not function) or (not function.metadata.count()):
-                continue
-
+        return self._scan_many([{'opcodes' : opcodes,
+                                 'architecture' : architecture,
+                                 'apis' : apis,
+                                 'disassembly' : disassembly}])[0]
+
+    def _scan_many(self, functions):
+        '''Returns List of FunctionResults lists, one per function'''
+        normalized = [self.normalize(f.get('disassembly')) for f in functions]
+        keys = {(h, f['architecture'])
+                for (changed, h), f in zip(normalized, functions) if h}
+        if not keys:
+            return [None for f in functions]
+
+        #   Get all buckets matching any of the functions in one query
+        matches = BasicMasking.objects.select_related('architecture').filter(
+                        sha256__in={x[0] for x in keys},
+                        architecture__name__in={x[1] for x in keys})
+        candidates, summaries = self._bucket_candidates(BasicMaskingEntry,
+                                                        list(matches))
+
+        scores = []
+        similarities = []
+        for (changed, h), f in zip(normalized, functions):
             #   Similarity = 90% (opcodes and the masking changes)
             #                + 10% (api overlap)
-            similarity = 100 - ((changed / (len(opcodes) * 8.0)) * 100)
+            similarity = 100 - ((changed / (len(f['opcodes']) * 8.0)) * 100)
             if similarity > 90.0:
                 similarity = 90.0
 
-            #   The APIs will count up to 10% of the similarity score
-            total_apis = function.apis.count()
-            if total_apis:
-                func_apis = {x['api'] for x in function.apis.values('api')}
-                overlap = float(len(func_apis.intersection(apis)))
-                similarity += (overlap / total_apis) * 10
+            scores.append((candidates.get((h, f['architecture']), []),
+                           f['apis'], similarity))
+            similarities.append(similarity)
 
-            results.append(FunctionResult(str(function_id), similarity))
+        results = self._score_candidates(scores)
+        for i, ((changed, h), f) in enumerate(zip(normalized, functions)):
+            if (h, f['architecture']) in summaries:
+                results[i].append(self._summary_result(
+                                    summaries[(h, f['architecture'])],
+                                    similarities[i]))
 
         return results
 
@@ -248,5 +221,20 @@ class BasicMaskingEngine(AbstractEngine):
         execute_from_command_line(['manage.py', 'makemigrations', 'engines'])
         execute_from_command_line(['manage.py', 'migrate', 'engines'])
 
+    def _upgrade(self):
+        '''
+        Converts the tables of older versions of the engine, storing hashes
+        and architectures as text, and counts the functions of every hash,
+        scans rely on the count to bound the number of candidates
+        '''
+        if self._convert_text_tables(BasicMasking, BasicMaskingEntry,
+                                     ('engines_basicmasking_functions',
+                                      'basicmasking_id',
+                                      'basicmaskingfunction_id',
+                                      'engines_basicmaskingfunction')):
+            self._update_migrations()
+
+        self._recount_buckets(BasicMasking, BasicMaskingEntry)
+
     def _uninstall(self):
         print('Manually delete tables associated with {}'.format(self.engine_name))
@@ -22,31 +22,187 @@
 #-------------------------------------------------------------------------------
 
 #   Python Modules
+import sys
 import json
 import base64
+import time
+import struct
+import threading
 from hashlib import sha256
+from datetime import datetime
 from collections import Counter
 
 # Catalog1lib
-from .catalog1lib import slow_sign
+from .catalog1sign import get_signer
+from .catalog1_index import Catalog1Index
 
 #   FIRST Modules
+from first.settings import CONFIG
 from first_core.error import FIRSTError
-from first_core.engines import AbstractEngine
+from first_core.models import Sha256Field
+from first_core.engines import AbstractEngine, entry_functions
 from first_core.engines.results import FunctionResult
 
 #   Third Party Modules
 from django.db import models
+from django.conf import settings
+from django.utils import timezone
 from django.core.exceptions import ObjectDoesNotExist
 
 NUM_PERMS = 64
 MATCH_THRESHOLD = 80
 
+#   Function used to compute catalog1 signatures, see catalog1sign
+sign = get_signer(CONFIG.get('catalog1_signer', 'auto'))
+
+#   Banding (LSH) of the signature used to retrieve near duplicate candidates.
+#   The signature is split into NUM_BANDS bands of ROWS_PER_BAND values, two
+#   functions become candidates when all values of at least one band match.
+#   More bands increase recall, more rows per band increase precision.
+#   The band index has to be rebuilt (populate) when this value changes.
+NUM_BANDS = int(CONFIG.get('catalog1_bands', 16))
+if (NUM_BANDS < 1) or (NUM_PERMS % NUM_BANDS):
+    print('[Catalog1] catalog1_bands must divide {}, using 16'.format(NUM_PERMS))
+    NUM_BANDS = 16
+ROWS_PER_BAND = NUM_PERMS // NUM_BANDS
+
+#   Optional in-memory index of every signature (see catalog1_index). When
+#   "catalog1_index_path" is set the snapshot found there is loaded at the
+#   first scan and rows signed in the DB since then are fetched at most every
+#   "catalog1_index_refresh" seconds. Scans then compare signatures against
+#   the index instead of querying the bands.
+INDEX_PATH = CONFIG.get('catalog1_index_path')
+INDEX_REFRESH = float(CONFIG.get('catalog1_index_refresh', 60))
+
+#   Rows signed up to INDEX_OVERLAP seconds before the previous refresh are
+#   read again, covering transactions committed after the refresh and clock
+#   differences between servers. Rows already indexed are skipped.
+INDEX_OVERLAP = 300
+
+_index = None
+_index_lock = threading.Lock()
+_index_refreshed = 0
+
+
+def band_hashes(catalog1hashes):
+    '''
+    Returns a list of (band, band hash) tuples for a signature. The band
+    hash is a signed 64 bit integer identifying the values within the band.
+    '''
+    bands = []
+    for band in range(NUM_BANDS):
+        values = catalog1hashes[band * ROWS_PER_BAND:(band + 1) * ROWS_PER_BAND]
+        digest = sha256(struct.pack('<{}I'.format(len(values)), *values)).digest()
+        bands.append((band, int.from_bytes(digest[:8], 'big', signed=True)))
+
+    return bands
+
+
+def pack_signature(catalog1hashes):
+    '''Returns the signature packed as NUM_PERMS little endian uint32'''
+    return struct.pack('<{}I'.format(NUM_PERMS), *catalog1hashes)
+
+
+def unpack_signature(data):
+    '''Returns the list of values of a packed signature'''
+    return list(struct.unpack('<{}I'.format(NUM_PERMS), bytes(data)))
+
+
+def catalog1_signature(opcodes):
+    '''Returns the list of signature values, None if opcodes is too short'''
+    if len(opcodes) < 4:
+        return None
+
+    return sign(opcodes, NUM_PERMS)
+
+
+def signature_sha256(catalog1hashes):
+    '''
+    Returns the sha256 of the sorted signature values, the unique
+    identifier of the fuzzy hash
+    '''
+    catalog1_string = ''.join([str(x) for x in sorted(catalog1hashes)])
+    return sha256(catalog1_string.encode('utf-8')).hexdigest()
+
+
+def _timestamp_datetime(timestamp):
+    '''Returns the datetime of a timestamp, comparable with Catalog1.signed'''
+    if settings.USE_TZ:
+        return datetime.fromtimestamp(timestamp, timezone.utc)
+
+    return datetime.fromtimestamp(timestamp)
+
+
+def _index_rows(signed_after=None):
+    '''
+    Yields (architecture, catalog1 id, signature values) tuples for the
+    signatures stored in the DB, only the ones signed after the signed_after
+    timestamp (minus INDEX_OVERLAP) if provided
+    '''
+    rows = Catalog1.objects.filter(signature__isnull=False).order_by('pk')
+    if signed_after is not None:
+        rows = rows.filter(signed__gt=_timestamp_datetime(
+                                        signed_after - INDEX_OVERLAP))
+
+    after_pk = 0
+    while True:
+        batch = list(rows.filter(pk__gt=after_pk)[:5000]
+                        .values_list('pk', 'architecture__name', 'signature'))
+        if not batch:
+            break
+
+        for pk, architecture, signature in batch:
+            yield (architecture, pk, unpack_signature(signature))
+
+        after_pk = batch[-1][0]
+
+
+def build_index():
+    '''Returns a Catalog1Index containing every signature in the DB'''
+    start = time.time()
+    index = Catalog1Index.build(_index_rows(), NUM_PERMS)
+    index.refreshed = start
+    return index
+
+
+def get_index():
+    '''
+    Returns the in-memory index, up to date within INDEX_REFRESH seconds,
+    or None if it is not enabled. Signatures added by this process are
+    indexed right away but do not move the refresh time (index.refreshed),
+    so signatures added by other processes meanwhile are still read.
+    '''
+    global _index, _index_refreshed
+    if not INDEX_PATH:
+        return None
+
+    with _index_lock:
+        if _index is None:
+            _index = Catalog1Index.load(INDEX_PATH)
+            if ((_index is None) or (_index.num_perms != NUM_PERMS)
+                or (_index.refreshed is None)):
+                print('[Catalog1] Building index from the DB')
+                _index = Catalog1Index(NUM_PERMS)
+
+        if (time.time() - _index_refreshed) > INDEX_REFRESH:
+            start = time.time()
+            _index.update(_index_rows(_index.refreshed))
+            _index.refreshed = start
+            _index_refreshed = time.time()
+
+    return _index
+
+
 class Catalog1(models.Model):
-    sha256 = models.CharField(max_length=64)
-    architecture = models.CharField(max_length=64)
-    functions = models.ManyToManyField('Catalog1Functions')
-    catalog1hashes = models.ManyToManyField('Catalog1Hash')
+    sha256 = Sha256Field()
+    architecture = models.ForeignKey('www.Architecture', on_delete=models.PROTECT)
+
+    #   NUM_PERMS signature values packed as little endian uint32
+    signature = models.BinaryField(max_length=NUM_PERMS * 4, null=True)
+
+    #   Time the signature was stored, rows signed after they were created
+    #   (see upgrade) are only found by the in-memory index through it
+    signed = models.DateTimeField(null=True, db_index=True)
 
     class Meta:
         app_label = 'engines'
@@ -55,113 +211,237 @@ class Catalog1(models.Model):
 
     def dump(self):
         return {'sha256': self.sha256,
-                'architecture': self.architecture,
-                'functions': self.functions.all(),
-                'catalog1hashes': self.catalog1hashes.all()}
+                'architecture': self.architecture.name,
+                'functions': entry_functions(Catalog1Entry, self.sha256,
+                                             self.architecture.name),
+                'signature': unpack_signature(self.signature)
+                                if self.signature else None}
 
 
-class Catalog1Hash(models.Model):
-    catalog_hash = models.CharField(max_length=32)
+class Catalog1Entry(models.Model):
+    #   Architecture ID and first_core.engines.hash_key of the sha256
+    architecture = models.SmallIntegerField()
+    hash_key = models.BigIntegerField()
+    function_id = models.BigIntegerField()
 
     class Meta:
         app_label = 'engines'
+        unique_together = ('architecture', 'hash_key', 'function_id')
 
 
-class Catalog1Functions(models.Model):
-    func = models.BigIntegerField()
+class Catalog1Band(models.Model):
+    catalog1 = models.ForeignKey('Catalog1', on_delete=models.CASCADE)
+
+    #   Architecture ID, like the entry tables
+    architecture = models.SmallIntegerField()
+    band = models.SmallIntegerField()
+    band_hash = models.BigIntegerField()
 
     class Meta:
         app_label = 'engines'
+        index_together = ('band_hash', 'band', 'architecture')
+        unique_together = ('catalog1', 'band')
 
 
 class Catalog1Engine(AbstractEngine):
     _name = 'Catalog1'
     _description = 'catalog1 sensitive hashing algorithm by xorpd'
     _required_db_names = ['first_db']
+    _tier = 2
+    _required_features = ['catalog1']
 
     def _add(self, function):
         '''
         Get the list of hashes from fcatalog
         '''
-        architecture = function['architecture']
-        opcodes = function["opcodes"]
-        function_id = function['id']
-
-        if len(opcodes) < 4:
-            # Minum opcodes lenght: 4
-            print("Catalog1 log: opcodes len < minimum (4)")
-            return
-
-        catalog1hashes = slow_sign(opcodes, NUM_PERMS)
-        # join the sorted list of hashes, and calculate the sha256
-        # This creates an unique identifier of the fuzzy hash
-        catalog1_string = ''.join([str(x) for x in sorted(catalog1hashes)])
-        catalog1_sha256 = sha256(catalog1_string.encode('utf-8')).hexdigest()
-
-        count = Catalog1.objects.filter(sha256=catalog1_sha256,
-                                        architecture=architecture,
-                                        functions__func=function_id).count()
-        if not count:
-            # Create a new database object
-
-            db_obj, _ = Catalog1.objects.get_or_create(sha256=catalog1_sha256,
-                                                       architecture=architecture)
-            # Add the function to the db_obj
-            func, _ = Catalog1Functions.objects.get_or_create(func=function_id)
-            db_obj.functions.add(func)
-
-            # Add catalog hashes to the db_obj
-            for ch in catalog1hashes:
-                c_hash_obj, _ = Catalog1Hash.objects.get_or_create(
-                    catalog_hash=ch)
-                db_obj.catalog1hashes.add(c_hash_obj)
+        self._add_many([function])
+
+    def _add_many(self, functions):
+        '''Adds the signatures of several functions with bulk queries'''
+        buckets = {}
+        signatures = {}
+        now = timezone.now()
+        for function in functions:
+            #   Stored features spare the signing
+            data = self._function_features(function)['catalog1']
+            if data is None:
+                # Minum opcodes lenght: 4
+                print("Catalog1 log: opcodes len < minimum (4)")
+                continue
+
+            catalog1hashes = unpack_signature(data)
+
+            key = (signature_sha256(catalog1hashes), function['architecture'])
+            defaults = {'signature' : pack_signature(catalog1hashes),
+                        'signed' : now}
+            buckets.setdefault(key, (defaults, set()))[1].add(function['id'])
+            signatures[key] = catalog1hashes
+
+        objs, created = self._bulk_add_functions(Catalog1, Catalog1Entry, buckets)
+
+        # Stored by an older version of the engine
+        legacy = [obj for obj in objs.values() if obj.signature is None]
+        for obj in legacy:
+            key = (obj.sha256, obj.architecture.name)
+            obj.signature = buckets[key][0]['signature']
+            obj.signed = now
+            created.add(key)
+
+        if legacy:
+            Catalog1.objects.bulk_update(legacy, ['signature', 'signed'])
+
+        if _index is not None:
+            for key in created:
+                _index.add(key[1], objs[key].pk, signatures[key])
+
+        self._add_bands([(obj, signatures[key]) for key, obj in objs.items()])
+
+    def _add_bands(self, rows):
+        '''
+        Index the bands of a list of (Catalog1 obj, signature values) tuples.
+        Existing bands are left untouched so this also fills in the bands of
+        functions added before the index.
+        '''
+        Catalog1Band.objects.bulk_create(
+            [Catalog1Band(catalog1=db_obj, architecture=db_obj.architecture_id,
+                          band=band, band_hash=band_hash)
+                for db_obj, catalog1hashes in rows
+                for band, band_hash in band_hashes(catalog1hashes)],
+            ignore_conflicts=True)
 
     def _scan(self, opcodes, architecture, apis, disassembly):
         '''
         Returns List of FunctionResults
         '''
+        return self._scan_many([{'opcodes' : opcodes,
+                                 'architecture' : architecture,
+                                 'apis' : apis,
+                                 'disassembly' : disassembly}])[0]
+
+    def _scan_many(self, functions):
+        '''
+        Returns List of FunctionResults lists, one per function
+        '''
         db = self._dbs['first_db']
-        catalog1hashes = slow_sign(opcodes, NUM_PERMS)
-        catalog1_string = ''.join([str(x) for x in sorted(catalog1hashes)])
-        catalog1_sha256 = sha256(catalog1_string.encode('utf-8')).hexdigest()
-        result = list()
+        results = [list() for f in functions]
+
+        signatures = []
+        for f in functions:
+            if len(f['opcodes']) < 4:
+                signatures.append((None, None))
+                continue
+
+            catalog1hashes = sign(f['opcodes'], NUM_PERMS)
+            signatures.append((catalog1hashes, signature_sha256(catalog1hashes)))
 
         # Step 0: Let's try to see if the same catalog1_sha256 exists:
-        try:
-            db_obj = Catalog1.objects.get(sha256=catalog1_sha256, architecture=architecture)
-            if db_obj:
-                for f in db_obj.functions.all():
+        exact = self._hash_functions(Catalog1Entry,
+                    {(x[1], f['architecture'])
+                        for x, f in zip(signatures, functions) if x[1]})
+        existing = db.existing_functions([x for ids in exact.values() for x in ids])
+
+        pending = []
+        for i, f in enumerate(functions):
+            catalog1hashes, catalog1_sha256 = signatures[i]
+            if not catalog1hashes:
+                continue
+
+            key = (catalog1_sha256, f['architecture'])
+            if key in exact:
+                for function_id in exact[key]:
                     similarity = 100.0
-                    function_id = f.func
-                    function = db.find_function(_id=function_id)
-                    if function:
-                        result.append(FunctionResult(
+                    if function_id in existing:
+                        results[i].append(FunctionResult(
                             str(function_id), similarity))
-                return result
+                continue
 
-        except ObjectDoesNotExist:
             # No luck
             # Let's search
-            pass
+            pending.append(i)
+
+        if not pending:
+            return results
+
+        index = get_index()
+        if index is not None:
+            # Step 1: Let's compare the signature against the whole index
+            min_matches = int(MATCH_THRESHOLD * NUM_PERMS / 100) + 1
+            candidates = {i : dict(index.query(functions[i]['architecture'],
+                                               signatures[i][0], k=10,
+                                               min_matches=min_matches))
+                            for i in pending}
+
+        else:
+            candidates = self._band_candidates(functions, signatures, pending)
+
+        all_candidates = {x for ids in candidates.values() for x in ids}
+
+        if not all_candidates:
+            return results
 
-        # Step 1: Let's search all the matching catalog1 hashes
-        matching_catalog_functions = Catalog1.objects.filter(architecture=architecture, catalog1hashes__catalog_hash__in=catalog1hashes).values_list('functions', flat=True)
-        matching_function_columns = Catalog1Functions.objects.filter(id__in=matching_catalog_functions)
+        keys = {pk : (sha256, architecture) for pk, sha256, architecture in
+                    Catalog1.objects.filter(pk__in=all_candidates)
+                        .values_list('pk', 'sha256', 'architecture__name')}
+        functions_by_key = self._hash_functions(Catalog1Entry, set(keys.values()))
+        candidate_functions = {pk : functions_by_key.get(key, [])
+                                for pk, key in keys.items()}
 
-        matching_function_ids = {}
-        for func_column in matching_function_columns:
-            matching_function_ids[func_column.id] = func_column.func
+        for i in pending:
+            cc = Counter()
+            for catalog1_id, counter in candidates[i].items():
+                for function_id in candidate_functions.get(catalog1_id, []):
+                    cc[function_id] = max(cc[function_id], counter)
 
-        cc = Counter(matching_catalog_functions)
-        for func_m_id, counter in cc.most_common(10):
-            if counter > 0:
-                function_id = matching_function_ids[func_m_id]
-                similarity = counter * 100 / NUM_PERMS
+            for function_id, counter in cc.most_common(10):
+                if counter > 0:
+                    similarity = counter * 100 / NUM_PERMS
 
-                if similarity > MATCH_THRESHOLD:
-                    result.append(FunctionResult(str(function_id), similarity))
+                    if similarity > MATCH_THRESHOLD:
+                        results[i].append(FunctionResult(str(function_id), similarity))
 
-        return result
+        return results
+
+    def _band_candidates(self, functions, signatures, pending):
+        '''
+        Returns {function index : {catalog1 id : matching values}} for the
+        signatures sharing at least one band with the scanned functions
+        '''
+        bands = {i : band_hashes(signatures[i][0]) for i in pending}
+        architectures = self._dbs['first_db'].get_architecture_ids(
+                            {functions[i]['architecture'] for i in pending})
+        matching_bands = Catalog1Band.objects.filter(
+                            architecture__in=set(architectures.values()),
+                            band_hash__in={h for i in pending for band, h in bands[i]})
+        matching_bands = list(matching_bands.values_list('architecture', 'band',
+                                                        'band_hash', 'catalog1'))
+
+        band_candidates = {}
+        for i in pending:
+            architecture = architectures.get(functions[i]['architecture'])
+            keys = {(architecture, band, h) for band, h in bands[i]}
+            band_candidates[i] = {catalog1_id for arch, band, h, catalog1_id in matching_bands
+                                    if (arch, band, h) in keys}
+
+        # Compare the candidates' signatures
+        candidate_signatures = Catalog1.objects.filter(
+                                pk__in={x for ids in band_candidates.values() for x in ids},
+                                signature__isnull=False)
+        candidate_signatures = {pk : unpack_signature(signature) for pk, signature
+                                in candidate_signatures.values_list('pk', 'signature')}
+
+        candidates = {}
+        for i in pending:
+            catalog1hashes = signatures[i][0]
+            candidates[i] = {}
+            for catalog1_id in band_candidates[i]:
+                if catalog1_id not in candidate_signatures:
+                    continue
+
+                # Number of permutations with the same minimum value
+                candidates[i][catalog1_id] = sum([x == y for x, y in
+                    zip(catalog1hashes, candidate_signatures[catalog1_id])])
+
+        return candidates
 
     def _install(self):
         try:
@@ -182,5 +462,65 @@ class Catalog1Engine(AbstractEngine):
         execute_from_command_line(['manage.py', 'makemigrations', 'engines'])
         execute_from_command_line(['manage.py', 'migrate', 'engines'])
 
+    def _upgrade(self):
+        '''
+        Converts the tables of older versions of the engine, storing hashes
+        and architectures as text, and signs rows without a signature. Older
+        versions did not keep the order of the signature's values, so
+        signatures are recomputed from the opcodes of a function associated
+        with them.
+        '''
+        db = self._dbs['first_db']
+        if self._convert_text_tables(Catalog1, Catalog1Entry,
+                                     ('engines_catalog1_functions',
+                                      'catalog1_id',
+                                      'catalog1functions_id',
+                                      'engines_catalog1functions'),
+                                     [Catalog1Band],
+                                     ['engines_catalog1_catalog1hashes',
+                                      'engines_catalog1hash']):
+            self._update_migrations()
+
+        legacy = Catalog1.objects.select_related('architecture') \
+                                 .filter(signature__isnull=True).order_by('pk')
+        total = legacy.count()
+        msg = ' [Status] {0:.2f}% Completed ({1} out of {2})\r'
+
+        last_pk = 0
+        completed = 0
+        while True:
+            rows = list(legacy.filter(pk__gt=last_pk)[:500])
+            if not rows:
+                break
+
+            last_pk = rows[-1].pk
+            funcs = self._hash_functions(Catalog1Entry,
+                        {(row.sha256, row.architecture.name) for row in rows})
+            function_ids = {row.pk : funcs[(row.sha256, row.architecture.name)][0]
+                            for row in rows
+                            if (row.sha256, row.architecture.name) in funcs}
+
+            opcodes = db.get_opcodes(function_ids.values())
+            converted = []
+            for row in rows:
+                data = opcodes.get(function_ids.get(row.pk))
+                if (not data) or (len(data) < 4):
+                    continue
+
+                catalog1hashes = sign(data, NUM_PERMS)
+                row.signature = pack_signature(catalog1hashes)
+                row.signed = timezone.now()
+                converted.append((row, catalog1hashes))
+
+            self._add_bands(converted)
+            converted = [row for row, catalog1hashes in converted]
+            Catalog1.objects.bulk_update(converted, ['signature', 'signed'])
+
+            completed += len(rows)
+            sys.stdout.write(msg.format((completed / total) * 100, completed, total))
+            sys.stdout.flush()
+
+        sys.stdout.write('\n')
+
     def _uninstall(self):
         print('Manually delete tables associated with {}'.format(self.engine_name))
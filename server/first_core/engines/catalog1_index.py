@@ -0,0 +1,219 @@
+#-------------------------------------------------------------------------------
+#
+#   FIRST Engine: Catalog1 in-memory similarity index
+#
+#   Keeps every Catalog1 signature of an architecture in a (N, NUM_PERMS)
+#   uint32 matrix so a query signature can be compared against all of them
+#   with vectorized equality counts, without touching the DB.
+#
+#   Snapshots are saved as a directory containing index.json and one pair of
+#   .npy files (signatures and Catalog1 IDs) per architecture. Snapshots are
+#   loaded memory-mapped, rows added afterwards are kept in memory. Array
+#   blocks are sorted by ID so updates can skip rows already indexed.
+#
+#   Requirements
+#   ------------
+#   -   numpy
+#
+#-------------------------------------------------------------------------------
+
+#   Python Modules
+import os
+import json
+import itertools
+import threading
+
+#   Third Party Modules
+import numpy
+
+#   Rows compared at once, bounds the size of the temporary equality matrix
+QUERY_CHUNK = 1 << 20
+
+#   Added rows kept in lists before being frozen into an array block
+PENDING_LIMIT = 4096
+
+
+class Catalog1Index(object):
+    def __init__(self, num_perms):
+        self.num_perms = num_perms
+        self._lock = threading.Lock()
+
+        #   {architecture : [(signatures, ids), ...]}
+        self._blocks = {}
+
+        #   {architecture : ([signature, ...], [id, ...])}, rows added
+        #   since the arrays were built
+        self._pending = {}
+        self.max_id = 0
+
+        #   Time (seconds since the epoch) up to which the rows stored in
+        #   the DB were read, None if they never were
+        self.refreshed = None
+
+    def __len__(self):
+        total = sum([len(ids) for blocks in self._blocks.values()
+                                for sigs, ids in blocks])
+        return total + sum([len(ids) for sigs, ids in self._pending.values()])
+
+    @classmethod
+    def build(cls, rows, num_perms):
+        '''
+        Creates an index from an iterable of
+        (architecture, catalog1_id, signature values) tuples
+        '''
+        index = cls(num_perms)
+        for architecture, catalog1_id, signature in rows:
+            index.add(architecture, catalog1_id, signature)
+
+        index._merge()
+        return index
+
+    @classmethod
+    def load(cls, path):
+        '''Loads a snapshot saved with save, returns None if not possible'''
+        try:
+            with open(os.path.join(path, 'index.json'), 'r') as f:
+                info = json.load(f)
+
+            index = cls(info['num_perms'])
+            index.refreshed = info.get('refreshed')
+            for architecture, name in info['architectures'].items():
+                signatures = numpy.load(os.path.join(path, name + '.signatures.npy'),
+                                        mmap_mode='r')
+                ids = numpy.load(os.path.join(path, name + '.ids.npy'),
+                                 mmap_mode='r')
+                index._blocks[architecture] = [(signatures, ids)]
+                if len(ids):
+                    index.max_id = max(index.max_id, int(ids.max()))
+
+            return index
+
+        except (IOError, ValueError, KeyError) as e:
+            print('[Catalog1] Unable to load index snapshot: {}'.format(e))
+            return None
+
+    def save(self, path):
+        '''Saves a snapshot of the index to the provided directory'''
+        self._merge()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        info = {'num_perms' : self.num_perms, 'refreshed' : self.refreshed,
+                'architectures' : {}}
+        for i, (architecture, blocks) in enumerate(self._blocks.items()):
+            signatures, ids = blocks[0]
+            name = str(i)
+            numpy.save(os.path.join(path, name + '.signatures.npy'), signatures)
+            numpy.save(os.path.join(path, name + '.ids.npy'), ids)
+            info['architectures'][architecture] = name
+
+        with open(os.path.join(path, 'index.json'), 'w') as f:
+            json.dump(info, f)
+
+    def add(self, architecture, catalog1_id, signature):
+        '''Adds a signature (list of values) to the index'''
+        with self._lock:
+            self._add(architecture, catalog1_id, signature)
+
+    def update(self, rows):
+        '''
+        Adds the (architecture, catalog1_id, signature values) tuples of an
+        iterable, skipping the ones whose ID is already in the index
+        '''
+        rows = iter(rows)
+        while True:
+            batch = list(itertools.islice(rows, PENDING_LIMIT))
+            if not batch:
+                break
+
+            by_architecture = {}
+            for row in batch:
+                by_architecture.setdefault(row[0], []).append(row)
+
+            with self._lock:
+                for architecture, arch_rows in by_architecture.items():
+                    known = self._known(architecture, [x[1] for x in arch_rows])
+                    for row in arch_rows:
+                        if row[1] not in known:
+                            known.add(row[1])
+                            self._add(*row)
+
+    def _add(self, architecture, catalog1_id, signature):
+        signatures, ids = self._pending.setdefault(architecture, ([], []))
+        signatures.append(signature)
+        ids.append(catalog1_id)
+        self.max_id = max(self.max_id, catalog1_id)
+
+        if len(ids) >= PENDING_LIMIT:
+            self._freeze(architecture)
+
+    def _known(self, architecture, catalog1_ids):
+        '''Returns the set of the provided IDs already in the index'''
+        query = numpy.array(catalog1_ids, dtype=numpy.int64)
+        known = set(self._pending.get(architecture, ([], []))[1])
+        known.intersection_update(query.tolist())
+        for signatures, ids in self._blocks.get(architecture, []):
+            if len(ids):
+                found = numpy.minimum(numpy.searchsorted(ids, query), len(ids) - 1)
+                known.update(query[ids[found] == query].tolist())
+
+        return known
+
+    def _freeze(self, architecture):
+        '''Moves the pending rows of an architecture into an array block'''
+        signatures, ids = self._pending.pop(architecture)
+        ids = numpy.array(ids, dtype=numpy.int64)
+        order = numpy.argsort(ids, kind='stable')
+        block = (numpy.array(signatures, dtype=numpy.uint32)
+                    .reshape((-1, self.num_perms))[order],
+                 ids[order])
+        self._blocks.setdefault(architecture, []).append(block)
+
+    def _merge(self):
+        '''Merges all rows of each architecture into a single array block'''
+        with self._lock:
+            for architecture in list(self._pending.keys()):
+                self._freeze(architecture)
+
+            for architecture, blocks in self._blocks.items():
+                if len(blocks) > 1:
+                    ids = numpy.concatenate([x[1] for x in blocks])
+                    order = numpy.argsort(ids, kind='stable')
+                    self._blocks[architecture] = [
+                        (numpy.concatenate([x[0] for x in blocks])[order],
+                         ids[order])]
+
+    def query(self, architecture, signature, k=10, min_matches=1):
+        '''
+        Returns the k most similar signatures as a list of
+        (catalog1_id, matching values) tuples, best first. Only signatures
+        with at least min_matches equal values are returned.
+        '''
+        query = numpy.array(signature, dtype=numpy.uint32)
+
+        with self._lock:
+            blocks = list(self._blocks.get(architecture, []))
+            if architecture in self._pending:
+                signatures, ids = self._pending[architecture]
+                blocks.append((numpy.array(signatures, dtype=numpy.uint32),
+                               numpy.array(ids, dtype=numpy.int64)))
+
+        best_ids = []
+        best_counts = []
+        for signatures, ids in blocks:
+            for i in range(0, len(ids), QUERY_CHUNK):
+                counts = (signatures[i:i + QUERY_CHUNK] == query).sum(axis=1)
+                top = numpy.nonzero(counts >= min_matches)[0]
+                if len(top) > k:
+                    top = top[numpy.argpartition(-counts[top], k - 1)[:k]]
+
+                best_ids.append(ids[i:i + QUERY_CHUNK][top])
+                best_counts.append(counts[top])
+
+        if not best_ids:
+            return []
+
+        best_ids = numpy.concatenate(best_ids)
+        best_counts = numpy.concatenate(best_counts)
+        order = numpy.argsort(-best_counts, kind='stable')[:k]
+        return [(int(best_ids[i]), int(best_counts[i])) for i in order]
@@ -0,0 +1,104 @@
+/*-----------------------------------------------------------------------------
+ *
+ *   FIRST Engine: Catalog1 signer
+ *
+ *   C implementation of catalog1lib.slow_sign, loaded by catalog1sign.py
+ *   through ctypes. The output must stay bit identical to slow_sign.
+ *
+ *   Building
+ *   --------
+ *   $ gcc -O3 -shared -fPIC -o libcatalog1sign.so catalog1sign.c
+ *
+ *---------------------------------------------------------------------------*/
+#include <stddef.h>
+#include <stdint.h>
+
+#define WORD_SIZE 32
+#define NUM_ITERS 4
+
+static const uint32_t RAND_DWORDS[] = {
+    1445200656u, 3877429363u, 1060188777u, 4260769784u, 1438562000u,
+    2836098482u, 1986405151u, 4230168452u, 380326093u, 2859127666u,
+    1134102609u, 788546250u, 3705417527u, 1779868252u, 1958737986u,
+    4046915967u, 1614805928u, 4160312724u, 3682325739u, 534901034u,
+    2287240917u, 2677201636u, 71025852u, 1171752314u, 47956297u,
+    2265969327u, 2865804126u, 1364027301u, 2267528752u, 1998395705u,
+    576397983u, 636085149u, 3876141063u, 1131266725u, 3949079092u,
+    1674557074u, 2566739348u, 3782985982u, 2164386649u, 550438955u,
+    2491039847u, 2409394861u, 3757073140u, 3509849961u, 3972853470u,
+    1377009785u, 2164834118u, 820549672u, 2867309379u, 1454756115u,
+    94270429u, 2974978638u, 2915205038u, 1887247447u, 3641720023u,
+    4292314015u, 702694146u, 1808155309u, 95993403u, 1529688311u,
+    2883286160u, 1410658736u, 3225014055u, 1903093988u, 2049895643u,
+    476880516u, 3241604078u, 3709326844u, 2531992854u, 265580822u,
+    2920230147u, 4294230868u, 408106067u, 3683123785u, 1782150222u,
+    3876124798u, 3400886112u, 1837386661u, 664033147u, 3948403539u,
+    3572529266u, 4084780068u, 691101764u, 1191456665u, 3559651142u,
+    709364116u, 3999544719u, 189208547u, 3851247656u, 69124994u,
+    1685591380u, 1312437435u, 2316872331u, 1466758250u, 1979107610u,
+    2611873442u, 80372344u, 1251839752u, 2716578101u, 176193185u,
+    2142192370u, 1179562050u, 1290470544u, 1957198791u, 1435943450u,
+    2989992875u, 3703466909u, 1302678442u, 3343948619u, 3762772165u,
+    1438266632u, 1761719790u, 3668101852u, 1283600006u, 671544087u,
+    1665876818u, 3645433092u, 3760380605u, 3802664867u, 1635015896u,
+    1060356828u, 1666255066u, 2953295653u, 2827859377u, 386702151u,
+    3372348076u, 4248620909u, 2259505262u
+};
+
+#define NUM_RAND (sizeof(RAND_DWORDS) / sizeof(RAND_DWORDS[0]))
+
+static inline uint32_t ror(uint32_t x, uint32_t i)
+{
+    /*  Rotate right x by i locations, i is in [0, WORD_SIZE) */
+    if (0 == i)
+        return x;
+
+    return (x >> i) | (x << (WORD_SIZE - i));
+}
+
+static uint32_t perm(uint64_t num, uint32_t x)
+{
+    uint64_t i;
+    uint32_t ror_index;
+
+    for (i = 0; i < NUM_ITERS; i++) {
+        x += RAND_DWORDS[(i + num + x) % NUM_RAND];
+        ror_index = (x ^ RAND_DWORDS[(i + num + 1) % NUM_RAND]) % WORD_SIZE;
+        x = ror(x, ror_index);
+        x ^= RAND_DWORDS[(i + num + x) % NUM_RAND];
+        ror_index = (x ^ RAND_DWORDS[(i + num + 1) % NUM_RAND]) % WORD_SIZE;
+        x = ror(x, ror_index);
+    }
+
+    return x;
+}
+
+/*
+ *  Sign over data using num_perms permutations, result must have room for
+ *  num_perms values. Returns 0 on success, -1 if data is smaller than 4 bytes.
+ */
+int catalog1_sign(const uint8_t *data, size_t len, uint32_t *result,
+                  uint32_t num_perms)
+{
+    size_t i;
+    uint32_t p, x, window;
+
+    if (len < (WORD_SIZE / 8))
+        return -1;
+
+    for (p = 0; p < num_perms; p++)
+        result[p] = UINT32_MAX;
+
+    for (i = 0; i + 4 <= len; i++) {
+        window = ((uint32_t)data[i] << 24) | ((uint32_t)data[i + 1] << 16)
+                 | ((uint32_t)data[i + 2] << 8) | (uint32_t)data[i + 3];
+
+        for (p = 0; p < num_perms; p++) {
+            x = perm(p, window);
+            if (x < result[p])
+                result[p] = x;
+        }
+    }
+
+    return 0;
+}
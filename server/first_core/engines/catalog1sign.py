@@ -0,0 +1,173 @@
+#-------------------------------------------------------------------------------
+#
+#   FIRST Engine: Catalog1 signers
+#
+#   Faster implementations of catalog1lib.slow_sign producing the exact same
+#   signatures:
+#
+#   -   numpy:  Computes every permutation over every 4 byte window at once
+#               with uint64 arrays (values are kept within 32 bits)
+#   -   c:      Uses the shared library built from catalog1sign.c through
+#               ctypes
+#   -   python: catalog1lib.slow_sign
+#
+#   The signer used by the Catalog1 engine is selected with the
+#   "catalog1_signer" configuration value (auto, c, numpy, python). When set
+#   to auto (default) the C library is used if it has been built, otherwise
+#   the numpy signer is used.
+#
+#   Building the C library
+#   ----------------------
+#   $ cd server/first_core/engines
+#   $ gcc -O3 -shared -fPIC -o libcatalog1sign.so catalog1sign.c
+#
+#   The path to the library can be changed with the "catalog1_library"
+#   configuration value.
+#
+#   Requirements
+#   ------------
+#   -   numpy
+#
+#-------------------------------------------------------------------------------
+
+#   Python Modules
+import os
+import ctypes
+
+#   FIRST Modules
+from first.settings import CONFIG
+from first_core.engines.catalog1lib import slow_sign, RAND_DWORDS, \
+                                            WORD_SIZE, BYTE_SIZE, NUM_ITERS
+
+#   Third Party Modules
+import numpy
+
+MAX_WORD = numpy.uint64((1 << WORD_SIZE) - 1)
+
+#   Number of 4 byte windows permuted at once, bounds the memory used to
+#   num_perms * WINDOW_CHUNK * 8 bytes per temporary array
+WINDOW_CHUNK = 4096
+
+_rand_dwords = numpy.array(RAND_DWORDS, dtype=numpy.uint64)
+_num_rand = numpy.uint64(len(RAND_DWORDS))
+_word_size = numpy.uint64(WORD_SIZE)
+
+
+def _ror(x, i):
+    '''Rotate right each value in x by the matching value in i'''
+    return ((x >> i) | (x << (_word_size - i))) & MAX_WORD
+
+
+def _perm(perms, x):
+    '''
+    Vectorized catalog1lib.perm, perms is a (num_perms, 1) array and x a
+    (num_perms, windows) array.
+    '''
+    for i in range(NUM_ITERS):
+        i = numpy.uint64(i)
+        ror_rand = _rand_dwords[(i + perms + numpy.uint64(1)) % _num_rand]
+
+        x = (x + _rand_dwords[(i + perms + x) % _num_rand]) & MAX_WORD
+        x = _ror(x, (x ^ ror_rand) % _word_size)
+        x ^= _rand_dwords[(i + perms + x) % _num_rand]
+        x = _ror(x, (x ^ ror_rand) % _word_size)
+
+    return x
+
+
+def numpy_sign(data, num_perms):
+    '''
+    Sign over data, see catalog1lib.slow_sign.
+    '''
+    nbytes = WORD_SIZE // BYTE_SIZE
+    if len(data) < nbytes:
+        raise Exception('data must be at least of size {} bytes.'
+                        .format(nbytes))
+
+    data = numpy.frombuffer(bytes(data), dtype=numpy.uint8).astype(numpy.uint64)
+
+    #   Big endian dword starting at every offset, only unique dwords matter
+    #   since the minimum is kept for each permutation
+    windows = ((data[:-3] << numpy.uint64(24)) | (data[1:-2] << numpy.uint64(16))
+                | (data[2:-1] << numpy.uint64(8)) | data[3:])
+    windows = numpy.unique(windows)
+
+    perms = numpy.arange(num_perms, dtype=numpy.uint64).reshape((num_perms, 1))
+    res_sign = numpy.full(num_perms, MAX_WORD, dtype=numpy.uint64)
+    for i in range(0, len(windows), WINDOW_CHUNK):
+        chunk = windows[i:i + WINDOW_CHUNK]
+        x = numpy.tile(chunk, (num_perms, 1))
+        res_sign = numpy.minimum(res_sign, _perm(perms, x).min(axis=1))
+
+    return [int(x) for x in res_sign]
+
+
+_library = None
+
+def _load_library():
+    '''Returns the ctypes library built from catalog1sign.c or None'''
+    global _library
+    if _library is None:
+        path = CONFIG.get('catalog1_library',
+                          os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                       'libcatalog1sign.so'))
+        try:
+            library = ctypes.CDLL(path)
+            library.catalog1_sign.restype = ctypes.c_int
+            library.catalog1_sign.argtypes = [ctypes.c_char_p, ctypes.c_size_t,
+                                              ctypes.POINTER(ctypes.c_uint32),
+                                              ctypes.c_uint32]
+            _library = library
+
+        except (OSError, AttributeError):
+            _library = False
+
+    return _library or None
+
+
+def c_sign(data, num_perms):
+    '''
+    Sign over data, see catalog1lib.slow_sign.
+    '''
+    library = _load_library()
+    if not library:
+        raise Exception('Catalog1 C library is not available')
+
+    nbytes = WORD_SIZE // BYTE_SIZE
+    if len(data) < nbytes:
+        raise Exception('data must be at least of size {} bytes.'
+                        .format(nbytes))
+
+    data = bytes(data)
+    res_sign = (ctypes.c_uint32 * num_perms)()
+    if library.catalog1_sign(data, len(data), res_sign, num_perms):
+        raise Exception('Catalog1 C library failed to sign data')
+
+    return list(res_sign)
+
+
+signers = {'c' : c_sign, 'numpy' : numpy_sign, 'python' : slow_sign}
+
+def get_signer(name='auto'):
+    '''
+    Returns the signing function matching the provided name. The numpy
+    signer is returned if the C signer is selected but not available.
+
+    Args:
+        name (:obj:`str`): auto, c, numpy or python
+
+    Returns:
+        function: Takes (data, num_perms) and returns a list of integers
+    '''
+    if name == 'auto':
+        name = 'c' if _load_library() else 'numpy'
+
+    if name not in signers:
+        print('[Catalog1] Unknown signer "{}", using numpy'.format(name))
+        name = 'numpy'
+
+    if (name == 'c') and (not _load_library()):
+        print('[Catalog1] C library is not available, using numpy')
+        name = 'numpy'
+
+    return signers[name]
@@ -31,6 +31,8 @@ class ExactMatchEngine(AbstractEngine):
     _name = 'ExactMatch'
     _description = 'Hashes the function\'s opcodes and finds direct matches'
     _required_db_names = ['first_db']
+    _tier = 0
+    _sufficient_similarity = 100.0
 
     def _add(self, function):
         '''
@@ -39,18 +41,35 @@ class ExactMatchEngine(AbstractEngine):
         '''
         pass
 
+    def _add_many(self, functions):
+        '''See _add'''
+        pass
+
     def _scan(self, opcodes, architecture, apis, disassembly):
         '''Returns List of FunctionResults'''
+        return self._scan_many([{'opcodes' : opcodes,
+                                 'architecture' : architecture,
+                                 'apis' : apis,
+                                 'disassembly' : disassembly}])[0]
 
+    def _scan_many(self, functions):
+        '''Returns List of FunctionResults lists, one per function'''
         db = self._dbs['first_db']
-        function = db.find_function(h_sha256=sha256(opcodes).hexdigest(),
-                                    architecture=architecture)
+        keys = [(sha256(f['opcodes']).hexdigest(), f['architecture'])
+                for f in functions]
+        matches = db.find_functions(keys)
+
+        results = []
+        for key, f in zip(keys, functions):
+            function = matches.get(key)
+            if not function:
+                results.append(None)
+                continue
 
-        if not function:
-            return None
+            similarity = 90.0
+            if set([el.api for el in function.apis.all()]) == set(f['apis']):
+                similarity += 10.0
 
-        similarity = 90.0
-        if set([el['api'] for el in function.apis.values()]) == set(apis):
-            similarity += 10.0
+            results.append([FunctionResult(str(function.id), similarity)])
 
-        return [FunctionResult(str(function.id), similarity)]
+        return results
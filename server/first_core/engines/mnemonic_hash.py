@@ -31,7 +31,8 @@ from hashlib import sha256
 
 #   FIRST Modules
 from first_core.error import FIRSTError
-from first_core.engines import AbstractEngine
+from first_core.engines import AbstractEngine, entry_functions
+from first_core.models import Sha256Field
 from first_core.engines.results import FunctionResult
 
 #   Third Party Modules
@@ -41,10 +42,28 @@ from django.core.exceptions import ObjectDoesNotExist
 
 MIN_REQUIRED_MNEMONICS = 8
 
+
+def mnemonic_hash(disassembly):
+    '''
+    Returns (list of mnemonics, sha256 of the mnemonics) for a Disassembly,
+    (None, None) if it has less than MIN_REQUIRED_MNEMONICS instructions
+    '''
+    if not disassembly:
+        return (None, None)
+
+    table = disassembly.table()
+    if len(table) < MIN_REQUIRED_MNEMONICS:
+        return (None, None)
+
+    mnemonics = table.mnemonics()
+    return (mnemonics, sha256(''.join(mnemonics).encode('utf-8')).hexdigest())
+
 class MnemonicHash(models.Model):
-    sha256 = models.CharField(max_length=64)
-    architecture = models.CharField(max_length=64)
-    functions = models.ManyToManyField('MnemonicHashFunctions')
+    sha256 = Sha256Field()
+    architecture = models.ForeignKey('www.Architecture', on_delete=models.PROTECT)
+
+    #   Number of functions with the hash, maintained on add
+    function_count = models.IntegerField(default=0)
 
     class Meta:
         app_label = 'engines'
@@ -53,14 +72,19 @@ class MnemonicHash(models.Model):
 
     def dump(self):
         return {'sha256' : self.sha256,
-                'architecture' : self.architecture,
-                'functions' : self.functions.all()}
+                'architecture' : self.architecture.name,
+                'functions' : entry_functions(MnemonicHashEntry, self.sha256,
+                                              self.architecture.name)}
 
-class MnemonicHashFunctions(models.Model):
-    func = models.BigIntegerField()
+class MnemonicHashEntry(models.Model):
+    #   Architecture ID and first_core.engines.hash_key of the sha256
+    architecture = models.SmallIntegerField()
+    hash_key = models.BigIntegerField()
+    function_id = models.BigIntegerField()
 
     class Meta:
         app_label = 'engines'
+        unique_together = ('architecture', 'hash_key', 'function_id')
 
 
 class MnemonicHashEngine(AbstractEngine):
@@ -70,78 +94,66 @@ class MnemonicHashEngine(AbstractEngine):
                     'arm, arm64, mips32, mips64, ppc32, ppc64, sparc). '
                     'Requires at least 8 mnemonics.')
     _required_db_names = ['first_db']
+    _required_features = ['mnemonic_sha256']
 
     def mnemonic_hash(self, disassembly):
-        if not disassembly:
-            return (None, None)
-
-        try:
-            mnemonics = [i.mnemonic for i in disassembly.instructions()]
-            if len(mnemonics) < MIN_REQUIRED_MNEMONICS:
-                return (None, None)
-
-            return (mnemonics, sha256(''.join(mnemonics).encode('utf-8')).hexdigest())
-
-        except Exception as e:
-            raise e
-            return (None, None)
+        return mnemonic_hash(disassembly)
 
     def _add(self, function):
         '''
         Creates a mnemonic hash based on the provided architecture and opcodes
         via disassembling the opcodes and discarding the instruction operands.
         '''
-        architecture = function['architecture']
-        disassembly = function.get('disassembly')
-        mnemonics, mnemonic_sha256 = self.mnemonic_hash(disassembly)
-        if None in [mnemonic_sha256, mnemonics]:
-            return
-
-        db_obj, _ = MnemonicHash.objects.get_or_create(sha256=mnemonic_sha256,
-                                                    architecture=architecture)
-        function_id = function['id']
-        count = MnemonicHash.objects.filter(sha256=mnemonic_sha256,
-                                            architecture=architecture,
-                                            functions__func=function_id).count()
-
-        if not count:
-            func, _ = MnemonicHashFunctions.objects.get_or_create(func=function_id)
-            db_obj.functions.add(func)
-
-    def _scan(self, opcodes, architecture, apis, disassembly):
-        '''Returns List of tuples (function ID, similarity percentage)'''
-        db = self._dbs['first_db']
-        mnemonics, mnemonic_sha256 = self.mnemonic_hash(disassembly)
-
-        if None in [mnemonic_sha256, mnemonics]:
-            return
-
-        try:
-            db_obj = MnemonicHash.objects.get(sha256=mnemonic_sha256,
-                                                architecture=architecture)
-        except ObjectDoesNotExist:
-            return None
-
-        results = []
-        for f in db_obj.functions.all():
-            similarity = 75.0
-            function_id = f.func
-            function = db.find_function(_id=function_id)
-
-            if (not function) or (not function.metadata.count()):
+        self._add_many([function])
+
+    def _add_many(self, functions):
+        '''Adds the mnemonic hashes of several functions with bulk queries'''
+        buckets = {}
+        for function in functions:
+            #   Stored features spare the disassembly
+            mnemonic_sha256 = self._function_features(function)['mnemonic_sha256']
+            if not mnemonic_sha256:
                 continue
 
-            #   The APIs will count up to 10% of the similarity score
-            total_apis = function.apis.count()
-            if total_apis:
-                func_apis = {x['api'] for x in function.apis.values('api')}
-                overlap = float(len(func_apis.intersection(apis)))
-                similarity += (overlap / total_apis) * 10
+            key = (mnemonic_sha256, function['architecture'])
+            buckets.setdefault(key, ({}, set()))[1].add(function['id'])
 
-            else:
-                similarity += 5
+        self._bulk_add_functions(MnemonicHash, MnemonicHashEntry, buckets, count=True)
 
-            results.append(FunctionResult(str(function_id), similarity))
+    def _scan(self, opcodes, architecture, apis, disassembly):
+        '''Returns List of tuples (function ID, similarity percentage)'''
+        return self._scan_many([{'opcodes' : opcodes,
+                                 'architecture' : architecture,
+                                 'apis' : apis,
+                                 'disassembly' : disassembly}])[0]
+
+    def _scan_many(self, functions):
+        '''Returns List of FunctionResults lists, one per function'''
+        hashes = [self.mnemonic_hash(f.get('disassembly'))[1] for f in functions]
+        keys = {(h, f['architecture']) for h, f in zip(hashes, functions) if h}
+        if not keys:
+            return [None for f in functions]
+
+        #   Get all buckets matching any of the functions in one query
+        buckets = {(b.sha256, b.architecture.name) : b for b in
+                    MnemonicHash.objects.select_related('architecture').filter(
+                        sha256__in={x[0] for x in keys},
+                        architecture__name__in={x[1] for x in keys})}
+        candidates, summaries = self._bucket_candidates(MnemonicHashEntry,
+                                                        list(buckets.values()))
+
+        scores = []
+        for h, f in zip(hashes, functions):
+            scores.append((candidates.get((h, f['architecture']), []),
+                           f['apis'], 75.0))
+
+        #   Similarity = 75% (mnemonic hash) + 10% (api overlap), candidates
+        #   without APIs get 5%
+        results = self._score_candidates(scores, 5.0)
+        for i, (h, f) in enumerate(zip(hashes, functions)):
+            if (h, f['architecture']) in summaries:
+                results[i].append(self._summary_result(
+                                    summaries[(h, f['architecture'])], 75.0))
 
         return results
 
@@ -164,5 +176,20 @@ class MnemonicHashEngine(AbstractEngine):
         execute_from_command_line(['manage.py', 'makemigrations', 'engines'])
         execute_from_command_line(['manage.py', 'migrate', 'engines'])
 
+    def _upgrade(self):
+        '''
+        Converts the tables of older versions of the engine, storing hashes
+        and architectures as text, and counts the functions of every hash,
+        scans rely on the count to bound the number of candidates
+        '''
+        if self._convert_text_tables(MnemonicHash, MnemonicHashEntry,
+                                     ('engines_mnemonichash_functions',
+                                      'mnemonichash_id',
+                                      'mnemonichashfunctions_id',
+                                      'engines_mnemonichashfunctions')):
+            self._update_migrations()
+
+        self._recount_buckets(MnemonicHash, MnemonicHashEntry)
+
     def _uninstall(self):
         print('Manually delete tables associated with {}'.format(self.engine_name))
@@ -35,6 +35,15 @@ class Result(object):
             data['engines'] = self.engines
             yield data
 
+    @classmethod
+    def prefetch_metadata(cls, db, results):
+        '''
+        Fetches the metadata of several results of this class at once, so
+        _get_metadata does not have to query the DB for each result.
+        Extending classes may implement this function.
+        '''
+        pass
+
     def _init(self, **kwargs):
         '''
         All extending classes should implement this function unless
@@ -91,16 +100,25 @@ class FunctionResult(Result):
     ID values are 26 hex character string. For metadata created by users,
     not engines, the flag byte not set.
     '''
+    @classmethod
+    def prefetch_metadata(cls, db, results):
+        metadata = db.get_functions_metadata([x.id for x in results])
+        for result in results:
+            result._set_metadata(metadata.get(int(result.id), []))
+
+    def _set_metadata(self, metadata):
+        #   Metadata is ordered by rank (highest first) and popped from the
+        #   end, get_metadata adds details of this result to each dictionary
+        self._metadata = [dict(x) for x in reversed(metadata)]
+
     def _get_metadata(self, db):
         if not hasattr(self, '_metadata'):
-            self._metadata = list(db.get_function_metadata(self.id))
-            self._metadata.sort(key=lambda x: x.rank)
+            metadata = db.get_functions_metadata([self.id])
+            self._set_metadata(metadata.get(int(self.id), []))
 
         data = None
         if len(self._metadata) > 0:
-            metadata = self._metadata.pop()
-            data = metadata.dump()
-            data['id'] = make_id(0, metadata=metadata.id)
+            data = self._metadata.pop()
 
         return data
 
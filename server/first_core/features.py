@@ -0,0 +1,67 @@
+#-------------------------------------------------------------------------------
+#
+#   FIRST Function Features
+#
+#   Features the engines derive from a function's opcodes (instruction
+#   count, mnemonic hash, masked hash and Catalog1 signature) do not depend
+#   on any engine. They are computed once, when the function is first sent
+#   to the engines, and stored in the FunctionFeatures table. Adding the
+#   function again (populate, engine worker) or to a newly installed engine
+#   reuses them instead of disassembling and signing the function again.
+#
+#   Engines list the features they use in _required_features, features are
+#   only computed and loaded when an engine the functions are added to
+#   requires them.
+#
+#-------------------------------------------------------------------------------
+
+#   Features stored with a different version are computed again, increase it
+#   whenever the way one of the features is derived changes
+FEATURES_VERSION = 1
+
+#   Names of the features
+#   -   instructions:       Number of instructions
+#   -   mnemonic_sha256:    sha256 of the mnemonics (MnemonicHash)
+#   -   masked_sha256:      sha256 of the masked instructions (BasicMasking)
+#   -   masked_changed:     Number of bytes masked (BasicMasking)
+#   -   catalog1:           Packed Catalog1 signature (Catalog1)
+#   Hashes and the signature are None when the function has none
+FEATURES = ['instructions', 'mnemonic_sha256', 'masked_sha256',
+            'masked_changed', 'catalog1']
+
+
+def compute_features(function, names=None):
+    '''
+    Derives the features of a function
+
+    @param function: Dictionary (keys: opcodes, architecture,
+                                 optional keys: disassembly)
+    @param names: List of the features to derive, None for all FEATURES
+    @returns Dictionary (keys: see FEATURES)
+    '''
+    #   Imported here, the engine modules import the engine manager's module
+    from first_core.disassembly import Disassembly
+    from first_core.engines.mnemonic_hash import mnemonic_hash
+    from first_core.engines.basic_masking import normalize
+    from first_core.engines.catalog1 import catalog1_signature, pack_signature
+
+    names = FEATURES if names is None else names
+    disassembly = function.get('disassembly')
+    if disassembly is None:
+        disassembly = Disassembly(function['architecture'], function['opcodes'])
+
+    features = {}
+    if 'instructions' in names:
+        features['instructions'] = len(disassembly.table())
+
+    if 'mnemonic_sha256' in names:
+        features['mnemonic_sha256'] = mnemonic_hash(disassembly)[1]
+
+    if ('masked_sha256' in names) or ('masked_changed' in names):
+        features['masked_changed'], features['masked_sha256'] = normalize(disassembly)
+
+    if 'catalog1' in names:
+        signature = catalog1_signature(function['opcodes'])
+        features['catalog1'] = pack_signature(signature) if signature else None
+
+    return features
@@ -0,0 +1,127 @@
+#-------------------------------------------------------------------------------
+#
+#   FIRST Function Opcodes Storage
+#
+#   Opcodes are kept out of the Function table, in the FunctionOpcodes table
+#   where functions with the same sha256 (the same opcodes on different
+#   architectures) share one row. Function rows stay small and queries that
+#   only need a function's metadata, hash or architecture never read opcode
+#   bytes. Function.opcodes loads them the first time they are used, load
+#   them for many functions at once with prefetch_opcodes. Opcodes are
+#   deleted with the last function using them.
+#
+#   New opcodes are compressed with the codec set by the "opcodes_compression"
+#   configuration value: none (default), zlib or zstd. Each row records its
+#   codec, so changing the value does not affect opcodes already stored.
+#
+#   Requirements
+#   ------------
+#   -   zstandard (optional, only for zstd)
+#
+#-------------------------------------------------------------------------------
+
+#   Python Modules
+import zlib
+
+#   FIRST Modules
+from first.settings import CONFIG
+from first_core.models import Function, FunctionOpcodes
+
+#   Third Party Modules
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+#   Codec IDs stored in FunctionOpcodes.compression
+NONE = 0
+ZLIB = 1
+ZSTD = 2
+CODECS = {'none' : NONE, 'zlib' : ZLIB, 'zstd' : ZSTD}
+
+
+def get_codec(name='none'):
+    '''
+    Returns the ID of the codec matching the provided name. zlib is used if
+    zstd is selected but zstandard is not installed.
+    '''
+    if name not in CODECS:
+        print('[Opcodes] Unknown compression "{}", using none'.format(name))
+        name = 'none'
+
+    if (name == 'zstd') and (zstandard is None):
+        print('[Opcodes] zstandard is not installed, using zlib')
+        name = 'zlib'
+
+    return CODECS[name]
+
+
+#   Codec used to store new opcodes
+CODEC = get_codec(CONFIG.get('opcodes_compression', 'none'))
+
+
+def compress(data, codec=None):
+    '''Returns (codec ID, data compressed with the codec)'''
+    codec = CODEC if codec is None else codec
+    if codec == ZLIB:
+        return (codec, zlib.compress(data))
+
+    if codec == ZSTD:
+        return (codec, zstandard.ZstdCompressor().compress(data))
+
+    return (NONE, data)
+
+
+def decompress(codec, data):
+    '''Returns the data stored with the codec'''
+    data = bytes(data)
+    if codec == ZLIB:
+        return zlib.decompress(data)
+
+    if codec == ZSTD:
+        if zstandard is None:
+            raise ImportError('zstandard is required to read these opcodes')
+
+        return zstandard.ZstdDecompressor().decompress(data)
+
+    return data
+
+
+def store_opcodes(opcodes):
+    '''
+    Stores opcodes not stored yet, existing ones are left untouched
+
+    @param opcodes: Dictionary {sha256 : opcodes}
+    '''
+    rows = []
+    for sha256, data in opcodes.items():
+        codec, data = compress(bytes(data))
+        rows.append(FunctionOpcodes(sha256=sha256, compression=codec, data=data))
+
+    FunctionOpcodes.objects.bulk_create(rows, ignore_conflicts=True)
+
+
+def purge_opcodes(hashes):
+    '''Deletes the opcodes of the sha256 hashes no function uses anymore'''
+    FunctionOpcodes.objects.filter(sha256__in=set(hashes)) \
+                           .exclude(sha256__in=Function.objects.values('sha256')) \
+                           .delete()
+
+
+def load_opcodes(hashes):
+    '''Returns {sha256 : opcodes} for the provided sha256 hashes'''
+    rows = FunctionOpcodes.objects.filter(sha256__in=set(hashes))
+    return {sha256 : decompress(codec, data) for sha256, codec, data
+            in rows.values_list('sha256', 'compression', 'data')}
+
+
+def prefetch_opcodes(functions):
+    '''Loads the opcodes of several Function objects with a single query'''
+    missing = [f for f in functions if f._opcodes is None]
+    if not missing:
+        return
+
+    opcodes = load_opcodes([f.sha256 for f in missing])
+    for function in missing:
+        function._opcodes = opcodes.get(function.sha256)
@@ -3,7 +3,12 @@ from django.urls import reverse
 from first_core.models import User
 from first_core.models import Sample 
 from first_core.models import Engine
+from first_core.models import Function, EngineQueue, Architecture
+from first_core import DBManager, EngineManager
+from django.core.management import call_command
 
+import io
+import base64
 import datetime
 import json
 
@@ -49,6 +54,52 @@ class RestTests(TestCase):
         response = self.client.get(reverse("rest:test_connection",  kwargs={'api_key' : 'AAAAAAAA-AAAA-AAAA-AAAA-AAAAAAAAAABB'}))
         self.assertIs(response.status_code == 401, True)
 
+    def test_engine_queue(self):
+        '''
+            Queue a function and let the engine worker add it to the engines
+        '''
+        user1 = create_user(name = "user1",
+                    email = "user1@noreply.cisco.com",
+                    handle = "user1_h4x0r",
+                    number = "1337",
+                    api_key = "AAAAAAAA-AAAA-AAAA-AAAA-AAAAAAAAAAAA",
+                    created = datetime.datetime.now(),
+                    rank = 0,
+                    active = True)
+
+        create_engine(name = "MnemonicHash",
+                      description = "Desc of MnemonicHash",
+                      path = "first_core.engines.mnemonic_hash",
+                      obj_name = "MnemonicHashEngine",
+                      developer = user1,
+                      active = True)
+        EngineManager.reload()
+        self.addCleanup(EngineManager.reload)
+
+        from first_core.engines.mnemonic_hash import MnemonicHash, MnemonicHashEntry
+        opcodes = b"\x55\x8b\xec" + b"\x40" * 10 + b"\x5d\xc3"
+        architecture = Architecture.objects.get_or_create(name = "intel32")[0]
+        function = Function.objects.create(sha256 = "BB" * 32,
+                                           opcodes = opcodes,
+                                           architecture = architecture)
+        DBManager.first_db.queue_functions([function])
+
+        response = self.client.get(reverse("rest:status", kwargs={'api_key' : 'AAAAAAAA-AAAA-AAAA-AAAA-AAAAAAAAAAAA'}))
+        self.assertEqual(response.status_code, 200)
+        d = json.loads(str(response.content, encoding="utf-8"))
+        self.assertEqual(d["queue"]["queued"], 1)
+        self.assertEqual(d["queue"]["ready"], 1)
+        self.assertEqual(MnemonicHash.objects.count(), 0)
+
+        call_command("engine_worker", once=True, stdout=io.StringIO())
+        self.assertEqual(EngineQueue.objects.count(), 0)
+        self.assertEqual(MnemonicHash.objects.count(), 1)
+        self.assertEqual(MnemonicHashEntry.objects.get().function_id, function.id)
+
+        # Status requires a valid API key
+        response = self.client.get(reverse("rest:status", kwargs={'api_key' : 'AAAAAAAA-AAAA-AAAA-AAAA-AAAAAAAAAABB'}))
+        self.assertEqual(response.status_code, 401)
+
     def test_sample_architecture(self):
         '''
             Test sample/architecures
@@ -517,6 +568,52 @@ class RestTests(TestCase):
                 else:
                     self.assertIs("Incorrect function name...", True)
 
+        # Fast scan, exact matches skip the other engines
+        functions = json.dumps({
+                    'function_id_0' :
+                        {
+                            'opcodes' : "VGhlIHF1aWNrIGJyb3duIGZveCBqdW1wcyBvdmVyIDEzIGxhenkgZG9ncy4=",
+                            'architecture' : "intel32",
+                            'apis' : ["ExitProcess", "CreateProcessA"]
+                        },
+                    'function_id_2' :
+                        {
+                            'opcodes' : "VTHSieWLaQhWi3UMU41Y/w+2DBaITBMBg8IBhMl18VteXcM=",
+                            'architecture' : "intel32",
+                            'apis' : ["CreateThread", "WriteProcessMemory"]
+                        }
+                    })
+        response = self.client.post(reverse("rest:metadata_scan", kwargs={'api_key' : 'AAAAAAAA-AAAA-AAAA-AAAA-AAAAAAAAAAAA'}),
+                {'functions' : functions, 'mode' : 'fast'})
+
+        self.assertIs(response.status_code, 200)
+        d = json.loads(str(response.content, encoding="utf-8"))
+        self.assertIs(d["failed"], False)
+        matches = d["results"]["matches"]
+        self.assertEqual(matches["function_id_0"][0]["name"], "my_function_0")
+        self.assertEqual(matches["function_id_0"][0]["engines"], ["ExactMatch"])
+        self.assertIn("Catalog1", matches["function_id_2"][0]["engines"])
+
+        # Exact matches without metadata do not skip the other engines
+        opcodes = b"The quick brown fox jumps over 13 lazy dogs!"
+        DBManager.first_db.get_function(opcodes, "intel32", ["ExitProcess", "CreateProcessA"],
+                                        create=True)
+        response = self.client.post(reverse("rest:metadata_scan", kwargs={'api_key' : 'AAAAAAAA-AAAA-AAAA-AAAA-AAAAAAAAAAAA'}),
+                {'functions' : json.dumps({'function_id_0' :
+                                            {'opcodes' : base64.b64encode(opcodes).decode(),
+                                             'architecture' : "intel32",
+                                             'apis' : ["ExitProcess", "CreateProcessA"]}}),
+                 'mode' : 'fast'})
+        d = json.loads(str(response.content, encoding="utf-8"))
+        self.assertEqual(d["results"]["matches"]["function_id_0"][0]["name"], "my_function_0")
+        self.assertNotIn("ExactMatch", d["results"]["matches"]["function_id_0"][0]["engines"])
+
+        response = self.client.post(reverse("rest:metadata_scan", kwargs={'api_key' : 'AAAAAAAA-AAAA-AAAA-AAAA-AAAAAAAAAAAA'}),
+                {'functions' : functions, 'mode' : 'quick'})
+        d = json.loads(str(response.content, encoding="utf-8"))
+        self.assertIs(d["failed"], True)
+        self.assertEqual(d["msg"], "Invalid scan mode")
+
         # Incorrect api key
         response = self.client.post(reverse("rest:metadata_scan", kwargs={'api_key' : 'AAAAAAAA-AAAA-AAAA-AAAA-AAAAAAAAAABB'}), 
                 {'functions' : json.dumps( 
@@ -32,5 +32,6 @@ urlpatterns = [
     re_path(r'metadata/scan/(?P<api_key>' + api_key_pattern + ')$',
         views.metadata_scan, name='metadata_scan'),
 
-    path(r'status', views.status, name='status'),
+    re_path(r'status/(?P<api_key>' + api_key_pattern + ')$',
+        views.status, name='status'),
 ]
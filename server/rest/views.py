@@ -13,7 +13,10 @@ from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_GET, require_POST
 
 #   FIRST Modules
+from first.settings import CONFIG
 from first_core import DBManager, EngineManager
+from first_core.cache import scan_cache
+from first_core.engines import SCAN_MODES
 from first_core.util import make_id, is_engine_metadata
 from first_core.auth import  verify_api_key, Authentication, FIRSTAuthError, \
                         require_login, require_apikey
@@ -21,6 +24,11 @@ from first_core.auth import  verify_api_key, Authentication, FIRSTAuthError, \
 
 MAX_FUNCTIONS = 20
 MAX_METADATA = 20
+
+#   Add functions to the engines from the engine worker instead of within
+#   the request, see www/management/commands/engine_worker.py
+ENGINE_QUEUE = bool(CONFIG.get('engine_queue', False))
+ENGINE_QUEUE_MAX_ATTEMPTS = int(CONFIG.get('engine_queue_max_attempts', 10))
 VALIDATE_IDS = lambda x: re.match('^[A-Fa-f\d]{26}$', x)
 
 #-----------------------------------------------------------------------------
@@ -215,6 +223,7 @@ def metadata_add(request, md5_hash, crc32, user):
     db.sample_seen_by_user(sample, user)
 
     results = {}
+    added = []
     for client_key in functions:
         f = functions[client_key]
 
@@ -245,8 +254,14 @@ def metadata_add(request, md5_hash, crc32, user):
         #   Set the user as applying the metadata
         db.applied(sample, user, _id)
 
-        #   Send opcode to EngineManager
-        EngineManager.add(function.dump(True))
+        added.append(function)
+
+    #   Send opcodes to EngineManager
+    if added and ENGINE_QUEUE:
+        db.queue_functions(added)
+
+    elif added:
+        EngineManager.add_many([f.dump(True) for f in added])
 
     return HttpResponse(json.dumps({'failed' : False, 'results' : results}))
 
@@ -463,6 +478,10 @@ def metadata_scan(request, user):
                                     'apis' : List Strings
                                 }
                 }
+
+        #   Optional
+        'mode' : String ('fast' or 'thorough'). Fast scans skip expensive
+                    engines for functions that already have exact matches
     }
     '''
     if not request.POST.get('functions'):
@@ -478,6 +497,10 @@ def metadata_scan(request, user):
     if ((dict != type(functions)) or MAX_FUNCTIONS < len(functions)):
         return render(request, 'rest/error_json.html', {'msg' : 'Invalid function json'})
 
+    mode = request.POST.get('mode')
+    if mode and (mode not in SCAN_MODES):
+        return render(request, 'rest/error_json.html', {'msg' : 'Invalid scan mode'})
+
     #   Validate input
     validated_input = {}
     required_keys = {'opcodes', 'apis', 'architecture'}
@@ -518,8 +541,10 @@ def metadata_scan(request, user):
                                         'architecture' : architecture}
 
     data = {'engines' : {}, 'matches' : {}}
-    for client_id, details in validated_input.items():
-        results = EngineManager.scan(user, **details)
+    client_ids = list(validated_input.keys())
+    scans = EngineManager.scan_many(user, [validated_input[x] for x in client_ids],
+                                    mode)
+    for client_id, results in zip(client_ids, scans or []):
         if (not results) or (results == ({}, [])):
             continue
 
@@ -531,9 +556,45 @@ def metadata_scan(request, user):
 
 
 
+@require_GET
 @require_apikey
 def status(request, user):
-    pass
+    '''
+    Returns the state of the server's engine indexing queue
+
+    GET request, returns:
+    {
+        'failed' : False,
+        'engine_queue' : Boolean, functions are added by the engine worker
+        'queue' :
+            {
+                'queued' : Number of functions waiting to be added
+                'ready' : Number of functions the workers can claim now
+                'retrying' : Number of functions with engines that failed
+                'failed' : Number of functions that will not be retried
+                'oldest' : Date of the oldest queued function or None
+            }
+        'scan_cache' : None when disabled, otherwise
+            {
+                'hits' : Number of functions answered from the cache
+                'misses' : Number of functions scanned by the engines
+            }
+        'engines' : Scan latency in seconds of each engine in this process
+            {
+                <engine_name> : {'calls', 'errors', 'timeouts', 'average', 'max'}
+            }
+    }
+    '''
+    db = DBManager.first_db
+    if not db:
+        return render(request, 'rest/error_json.html',
+                        {'msg' : 'Unable to connect to FIRST DB'})
+
+    return HttpResponse(json.dumps({'failed' : False,
+                                    'engine_queue' : ENGINE_QUEUE,
+                                    'queue' : db.queue_status(ENGINE_QUEUE_MAX_ATTEMPTS),
+                                    'scan_cache' : scan_cache.stats() if scan_cache else None,
+                                    'engines' : EngineManager.engine_stats()}))
 
 
 #-----------------------------------------------------------------------------
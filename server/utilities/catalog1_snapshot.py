@@ -0,0 +1,45 @@
+#! /usr/bin/python
+#-------------------------------------------------------------------------------
+#
+#   Utility to save a snapshot of the Catalog1 in-memory index
+#
+#   The snapshot is written to the provided directory, or to the directory
+#   set with the "catalog1_index_path" configuration value. FIRST loads it
+#   memory-mapped at startup and only fetches signatures added afterwards
+#   from the DB.
+#
+#   Usage
+#   -----
+#   $ cd server/utilities
+#   $ python catalog1_snapshot.py [path]
+#
+#-------------------------------------------------------------------------------
+#   Python Modules
+import os
+import sys
+import time
+from argparse import ArgumentParser
+
+#   Add app package to sys path
+sys.path.append(os.path.abspath('..'))
+
+#   FIRST Modules
+import first.wsgi
+from first_core.engines.catalog1 import build_index, INDEX_PATH
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Save a Catalog1 index snapshot')
+    parser.add_argument('path', nargs='?', default=INDEX_PATH,
+                        help='Snapshot directory (default: catalog1_index_path)')
+    args = parser.parse_args()
+
+    if not args.path:
+        print('[Catalog1] No snapshot path provided or configured')
+        sys.exit(1)
+
+    start = time.time()
+    index = build_index()
+    index.save(args.path)
+    print('[Catalog1] Saved {} signatures to {} in {:.2f}s'.format(
+            len(index), args.path, time.time() - start))
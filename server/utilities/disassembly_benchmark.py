@@ -0,0 +1,115 @@
+#! /usr/bin/python
+#-------------------------------------------------------------------------------
+#
+#   Microbenchmark of the Capstone handle pool
+#
+#   Decodes the same functions with a new Capstone handle per function (how
+#   Disassembly worked before handles were pooled) and with the calling
+#   thread's pooled handles, then prints the time and peak memory of each.
+#
+#   Usage
+#   -----
+#   $ cd server/utilities
+#   $ python disassembly_benchmark.py [--functions N] [--repeat N]
+#                                     [--architecture intel32]
+#
+#-------------------------------------------------------------------------------
+#   Python Modules
+import os
+import sys
+import time
+import random
+import tracemalloc
+from argparse import ArgumentParser
+
+#   Add app package to sys path
+sys.path.append(os.path.abspath('..'))
+
+#   FIRST Modules
+import first.wsgi
+from first_core.disassembly import Disassembly, InstructionTable, \
+                                    arch_mapping, get_handle
+
+#   Third Party Modules
+from capstone import Cs
+
+#   push ebp; mov ebp, esp; sub esp, 0x10; call $+5; mov [ebp-4], eax;
+#   call [0x40302010]; cmp [ebp-4], 0; je $+9; ...; mov esp, ebp; pop ebp; ret
+SAMPLE = bytes.fromhex('558bec83ec10e8000000008945fcff1510203040837dfc00'
+                       '740766e90100eb05e8aabbccdd8b45fc8be55dc3')
+
+
+def functions(count):
+    '''Returns count functions made of the sample with a few bytes changed'''
+    rand = random.Random(1337)
+    result = []
+    for i in range(count):
+        code = bytearray(SAMPLE * rand.randint(1, 8))
+        code[rand.randrange(len(code))] = rand.getrandbits(8)
+        result.append(bytes(code))
+
+    return result
+
+
+def new_handle(architecture, codes):
+    for code in codes:
+        md = Cs(*arch_mapping[architecture])
+        md.detail = False
+        InstructionTable(code, md.disasm(code, 0), architecture)
+
+
+def pooled_handle(architecture, codes):
+    for code in codes:
+        Disassembly(architecture, code).table()
+
+
+def measure(function, architecture, codes, repeat):
+    '''Returns (best seconds per function, peak bytes allocated)'''
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        function(architecture, codes)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    tracemalloc.start()
+    function(architecture, codes)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return (best / len(codes), peak)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Benchmark Capstone handle reuse')
+    parser.add_argument('--functions', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--architecture', default='intel32',
+                        choices=sorted(arch_mapping.keys()))
+    args = parser.parse_args()
+
+    codes = functions(args.functions)
+    get_handle(args.architecture)
+
+    start = time.perf_counter()
+    for i in range(args.functions):
+        Cs(*arch_mapping[args.architecture])
+    created = (time.perf_counter() - start) / args.functions
+
+    start = time.perf_counter()
+    for i in range(args.functions):
+        get_handle(args.architecture)
+    pooled = (time.perf_counter() - start) / args.functions
+
+    print('Handle:   new {:8.1f} us   pooled {:8.1f} us'.format(created * 1e6,
+                                                              pooled * 1e6))
+
+    results = {}
+    for name, function in [('new', new_handle), ('pooled', pooled_handle)]:
+        results[name] = measure(function, args.architecture, codes, args.repeat)
+
+    print('Function: new {:8.1f} us   pooled {:8.1f} us   ({:.0%} faster)'.format(
+            results['new'][0] * 1e6, results['pooled'][0] * 1e6,
+            1 - (results['pooled'][0] / results['new'][0])))
+    print('Peak memory: new {} KB   pooled {} KB'.format(
+            results['new'][1] // 1024, results['pooled'][1] // 1024))
@@ -22,6 +22,10 @@
 #   Python Modules
 import os
 import sys
+import json
+import time
+import itertools
+import multiprocessing
 from cmd import Cmd
 from pprint import pprint
 from argparse import ArgumentParser
@@ -33,12 +37,66 @@ sys.path.append(os.path.abspath('..'))
 import first.wsgi
 import first.settings
 from first_core.engines import AbstractEngine
-from first_core.disassembly import Disassembly
 from first_core import DBManager, EngineManager
 from first_core.models import Engine, User, Function
 
 #   Third Party Modules
-from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Min, Max
+
+#   Last primary key populated per engine, see RootCmd.do_populate
+CHECKPOINT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'populate_checkpoint.json')
+
+#   Names of the engines populated by the worker processes
+populate_engines = []
+
+#   DB connections inherited from the parent by a populate worker, kept
+#   referenced so they are never closed (or garbage collected) by the worker
+inherited_connections = []
+
+def populate_init(engine_names):
+    '''
+    Initializes a populate worker, each worker uses its own DB connection.
+    Connections inherited from the parent share its socket, closing them
+    would end the parent's session, so they are only dropped.
+    '''
+    global populate_engines
+    for conn in connections.all():
+        if conn.connection is not None:
+            inherited_connections.append(conn.connection)
+            conn.connection = None
+
+    populate_engines = engine_names
+
+def populate_range(pk_range):
+    '''
+    Sends the functions with a primary key in the range (start, end] to the
+    populate engines through the engine manager, which reuses the functions'
+    stored features (see first_core.features) and stores missing ones.
+
+    @returns Tuple. (start, end, number of functions, list of errors)
+    '''
+    start, end = pk_range
+    count = 0
+    errors = []
+
+    functions = DBManager.first_db.iter_functions(100, start, until_pk=end)
+    while True:
+        details = [f.dump(True) for f in itertools.islice(functions, 100)]
+        if not details:
+            break
+
+        engine_errors = EngineManager.add_many(details, populate_engines)
+        if engine_errors is None:
+            engine_errors = {'all' : 'Invalid function data'}
+
+        for name, e in engine_errors.items():
+            errors.append('[Error] Engine "{}": {}'.format(name, e))
+
+        count += len(details)
+
+    return (start, end, count, errors)
 
 class EngineCmd(Cmd):
 
@@ -65,6 +123,7 @@ class EngineCmd(Cmd):
                 '| enable   | Enable engine (Engine will be enabled)      |\n'
                 '| populate | Sending all functions to engine             |\n'
                 '| disable  | Disable engine (Engine will be disabled)    |\n'
+                '| upgrade  | Converts data from older engine versions    |\n'
                 '+--------------------------------------------------------+\n')
 
     def postcmd(self, stop, line):
@@ -170,6 +229,7 @@ class RootCmd(EngineCmd):
                                             path=path,
                                             obj_name=obj_name,
                                             developer=developer, active=True)
+            EngineManager.reload()
             print('Engine added to FIRST')
             return
 
@@ -196,6 +256,7 @@ class RootCmd(EngineCmd):
 
         e.uninstall()
         engine.delete()
+        EngineManager.reload()
 
     def do_enable(self, line):
         print('enable - Enable engine \n')
@@ -209,6 +270,7 @@ class RootCmd(EngineCmd):
 
         engine.active = True
         engine.save()
+        EngineManager.reload()
         print('Engine "{}" enabled'.format(line))
 
     def do_disable(self, line):
@@ -223,18 +285,49 @@ class RootCmd(EngineCmd):
 
         engine.active = False
         engine.save()
+        EngineManager.reload()
         print('Engine "{}" disabled'.format(line))
 
+    def do_upgrade(self, line):
+        print('upgrade - Convert data stored by an older version of the engine\n')
+        if line in ['', 'help', '?']:
+            print('Usage: upgrade <engine name>\n\n'
+                  'Converts the tables of older versions of the engine and '
+                  'updates the engines\' migrations, run it before '
+                  'makemigrations engines')
+            return
+
+        engine, e = self._get_engine_by_name(line)
+        if (not engine) or (not e):
+            return
+
+        e.upgrade()
+        print('Engine "{}" upgraded'.format(line))
+
     def do_populate(self, line):
         print('populate - Populate engine by sending all functions to engine\n')
         if line in ['', 'help', '?']:
-            print ( 'Usage: populate <engine name> ...\n\n'
+            print ( 'Usage: populate [--workers N] [--chunk N] [--restart] '
+                    '<engine name> ...\n\n'
                     'More than one engine name can be provided, separate with '
-                    'a space\n')
+                    'a space\n\n'
+                    '--workers  Number of processes used (default: 1)\n'
+                    '--chunk    Number of primary keys sent to a process at '
+                    'once (default: 10000)\n'
+                    '--restart  Ignore the checkpoint of a previous run\n\n'
+                    'Interrupted runs continue from the last function '
+                    'completed by every engine\n')
             return
 
-        global total, completed, operation_complete
-        populate_engines = line.split(' ')
+        parser = ArgumentParser(prog='populate', add_help=False)
+        parser.add_argument('--workers', type=int, default=1)
+        parser.add_argument('--chunk', type=int, default=10000)
+        parser.add_argument('--restart', action='store_true')
+        parser.add_argument('engines', nargs='+')
+        try:
+            args = parser.parse_args(line.split())
+        except SystemExit:
+            return
 
         db = DBManager.first_db
         if not db:
@@ -244,7 +337,7 @@ class RootCmd(EngineCmd):
         #   Get all engines the user entered
         all_engines = EngineManager.get_engines()
         engines = []
-        for engine_name in populate_engines:
+        for engine_name in args.engines:
             if engine_name not in all_engines:
                 print('[Error] Engine "{}" is not installed'.format(engine_name))
                 continue
@@ -256,46 +349,96 @@ class RootCmd(EngineCmd):
             return
 
         print('Starting to populate engines:\n-\t{}'.format('\n-\t'.join([e.name for e in engines])))
-        functions = db.get_all_functions().order_by('pk')
-        total = functions.count()
-
-        msg = ' [Status] {0:.2f}% Completed ({1} out of {2})\r'
-        errors = []
-        i = 0.0
-
-        offset = 0
-        limit = 500
-        paginator = Paginator(functions, 100)
-        for j in paginator.page_range:
-            functions = paginator.page(j)
-
-            for function in functions:
-                details = function.dump(True)
-
-                dis = Disassembly(details['architecture'], details['opcodes'])
-                if dis:
-                    details['disassembly'] = dis
-
-                for engine in engines:
-                    try:
-                        engine.add(details)
+        bounds = Function.objects.aggregate(first=Min('pk'), last=Max('pk'))
+        if bounds['last'] is None:
+            print('No functions to populate, exiting...')
+            return
 
-                    except Exception as e:
-                        msg = '[Error] Engine "{}": {}'.format(engine.name, e)
-                        errors.append(msg)
-                        print(msg)
+        checkpoint = self._load_checkpoint()
+        start = bounds['first'] - 1
+        if not args.restart:
+            start = max([start] + [min([checkpoint.get(e.name, 0) for e in engines])])
 
-                i += 1
-                if 0 == (i % 50):
-                    sys.stdout.write(msg.format((i / total) * 100, int(i), total)),
-                    sys.stdout.flush()
+        end = bounds['last']
+        if start >= end:
+            print('Engines are already populated, use --restart to populate '
+                  'them again')
+            return
 
+        chunk = max(1, args.chunk)
+        ranges = [(x, min(x + chunk, end)) for x in range(start, end, chunk)]
+        names = [e.name for e in engines]
+
+        pool = None
+        if args.workers > 1:
+            #   Workers must not inherit an open connection
+            connections.close_all()
+            pool = multiprocessing.Pool(args.workers, populate_init, (names,))
+            results = pool.imap_unordered(populate_range, ranges)
+        else:
+            global populate_engines
+            populate_engines = names
+            results = map(populate_range, ranges)
+
+        msg = ' [Status] {0:.2f}% Completed ({1} functions, {2:.1f} functions/sec)\r'
+        errors = []
+        populated = 0
+        covered = 0
+        started = time.time()
+
+        #   The checkpoint only moves past ranges completed without errors,
+        #   ranges are completed out of order with more than one worker
+        completed = {}
+        watermark = start
+        try:
+            for range_start, range_end, count, range_errors in results:
+                populated += count
+                if range_errors:
+                    errors.extend(range_errors)
+                    for error in range_errors:
+                        print(error)
+                else:
+                    completed[range_start] = range_end
+
+                while watermark in completed:
+                    watermark = completed.pop(watermark)
+
+                for name in names:
+                    checkpoint[name] = watermark
+                self._save_checkpoint(checkpoint)
+
+                covered += range_end - range_start
+                sys.stdout.write(msg.format((covered / (end - start)) * 100, populated,
+                                            populated / (time.time() - started)))
+                sys.stdout.flush()
+
+        finally:
+            if pool:
+                pool.terminate()
+                pool.join()
+
+        elapsed = time.time() - started
         sys.stdout.write('\n')
         sys.stdout.flush()
+        print('Populated {} functions in {:.1f}s ({:.1f} functions/sec) with {} '
+              'worker(s)'.format(populated, elapsed, populated / max(elapsed, 0.001),
+                                 max(1, args.workers)))
         print('Populating engines complete, exiting...')
         if errors:
             print('The below errors occured:\n{}'.format('\n  '.join(errors)))
 
+    def _load_checkpoint(self):
+        try:
+            with open(CHECKPOINT_PATH, 'r') as f:
+                return json.load(f)
+
+        except (IOError, ValueError):
+            return {}
+
+    def _save_checkpoint(self, checkpoint):
+        with open(CHECKPOINT_PATH, 'w') as f:
+            json.dump(checkpoint, f)
+
     def _get_db_engine_obj(self, name):
         engine = Engine.objects.filter(name=name)
         if not engine:
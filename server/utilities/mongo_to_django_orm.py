@@ -73,7 +73,12 @@ def migrate_samples():
 def migrate_functions(skip, limit):
     i = 0
     for f in Function.objects.skip(skip).limit(limit).select_related(3):
-        function, created = ORM.Function.objects.get_or_create(**f.dump())
+        data = f.dump()
+        architecture = ORM.Architecture.objects.get_or_create(
+                            name=data['architecture'])[0]
+        function, created = ORM.Function.objects.get_or_create(
+                                sha256=data['sha256'], architecture=architecture,
+                                defaults={'opcodes' : data['opcodes']})
         #   Convert Functions
         if created:
             #   Add APIs to function
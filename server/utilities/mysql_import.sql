@@ -36,12 +36,25 @@ ALTER TABLE Sample AUTO_INCREMENT = 1;
 DELETE FROM Function;
 ALTER TABLE Function AUTO_INCREMENT = 1;
 
+DELETE FROM FunctionOpcodes;
+ALTER TABLE FunctionOpcodes AUTO_INCREMENT = 1;
+
 DELETE FROM User;
 ALTER TABLE User AUTO_INCREMENT = 1;
 
 LOAD DATA LOCAL INFILE "FunctionApis" INTO TABLE FunctionApis COLUMNS TERMINATED BY "|";
 
-LOAD DATA LOCAL INFILE "Function" INTO TABLE Function FIELDS TERMINATED BY "|" (id, sha256, @var1, architecture) SET opcodes = UNHEX(@var1);
+CREATE TEMPORARY TABLE FunctionImport (line BIGINT AUTO_INCREMENT PRIMARY KEY, id BIGINT, sha256 CHAR(64), opcodes LONGTEXT, architecture VARCHAR(64));
+
+LOAD DATA LOCAL INFILE "Function" INTO TABLE FunctionImport FIELDS TERMINATED BY "|" (id, sha256, opcodes, architecture);
+
+INSERT IGNORE INTO Architecture (name) SELECT DISTINCT architecture FROM FunctionImport;
+
+INSERT INTO Function (id, sha256, architecture_id) SELECT f.id, UNHEX(f.sha256), a.id FROM FunctionImport f JOIN Architecture a ON a.name = f.architecture ORDER BY f.line;
+
+INSERT IGNORE INTO FunctionOpcodes (sha256, data, compression) SELECT UNHEX(sha256), UNHEX(opcodes), 0 FROM FunctionImport;
+
+DROP TEMPORARY TABLE FunctionImport;
 
 LOAD DATA LOCAL INFILE"Function_apis" INTO TABLE Function_apis FIELDS TERMINATED BY "|";
 
@@ -36,6 +36,7 @@ import first.wsgi
 import first.settings
 from first_core.disassembly import Disassembly
 from first_core.models import User
+from first_core.auth import invalidate_api_key
 
 #   Third Party Modules
 from django.core.paginator import Paginator
@@ -178,6 +179,7 @@ class RootCmd(UserCmd):
 
         user.active = True
         user.save()
+        invalidate_api_key(user.api_key)
         print('User "{}" enabled'.format(line))
 
     def do_disable(self, line):
@@ -192,6 +194,7 @@ class RootCmd(UserCmd):
 
         user.active = False
         user.save()
+        invalidate_api_key(user.api_key)
         print('User "{}" disabled'.format(line))
 
     def _expand_user_handle(self, user_handle):
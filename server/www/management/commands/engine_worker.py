@@ -0,0 +1,100 @@
+#-------------------------------------------------------------------------------
+#
+#   Engine worker, adds functions queued by metadata_add to the engines
+#
+#   Functions are queued instead of being added to the engines within the
+#   request when the "engine_queue" configuration value is true. Run one or
+#   more workers to process the queue:
+#
+#   $ python manage.py engine_worker
+#
+#   Jobs are claimed for --lease seconds and deleted once every engine
+#   processed them. Jobs from a worker that stopped are claimed again when
+#   their lease expires. Engines that raised an error are retried with an
+#   exponential backoff, up to "engine_queue_max_attempts" attempts.
+#
+#-------------------------------------------------------------------------------
+
+#   Python Modules
+import time
+
+#   FIRST Modules
+from first.settings import CONFIG
+from first_core import DBManager, EngineManager
+from first_core.models import Function
+from first_core.opcodes import prefetch_opcodes
+
+#   Third Party Modules
+from django.core.management.base import BaseCommand
+
+MAX_ATTEMPTS = int(CONFIG.get('engine_queue_max_attempts', 10))
+MAX_RETRY_DELAY = 3600
+
+
+class Command(BaseCommand):
+    help = 'Adds functions queued by metadata_add to the engines'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch', type=int, default=100,
+                            help='Number of jobs claimed at once')
+        parser.add_argument('--lease', type=int, default=300,
+                            help='Seconds a claimed job is hidden from other workers')
+        parser.add_argument('--sleep', type=float, default=5,
+                            help='Seconds to wait when the queue is empty')
+        parser.add_argument('--once', action='store_true',
+                            help='Exit once the queue is empty')
+
+    def handle(self, *args, **options):
+        db = DBManager.first_db
+        if not db:
+            self.stderr.write('[Error] Unable to connect to FIRST DB, exiting...')
+            return
+
+        while True:
+            jobs = db.claim_queued(options['batch'], options['lease'], MAX_ATTEMPTS)
+            if not jobs:
+                if options['once']:
+                    break
+
+                time.sleep(options['sleep'])
+                continue
+
+            self.process(db, jobs)
+
+    def process(self, db, jobs):
+        '''Adds the functions of the claimed jobs to the engines'''
+        functions = Function.objects.filter(pk__in={x.function_id for x in jobs}) \
+                                    .select_related('architecture')
+        functions = list(functions.prefetch_related('apis'))
+        prefetch_opcodes(functions)
+        functions = {f.pk : f.dump(True) for f in functions}
+
+        #   Jobs retrying a subset of the engines are processed together
+        groups = {}
+        for job in jobs:
+            groups.setdefault(job.engines, []).append(job)
+
+        completed = []
+        for engines, group in groups.items():
+            engines = engines.split(',') if engines else None
+            details = [functions[x.function_id] for x in group
+                        if x.function_id in functions]
+
+            errors = EngineManager.add_many(details, engines) if details else {}
+            if errors is None:
+                errors = {'all' : 'Invalid function data'}
+
+            if not errors:
+                completed.extend(group)
+                continue
+
+            failed = [x for x in errors.keys() if x != 'all']
+            error = '; '.join(['{}: {}'.format(k, v) for k, v in errors.items()])
+            self.stderr.write('[Error] {} jobs failed: {}'.format(len(group), error))
+            for job in group:
+                delay = min(MAX_RETRY_DELAY, 10 * (2 ** job.attempts))
+                db.retry_queued(job, failed, error, delay)
+
+        db.complete_queued(completed)
+        self.stdout.write('[Worker] Processed {} jobs, {} failed'.format(
+                            len(jobs), len(jobs) - len(completed)))
@@ -0,0 +1,53 @@
+#-------------------------------------------------------------------------------
+#
+#   Recomputes Metadata.applied_count (metadata rank) from AppliedMetadata
+#
+#   The counter is maintained when metadata is applied or unapplied, rows
+#   removed by cascading deletes (users, samples) are not accounted for.
+#   Run periodically or after bulk changes:
+#
+#   $ python manage.py reconcile_ranks
+#
+#-------------------------------------------------------------------------------
+
+#   FIRST Modules
+from first_core.models import Metadata, AppliedMetadata
+
+#   Third Party Modules
+from django.db import transaction
+from django.db.models import Count
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the applied count (rank) of all metadata'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch', type=int, default=5000,
+                            help='Number of metadata checked per query')
+
+    def handle(self, *args, **options):
+        checked = 0
+        fixed = 0
+        last_pk = 0
+        while True:
+            current = dict(Metadata.objects.filter(pk__gt=last_pk).order_by('pk')
+                            .values_list('pk', 'applied_count')[:options['batch']])
+            if not current:
+                break
+
+            last_pk = max(current.keys())
+            counts = AppliedMetadata.objects.filter(metadata_id__in=current.keys())
+            counts = dict(counts.values_list('metadata_id').annotate(Count('pk')))
+
+            #   Only rows with a wrong count are written
+            wrong = [Metadata(pk=pk, applied_count=counts.get(pk, 0))
+                        for pk, applied_count in current.items()
+                        if applied_count != counts.get(pk, 0)]
+            with transaction.atomic():
+                Metadata.objects.bulk_update(wrong, ['applied_count'])
+
+            checked += len(current)
+            fixed += len(wrong)
+
+        self.stdout.write('[Ranks] Checked {} metadata, fixed {}'.format(checked, fixed))
@@ -0,0 +1,18 @@
+# Generated by Django 4.0.10 on 2026-10-17 17:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('www', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='engine',
+            name='modified',
+            field=models.DateTimeField(auto_now=True),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 4.0.10 on 2026-10-17 17:55
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('www', '0002_engine_modified'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EngineQueue',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('engines', models.CharField(blank=True, default='', max_length=1024)),
+                ('attempts', models.IntegerField(default=0)),
+                ('last_error', models.CharField(blank=True, default='', max_length=1024)),
+                ('created', models.DateTimeField(default=django.utils.timezone.now)),
+                ('available', models.DateTimeField(default=django.utils.timezone.now)),
+                ('worker', models.CharField(blank=True, default='', max_length=36)),
+                ('function', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='www.function')),
+            ],
+            options={
+                'db_table': 'EngineQueue',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='enginequeue',
+            index=models.Index(fields=['available'], name='EngineQueue_availab_8ca5ae_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='enginequeue',
+            index=models.Index(fields=['worker'], name='EngineQueue_worker_9ff1a9_idx'),
+        ),
+    ]
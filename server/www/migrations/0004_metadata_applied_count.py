@@ -0,0 +1,30 @@
+# Generated by Django 4.0.10 on 2026-10-17 17:59
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_applied(apps, schema_editor):
+    Metadata = apps.get_model('www', 'Metadata')
+    AppliedMetadata = apps.get_model('www', 'AppliedMetadata')
+
+    applied = (AppliedMetadata.objects.filter(metadata=OuterRef('pk'))
+                .values('metadata').annotate(total=Count('pk')).values('total'))
+    Metadata.objects.update(applied_count=Coalesce(Subquery(applied), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('www', '0003_engine_queue'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='metadata',
+            name='applied_count',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.RunPython(count_applied, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 4.0.10 on 2026-10-17 18:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def set_current_details(apps, schema_editor):
+    Metadata = apps.get_model('www', 'Metadata')
+    Through = Metadata.details.through
+
+    #   Metadata is processed in primary key batches, the latest details of
+    #   each one is the last seen when ordered by commit time
+    last_pk = 0
+    while True:
+        ids = list(Metadata.objects.filter(pk__gt=last_pk).order_by('pk')
+                        .values_list('pk', flat=True)[:5000])
+        if not ids:
+            break
+
+        last_pk = ids[-1]
+        latest = {}
+        rows = Through.objects.filter(metadata_id__in=ids)
+        for metadata_id, details_id in (rows.order_by('metadatadetails__committed',
+                                                      'metadatadetails_id')
+                                        .values_list('metadata_id', 'metadatadetails_id')):
+            latest[metadata_id] = details_id
+
+        Metadata.objects.bulk_update(
+            [Metadata(pk=pk, current_details_id=details_id)
+                for pk, details_id in latest.items()],
+            ['current_details'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('www', '0004_metadata_applied_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='metadata',
+            name='current_details',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='www.metadatadetails'),
+        ),
+        migrations.RunPython(set_current_details, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 4.0.10 on 2026-10-17 18:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('www', '0005_metadata_current_details'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FunctionFeatures',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('version', models.PositiveSmallIntegerField()),
+                ('instructions', models.IntegerField(default=0)),
+                ('mnemonic_sha256', models.CharField(blank=True, max_length=64, null=True)),
+                ('masked_sha256', models.CharField(blank=True, max_length=64, null=True)),
+                ('masked_changed', models.IntegerField(default=0)),
+                ('catalog1', models.BinaryField(max_length=256, null=True)),
+                ('function', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='www.function')),
+            ],
+            options={
+                'db_table': 'FunctionFeatures',
+                'unique_together': {('function', 'version')},
+            },
+        ),
+    ]
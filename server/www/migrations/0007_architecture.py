@@ -0,0 +1,33 @@
+# Generated by Django 4.0.10 on 2026-10-17 20:41
+
+from django.db import migrations, models
+
+
+def add_architectures(apps, schema_editor):
+    Architecture = apps.get_model('www', 'Architecture')
+    Function = apps.get_model('www', 'Function')
+
+    names = Function.objects.values_list('architecture', flat=True).distinct()
+    Architecture.objects.bulk_create([Architecture(name=x) for x in names],
+                                     ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('www', '0006_function_features'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Architecture',
+            fields=[
+                ('id', models.SmallAutoField(primary_key=True, serialize=False)),
+                ('name', models.CharField(max_length=64, unique=True)),
+            ],
+            options={
+                'db_table': 'Architecture',
+            },
+        ),
+        migrations.RunPython(add_architectures, migrations.RunPython.noop),
+    ]
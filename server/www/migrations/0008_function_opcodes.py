@@ -0,0 +1,73 @@
+# Generated by Django 4.0.10 on 2026-10-17 21:26
+
+import zlib
+
+from django.db import migrations, models
+
+
+def move_opcodes(apps, schema_editor):
+    Function = apps.get_model('www', 'Function')
+    FunctionOpcodes = apps.get_model('www', 'FunctionOpcodes')
+
+    functions = Function.objects.order_by('pk')
+    last_pk = 0
+    while True:
+        batch = list(functions.filter(pk__gt=last_pk)[:1000]
+                        .values_list('pk', 'sha256', 'opcodes'))
+        if not batch:
+            break
+
+        FunctionOpcodes.objects.bulk_create(
+            [FunctionOpcodes(sha256=sha256, data=opcodes)
+                for pk, sha256, opcodes in batch],
+            ignore_conflicts=True)
+        last_pk = batch[-1][0]
+
+
+def restore_opcodes(apps, schema_editor):
+    Function = apps.get_model('www', 'Function')
+    FunctionOpcodes = apps.get_model('www', 'FunctionOpcodes')
+
+    for sha256, compression, data in (FunctionOpcodes.objects.values_list(
+                                        'sha256', 'compression', 'data')
+                                        .iterator()):
+        data = bytes(data)
+        if compression == 1:
+            data = zlib.decompress(data)
+
+        elif compression != 0:
+            raise ValueError('Unable to restore opcodes compressed with zstd')
+
+        Function.objects.filter(sha256=sha256).update(opcodes=data)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('www', '0007_architecture'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FunctionOpcodes',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('sha256', models.CharField(max_length=64, unique=True)),
+                ('compression', models.SmallIntegerField(default=0)),
+                ('data', models.BinaryField()),
+            ],
+            options={
+                'db_table': 'FunctionOpcodes',
+            },
+        ),
+        migrations.AlterField(
+            model_name='function',
+            name='opcodes',
+            field=models.BinaryField(null=True),
+        ),
+        migrations.RunPython(move_opcodes, restore_opcodes),
+        migrations.RemoveField(
+            model_name='function',
+            name='opcodes',
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 4.0.10 on 2026-10-17 21:40
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+#   Features are now stored per engine. They are only derived from the
+#   opcodes, so existing rows are dropped and computed again by the engines.
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('www', '0008_function_opcodes'),
+    ]
+
+    operations = [
+        migrations.DeleteModel(
+            name='FunctionFeatures',
+        ),
+        migrations.CreateModel(
+            name='FunctionFeatures',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('engine', models.CharField(max_length=16)),
+                ('version', models.PositiveSmallIntegerField()),
+                ('data', models.BinaryField(null=True)),
+                ('function', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='www.function')),
+            ],
+            options={
+                'db_table': 'FunctionFeatures',
+                'unique_together': {('function', 'engine', 'version')},
+            },
+        ),
+    ]
@@ -0,0 +1,163 @@
+# Generated by Django 4.0.10 on 2026-10-17 22:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+import www.models
+
+
+def compact_keys(apps, schema_editor):
+    Architecture = apps.get_model('www', 'Architecture')
+    Function = apps.get_model('www', 'Function')
+    FunctionOpcodes = apps.get_model('www', 'FunctionOpcodes')
+
+    names = Function.objects.values_list('architecture', flat=True).distinct()
+    Architecture.objects.bulk_create([Architecture(name=x) for x in names],
+                                     ignore_conflicts=True)
+    architectures = dict(Architecture.objects.values_list('name', 'id'))
+
+    functions = Function.objects.order_by('pk')
+    last_pk = 0
+    while True:
+        batch = list(functions.filter(pk__gt=last_pk)[:1000]
+                        .only('pk', 'sha256', 'architecture'))
+        if not batch:
+            break
+
+        for function in batch:
+            function.sha256_key = function.sha256
+            function.architecture_ref_id = architectures[function.architecture]
+
+        Function.objects.bulk_update(batch, ['sha256_key', 'architecture_ref'])
+        last_pk = batch[-1].pk
+
+    rows = FunctionOpcodes.objects.order_by('pk')
+    last_pk = 0
+    while True:
+        batch = list(rows.filter(pk__gt=last_pk)[:1000].only('pk', 'sha256'))
+        if not batch:
+            break
+
+        for row in batch:
+            row.sha256_key = row.sha256
+
+        FunctionOpcodes.objects.bulk_update(batch, ['sha256_key'])
+        last_pk = batch[-1].pk
+
+
+def expand_keys(apps, schema_editor):
+    Function = apps.get_model('www', 'Function')
+    FunctionOpcodes = apps.get_model('www', 'FunctionOpcodes')
+
+    for model, fields in [(Function, ['sha256', 'architecture']),
+                          (FunctionOpcodes, ['sha256'])]:
+        rows = model.objects.order_by('pk')
+        if model is Function:
+            rows = rows.select_related('architecture_ref')
+
+        last_pk = 0
+        while True:
+            batch = list(rows.filter(pk__gt=last_pk)[:1000])
+            if not batch:
+                break
+
+            for row in batch:
+                row.sha256 = row.sha256_key
+                if model is Function:
+                    row.architecture = row.architecture_ref.name
+
+            model.objects.bulk_update(batch, fields)
+            last_pk = batch[-1].pk
+
+
+#   Function hashes and FunctionOpcodes hashes are stored as 32 bytes and
+#   Function architectures as Architecture IDs. New columns are added,
+#   filled from the old ones, then renamed over them.
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('www', '0009_function_features_engine'),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name='function',
+            unique_together=set(),
+        ),
+        migrations.AlterField(
+            model_name='function',
+            name='sha256',
+            field=models.CharField(max_length=64, null=True),
+        ),
+        migrations.AlterField(
+            model_name='function',
+            name='architecture',
+            field=models.CharField(max_length=64, null=True),
+        ),
+        migrations.AlterField(
+            model_name='functionopcodes',
+            name='sha256',
+            field=models.CharField(max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='function',
+            name='sha256_key',
+            field=www.models.Sha256Field(null=True),
+        ),
+        migrations.AddField(
+            model_name='function',
+            name='architecture_ref',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT, to='www.architecture'),
+        ),
+        migrations.AddField(
+            model_name='functionopcodes',
+            name='sha256_key',
+            field=www.models.Sha256Field(null=True),
+        ),
+        migrations.RunPython(compact_keys, expand_keys),
+        migrations.RemoveField(
+            model_name='function',
+            name='sha256',
+        ),
+        migrations.RemoveField(
+            model_name='function',
+            name='architecture',
+        ),
+        migrations.RemoveField(
+            model_name='functionopcodes',
+            name='sha256',
+        ),
+        migrations.RenameField(
+            model_name='function',
+            old_name='sha256_key',
+            new_name='sha256',
+        ),
+        migrations.RenameField(
+            model_name='function',
+            old_name='architecture_ref',
+            new_name='architecture',
+        ),
+        migrations.RenameField(
+            model_name='functionopcodes',
+            old_name='sha256_key',
+            new_name='sha256',
+        ),
+        migrations.AlterField(
+            model_name='function',
+            name='sha256',
+            field=www.models.Sha256Field(),
+        ),
+        migrations.AlterField(
+            model_name='function',
+            name='architecture',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='www.architecture'),
+        ),
+        migrations.AlterField(
+            model_name='functionopcodes',
+            name='sha256',
+            field=www.models.Sha256Field(unique=True),
+        ),
+        migrations.AlterUniqueTogether(
+            name='function',
+            unique_together={('sha256', 'architecture')},
+        ),
+    ]
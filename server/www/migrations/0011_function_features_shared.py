@@ -0,0 +1,38 @@
+# Generated by Django 4.0.10 on 2026-10-17 23:10
+
+from django.db import migrations, models
+import django.db.models.deletion
+import www.models
+
+
+#   Features are stored once per function and version again, shared by every
+#   engine. They are only derived from the opcodes, so existing rows are
+#   dropped and computed again when the functions are added to the engines.
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('www', '0010_compact_function_keys'),
+    ]
+
+    operations = [
+        migrations.DeleteModel(
+            name='FunctionFeatures',
+        ),
+        migrations.CreateModel(
+            name='FunctionFeatures',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('version', models.PositiveSmallIntegerField()),
+                ('instructions', models.IntegerField(default=0)),
+                ('mnemonic_sha256', www.models.Sha256Field(null=True)),
+                ('masked_sha256', www.models.Sha256Field(null=True)),
+                ('masked_changed', models.IntegerField(default=0)),
+                ('catalog1', models.BinaryField(max_length=256, null=True)),
+                ('function', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='www.function')),
+            ],
+            options={
+                'db_table': 'FunctionFeatures',
+                'unique_together': {('function', 'version')},
+            },
+        ),
+    ]
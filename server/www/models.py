@@ -26,6 +26,54 @@ from __future__ import unicode_literals
 #   Third Party Modules
 from django.db import models
 from django.utils import timezone
+from django.dispatch import receiver
+from django.db.models.signals import post_delete
+
+
+class Sha256Field(models.BinaryField):
+    '''
+    SHA-256 hash stored as its 32 bytes (BINARY(32) on MySQL) instead of
+    64 hex characters, values are hex strings in Python
+    '''
+    def __init__(self, *args, **kwargs):
+        kwargs['max_length'] = 32
+        kwargs.setdefault('editable', True)
+        super(Sha256Field, self).__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super(Sha256Field, self).deconstruct()
+        kwargs.pop('max_length', None)
+        kwargs.pop('editable', None)
+        return name, path, args, kwargs
+
+    def db_type(self, connection):
+        if connection.vendor == 'mysql':
+            return 'binary(32)'
+
+        return super(Sha256Field, self).db_type(connection)
+
+    def from_db_value(self, value, expression, connection):
+        return self.to_python(value)
+
+    def to_python(self, value):
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            return bytes(value).hex()
+
+        return value
+
+    def get_prep_value(self, value):
+        if isinstance(value, str):
+            try:
+                return bytes.fromhex(value)
+
+            #   Not a hash, matches nothing
+            except ValueError:
+                return value.encode('utf-8')
+
+        return super(Sha256Field, self).get_prep_value(value)
+
+    def value_to_string(self, obj):
+        return self.value_from_object(obj)
 
 
 class User(models.Model):
@@ -78,6 +126,9 @@ class Engine(models.Model):
     developer = models.ForeignKey('User', on_delete=models.CASCADE)
     active = models.BooleanField(default=False)
 
+    #   Updated on every save, used as the change token for the engine registry
+    modified = models.DateTimeField(auto_now=True)
+
     @property
     def rank(self):
         #   TODO: Complete
@@ -140,18 +191,35 @@ class Metadata(models.Model):
     user = models.ForeignKey('User', on_delete = models.CASCADE)
     details = models.ManyToManyField('MetadataDetails')
 
+    #   Latest entry of details, set by FIRSTDB add_metadata_to_function
+    current_details = models.ForeignKey('MetadataDetails', null=True,
+                                        blank=True, related_name='+',
+                                        on_delete=models.SET_NULL)
+
+    #   Number of AppliedMetadata rows, maintained by FIRSTDB applied and
+    #   unapplied. Recompute with: python manage.py reconcile_ranks
+    applied_count = models.BigIntegerField(default=0)
+
     @property
     def rank(self):
-        if hasattr(self, 'id'):
-            return AppliedMetadata.objects.filter(metadata=self.id).count()
+        return self.applied_count
 
-        return 0
+    @property
+    def latest_details(self):
+        if self.current_details_id:
+            return self.current_details
+
+        try:
+            return self.details.latest('committed')
+
+        except MetadataDetails.DoesNotExist:
+            return None
 
     def has_changed(self, name, prototype, comment):
-        if not self.details.exists():
+        latest = self.latest_details
+        if not latest:
             return True
 
-        latest = self.details.latest('committed')
         if ((latest.name != name)
             or (latest.prototype != prototype)
             or (latest.comment != comment)):
@@ -161,7 +229,7 @@ class Metadata(models.Model):
 
     def dump(self, full=False):
         data = {'creator' : self.user.user_handle}
-        latest_details = self.details.latest('committed')
+        latest_details = self.latest_details
         data.update({
             'name' : latest_details.name,
             'prototype' : latest_details.prototype,
@@ -192,22 +260,77 @@ class FunctionApis(models.Model):
         db_table = 'FunctionApis'
 
 
+class Architecture(models.Model):
+    '''
+    Architecture names of the functions, engine tables refer to them by
+    their small ID instead of repeating the name in every row
+    '''
+    id = models.SmallAutoField(primary_key=True)
+
+    name = models.CharField(max_length=64, unique=True)
+
+    class Meta:
+        db_table = 'Architecture'
+
+
+class FunctionOpcodes(models.Model):
+    '''
+    Opcodes of the functions with the sha256, stored once and optionally
+    compressed, see first_core.opcodes
+    '''
+    id = models.BigAutoField(primary_key=True)
+
+    sha256 = Sha256Field(unique=True)
+
+    #   first_core.opcodes codec ID the data is compressed with
+    compression = models.SmallIntegerField(default=0)
+    data = models.BinaryField()
+
+    class Meta:
+        db_table = 'FunctionOpcodes'
+
+
 class Function(models.Model):
     id = models.BigAutoField(primary_key=True)
 
-    sha256 = models.CharField(max_length=64)
-    opcodes = models.BinaryField()
+    sha256 = Sha256Field()
     apis = models.ManyToManyField('FunctionApis')
     metadata = models.ManyToManyField('Metadata')
-    architecture = models.CharField(max_length=64)
+    architecture = models.ForeignKey('Architecture', on_delete=models.PROTECT)
+
+    #   Opcodes loaded from or waiting to be saved to FunctionOpcodes
+    _opcodes = None
+    _opcodes_changed = False
+
+    @property
+    def opcodes(self):
+        if self._opcodes is None:
+            #   Imported here, first_core imports these models
+            from first_core.opcodes import prefetch_opcodes
+            prefetch_opcodes([self])
+
+        return self._opcodes
+
+    @opcodes.setter
+    def opcodes(self, value):
+        self._opcodes = bytes(value)
+        self._opcodes_changed = True
+
+    def save(self, *args, **kwargs):
+        super(Function, self).save(*args, **kwargs)
+
+        if self._opcodes_changed:
+            from first_core.opcodes import store_opcodes
+            store_opcodes({self.sha256 : self._opcodes})
+            self._opcodes_changed = False
 
     def dump(self, full=False):
         data = {'opcodes' : self.opcodes,
-                'architecture' : self.architecture,
+                'architecture' : self.architecture.name,
                 'sha256' : self.sha256}
 
         if full:
-            data['apis'] = [x['api'] for x in self.apis.values('api')]
+            data['apis'] = [x.api for x in self.apis.all()]
             data['id'] = self.id
 
         return data
@@ -217,6 +340,13 @@ class Function(models.Model):
         unique_together = ('sha256', 'architecture')
 
 
+@receiver(post_delete, sender=Function)
+def delete_function_opcodes(sender, instance, **kwargs):
+    '''Deletes the opcodes of a deleted function once no function uses them'''
+    from first_core.opcodes import purge_opcodes
+    purge_opcodes([instance.sha256])
+
+
 class Sample(models.Model):
     id = models.BigAutoField(primary_key=True)
 
@@ -239,3 +369,56 @@ class Sample(models.Model):
                 'functions' : [str(x.id) for x in self.functions.all()],
                 'sha1' : self.sha1,
                 'sha256' : self.sha256}
+
+
+class EngineQueue(models.Model):
+    '''Function waiting to be added to the engines by the engine worker'''
+    id = models.BigAutoField(primary_key=True)
+
+    function = models.ForeignKey('Function', on_delete=models.CASCADE)
+
+    #   Comma separated names of the engines left to add the function to,
+    #   empty for every active engine
+    engines = models.CharField(max_length=1024, blank=True, default='')
+    attempts = models.IntegerField(default=0)
+    last_error = models.CharField(max_length=1024, blank=True, default='')
+
+    created = models.DateTimeField(default=timezone.now)
+
+    #   The job can be claimed once this time has passed. Workers push it
+    #   forward while processing the job (lease) and when retrying it later
+    available = models.DateTimeField(default=timezone.now)
+    worker = models.CharField(max_length=36, blank=True, default='')
+
+    class Meta:
+        db_table = 'EngineQueue'
+        indexes = [
+            models.Index(fields=['available']),
+            models.Index(fields=['worker']),
+        ]
+
+
+class FunctionFeatures(models.Model):
+    '''
+    Features derived from a function's opcodes, computed once and reused
+    by the engines when the function is added to them again, see
+    first_core.features
+    '''
+    id = models.BigAutoField(primary_key=True)
+
+    function = models.ForeignKey('Function', on_delete=models.CASCADE)
+
+    #   first_core.features.FEATURES_VERSION used to compute the features
+    version = models.PositiveSmallIntegerField()
+
+    instructions = models.IntegerField(default=0)
+    mnemonic_sha256 = Sha256Field(null=True)
+    masked_sha256 = Sha256Field(null=True)
+    masked_changed = models.IntegerField(default=0)
+
+    #   Catalog1 signature packed as little endian uint32 values
+    catalog1 = models.BinaryField(max_length=256, null=True)
+
+    class Meta:
+        db_table = 'FunctionFeatures'
+        unique_together = ('function', 'version')
@@ -1,3 +1,375 @@
-from django.test import TestCase
+import io
+import time
+from unittest import mock
 
-# Create your tests here.
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+
+from first_core import DBManager, EngineManager
+from first_core.cache import LRUCache, ScanCache
+from first_core import opcodes
+from first_core.models import FunctionFeatures, User, Metadata, Function, \
+                              FunctionOpcodes
+from first_core.engines import AbstractEngine, FIRSTEngineError, \
+                                FIRSTEngineManager, hash_key
+from first_core.engines.catalog1 import catalog1_signature, unpack_signature, \
+                                        Catalog1Engine
+from first_core.engines.exact_match import ExactMatchEngine
+from first_core.features import FEATURES_VERSION
+from first_core.engines.mnemonic_hash import mnemonic_hash, MnemonicHash, \
+                                            MnemonicHashEngine, MnemonicHashEntry
+from first_core.engines.results import EngineResult
+from first_core.disassembly import Disassembly
+
+
+class ScanCacheTests(SimpleTestCase):
+    def test_lru(self):
+        cache = LRUCache(2, 60)
+        cache.set_many({'a' : 1, 'b' : 2})
+        self.assertEqual(cache.get_many(['a']), {'a' : 1})
+
+        # b is the least recently used entry
+        cache.set_many({'c' : 3})
+        self.assertEqual(cache.get_many(['a', 'b', 'c']), {'a' : 1, 'c' : 3})
+
+        cache.set_many({'d' : 4}, timeout=-1)
+        self.assertEqual(cache.get_many(['d']), {})
+
+        cache.delete_many(['a'])
+        self.assertEqual(cache.get_many(['a', 'c']), {'c' : 3})
+
+    def test_scan_cache(self):
+        cache = ScanCache(LRUCache(100, 60), 60)
+        function = {'opcodes' : b'\x55\x8b\xec', 'architecture' : 'intel32',
+                    'apis' : ['b', 'a']}
+        key = ScanCache.key(function, '4:1')
+        self.assertEqual(key, ScanCache.key(dict(function, apis=['a', 'b', 'a']), '4:1'))
+        self.assertNotEqual(key, ScanCache.key(function, '5:1'))
+        self.assertNotEqual(key, ScanCache.key(dict(function, architecture='arm'), '4:1'))
+
+        self.assertEqual(cache.get_many([key]), {})
+        cache.set(key, ({'Engine' : 'Description'}, [{'id' : 1}]), [10, 11])
+        self.assertEqual(cache.get_many([key]),
+                         {key : ({'Engine' : 'Description'}, [{'id' : 1}])})
+
+        # Entries are dropped once a function they matched changes
+        cache.invalidate_functions([12])
+        self.assertEqual(len(cache.get_many([key])), 1)
+        cache.invalidate_functions([11])
+        self.assertEqual(cache.get_many([key]), {})
+
+        cache.set(key, ({}, []), [11])
+        self.assertEqual(cache.get_many([key]), {key : ({}, [])})
+        self.assertEqual(cache.stats(), {'hits' : 3, 'misses' : 2, 'entries' : 3})
+
+
+class ScanCacheInvalidationTests(TestCase):
+    def test_metadata_added_to_scanned_function(self):
+        db = DBManager.first_db
+        user = User.objects.create(name='user', email='user@example.com',
+                                   handle='user', number=1,
+                                   api_key='AAAAAAAA-AAAA-AAAA-AAAA-AAAAAAAAAAAA')
+
+        #   The scan matched nothing when it was cached
+        cache = ScanCache(LRUCache(100, 60), 60)
+        scanned = {'opcodes' : b'\x55\x8b\xec' * 4, 'architecture' : 'intel32',
+                   'apis' : ['A']}
+        key = ScanCache.key(scanned, '1:thorough')
+        cache.set(key, ({}, []), [], scanned)
+        self.assertEqual(len(cache.get_many([key])), 1)
+
+        #   Whatever the APIs the function is added with
+        function = db.get_function(scanned['opcodes'], 'intel32', [], create=True)
+        with mock.patch('first_core.dbs.builtin_db.scan_cache', cache):
+            db.add_metadata_to_function(user, function, 'name', 'prototype', '')
+
+        self.assertEqual(cache.get_many([key]), {})
+
+
+class EngineTimeoutTests(TestCase):
+    class Engine(AbstractEngine):
+        _name = 'Sleeping'
+
+        def _scan(self, opcodes, architecture, apis, **kwargs):
+            time.sleep(self.delay)
+            return []
+
+    def test_incomplete_scan_not_cached(self):
+        engine = self.Engine({}, 1, 1)
+        engine.delay = 0.5
+        with mock.patch.dict('first.settings.CONFIG', {'engine_executor' : 'threads',
+                                                       'engine_timeout' : 0.1}):
+            manager = FIRSTEngineManager(DBManager)
+
+        cache = ScanCache(LRUCache(100, 60), 60)
+        function = {'opcodes' : b'\x55\x8b\xec', 'architecture' : 'intel32',
+                    'apis' : []}
+        with mock.patch.object(FIRSTEngineManager, '_engines', [engine]), \
+             mock.patch('first_core.engines.scan_cache', cache):
+            self.assertEqual(manager.scan_many(None, [function]), [({}, [])])
+            self.assertEqual(cache.stats()['entries'], 0)
+            self.assertEqual(manager.engine_stats()['Sleeping']['timeouts'], 1)
+
+            #   Complete scans are cached
+            engine.delay = 0
+            for i in range(2):
+                manager.scan_many(None, [function])
+
+            self.assertEqual(cache.stats()['hits'], 1)
+
+
+class FunctionFeaturesTests(TestCase):
+    opcodes = bytes.fromhex('558bec83ec10e8000000008945fcff1510203040837dfc00'
+                            '740766e90100eb05e8aabbccdd8b45fc8be55dc3')
+
+    def test_features(self):
+        db = DBManager.first_db
+        function = db.get_function(self.opcodes, 'intel32', ['ExitProcess'],
+                                   create=True).dump(True)
+        manager = FIRSTEngineManager(DBManager)
+        mnemonic = MnemonicHashEngine({'first_db' : db}, 1, 1)
+        exact = ExactMatchEngine({'first_db' : db}, 2, 1)
+
+        #   Engines not requiring features do not compute them
+        with mock.patch.object(FIRSTEngineManager, '_engines', [exact]):
+            manager.add_many([dict(function)])
+
+        self.assertFalse(FunctionFeatures.objects.exists())
+
+        #   Every feature is computed when an engine requires any
+        with mock.patch.object(FIRSTEngineManager, '_engines', [exact, mnemonic]):
+            manager.add_many([dict(function)])
+
+        features = db.get_function_features([function['id']], FEATURES_VERSION)
+        features = features[function['id']]
+        self.assertEqual(features['mnemonic_sha256'],
+                         mnemonic_hash(Disassembly('intel32', self.opcodes))[1])
+        self.assertEqual(unpack_signature(features['catalog1']),
+                         catalog1_signature(self.opcodes))
+        self.assertEqual(features['instructions'],
+                         len(Disassembly('intel32', self.opcodes).table()))
+
+        #   Stored features are reused by engines installed later
+        catalog1 = Catalog1Engine({'first_db' : db}, 3, 1)
+        with mock.patch.object(FIRSTEngineManager, '_engines', [mnemonic, catalog1]), \
+             mock.patch('first_core.engines.compute_features') as compute:
+            manager.add_many([dict(function)])
+
+        compute.assert_not_called()
+        self.assertEqual(FunctionFeatures.objects.count(), 1)
+        self.assertEqual(MnemonicHashEntry.objects.get().function_id, function['id'])
+
+        #   Features of other versions are replaced
+        db.add_function_features({function['id'] : {'instructions' : 1}},
+                                 FEATURES_VERSION + 1)
+        self.assertEqual(list(FunctionFeatures.objects.values_list('version', flat=True)),
+                         [FEATURES_VERSION + 1])
+
+
+class CandidateScoringTests(TestCase):
+    def test_score_candidates(self):
+        db = DBManager.first_db
+        user = User.objects.create(name='user', email='user@example.com',
+                                   handle='user', number=1,
+                                   api_key='AAAAAAAA-AAAA-AAAA-AAAA-AAAAAAAAAAAA')
+        functions = [db.get_function(bytes([i]) * 8, 'intel32', apis, create=True)
+                        for i, apis in enumerate([['A', 'B'], [], ['C'], ['A']])]
+        for function in functions[:3]:
+            db.add_metadata_to_function(user, function, 'name', 'prototype', '')
+
+        engine = MnemonicHashEngine({'first_db' : db}, 1, 1)
+        ids = [x.id for x in functions]
+        results = engine._score_candidates([(ids, ['A', 'Unknown'], 75.0),
+                                            ([], ['A'], 75.0)], 5.0)
+
+        #   The last function has no metadata
+        self.assertEqual({(x.id, x.similarity) for x in results[0]},
+                         {(str(ids[0]), 80.0), (str(ids[1]), 80.0),
+                          (str(ids[2]), 75.0)})
+        self.assertEqual(results[1], [])
+        self.assertEqual(set(db.get_api_ids(['A', 'C', 'Unknown'])), {'A', 'C'})
+
+
+class BucketFanoutTests(TestCase):
+    def setUp(self):
+        db = DBManager.first_db
+        user = User.objects.create(name='user', email='user@example.com',
+                                   handle='user', number=1,
+                                   api_key='AAAAAAAA-AAAA-AAAA-AAAA-AAAAAAAAAAAA')
+
+        #   Same mnemonics, different call targets
+        self.functions = []
+        for i in range(4):
+            opcodes = (bytes.fromhex('558bec83ec10e8') + bytes([i, 0, 0, 0])
+                       + bytes.fromhex('8945fc837dfc007402eb008b45fc8be55dc3'))
+            function = db.get_function(opcodes, 'intel32', [], create=True)
+            metadata_id = db.add_metadata_to_function(user, function, 'name_{}'.format(i),
+                                                      'prototype', 'comment')
+            Metadata.objects.filter(pk=metadata_id).update(applied_count=i)
+            self.functions.append(function.dump(True))
+
+        self.engine = MnemonicHashEngine({'first_db' : db}, 1, 1)
+        self.engine.add_many([dict(x, disassembly=Disassembly('intel32', x['opcodes']))
+                                for x in self.functions])
+        self.scan = [{'opcodes' : self.functions[0]['opcodes'], 'apis' : [],
+                      'architecture' : 'intel32',
+                      'disassembly' : Disassembly('intel32', self.functions[0]['opcodes'])}]
+
+    def test_fanout(self):
+        bucket = MnemonicHash.objects.get()
+        self.assertEqual(bucket.function_count, 4)
+        self.assertEqual(len(self.engine.scan_many(self.scan)[0]), 4)
+
+        #   Functions added again are not counted again
+        self.engine.add_many([dict(x, disassembly=Disassembly('intel32', x['opcodes']))
+                                for x in self.functions[:2]])
+        bucket.refresh_from_db()
+        self.assertEqual(bucket.function_count, 4)
+
+        #   Only the functions with the highest ranked metadata are scored
+        with mock.patch('first_core.engines.BUCKET_FANOUT', 2):
+            results = self.engine.scan_many(self.scan)[0]
+            self.assertEqual({x.id for x in results},
+                             {str(x['id']) for x in self.functions[2:]})
+
+    def test_stoplist(self):
+        with mock.patch('first_core.engines.BUCKET_FANOUT', 2), \
+             mock.patch('first_core.engines.STOPLIST_SIZE', 3):
+            results = self.engine.scan_many(self.scan)[0]
+
+        self.assertEqual(len(results), 1)
+        self.assertIsInstance(results[0], EngineResult)
+        metadata = next(results[0].get_metadata(DBManager.first_db))
+        self.assertEqual(metadata['name'], 'name_3')
+        self.assertEqual(metadata['comment'], '[Common function, 4 matches] comment')
+        self.assertEqual(metadata['creator'], 'MnemonicHash')
+
+
+class HashEntryUpgradeTests(TestCase):
+    def test_recount_buckets(self):
+        architecture = DBManager.first_db.get_architecture_ids(['intel32'], create=True)
+        bucket = MnemonicHash.objects.create(sha256='AA' * 32,
+                                             architecture_id=architecture['intel32'])
+        MnemonicHashEntry.objects.bulk_create(
+            [MnemonicHashEntry(architecture=architecture['intel32'],
+                               hash_key=hash_key('AA' * 32), function_id=x)
+                for x in [1, 2]])
+
+        engine = MnemonicHashEngine({'first_db' : DBManager.first_db}, 1, 1)
+        with mock.patch('sys.stdout', io.StringIO()):
+            engine.upgrade()
+
+        bucket.refresh_from_db()
+        self.assertEqual(bucket.function_count, 2)
+
+
+class TextTableUpgradeTests(TransactionTestCase):
+    def test_convert_text_tables(self):
+        #   Tables of versions storing hashes and architectures as text
+        with connection.schema_editor() as schema_editor:
+            schema_editor.delete_model(MnemonicHash)
+            schema_editor.delete_model(MnemonicHashEntry)
+            for sql in ['CREATE TABLE engines_mnemonichash (id integer PRIMARY '
+                            'KEY, sha256 varchar(64), architecture varchar(64))',
+                        'CREATE TABLE engines_mnemonichashfunctions (id integer '
+                            'PRIMARY KEY, func bigint)',
+                        'CREATE TABLE engines_mnemonichash_functions (id integer '
+                            'PRIMARY KEY, mnemonichash_id integer, '
+                            'mnemonichashfunctions_id integer)',
+                        "INSERT INTO engines_mnemonichash VALUES "
+                            "(1, '{}', 'intel32'), (2, '{}', 'arm')".format(
+                                'aa' * 32, 'bb' * 32),
+                        'INSERT INTO engines_mnemonichashfunctions VALUES '
+                            '(1, 10), (2, 11), (3, 12)',
+                        'INSERT INTO engines_mnemonichash_functions VALUES '
+                            '(1, 1, 1), (2, 1, 2), (3, 2, 3)']:
+                schema_editor.execute(sql)
+
+        engine = MnemonicHashEngine({'first_db' : DBManager.first_db}, 1, 1)
+        with mock.patch.object(MnemonicHashEngine, '_update_migrations') as update, \
+                mock.patch('sys.stdout', io.StringIO()):
+            engine.upgrade()
+
+            #   Converted tables are left as they are
+            engine.upgrade()
+
+        self.assertEqual(update.call_count, 1)
+        buckets = {(x.sha256, x.architecture.name) : x.function_count
+                    for x in MnemonicHash.objects.select_related('architecture')}
+        self.assertEqual(buckets, {('aa' * 32, 'intel32') : 2, ('bb' * 32, 'arm') : 1})
+        self.assertEqual(sorted(MnemonicHashEntry.objects.filter(hash_key=hash_key('aa' * 32))
+                                .values_list('function_id', flat=True)), [10, 11])
+
+        tables = connection.introspection.table_names()
+        self.assertFalse([x for x in ['engines_mnemonichash_text',
+                                      'engines_mnemonichashfunctions',
+                                      'engines_mnemonichash_functions']
+                            if x in tables])
+
+
+class FunctionOpcodesTests(TestCase):
+    opcodes = b'\x55\x8b\xec' * 20
+
+    def test_shared_opcodes(self):
+        db = DBManager.first_db
+        for architecture in ['intel32', 'intel64']:
+            db.get_function(self.opcodes, architecture, [], create=True)
+
+        self.assertEqual(FunctionOpcodes.objects.count(), 1)
+
+        #   Opcodes are loaded the first time they are used
+        function = Function.objects.select_related('architecture') \
+                                   .get(architecture__name='intel64')
+        with self.assertNumQueries(1):
+            self.assertEqual(function.dump()['opcodes'], self.opcodes)
+            self.assertEqual(function.opcodes, self.opcodes)
+
+        self.assertEqual(db.get_opcodes([function.id]), {function.id : self.opcodes})
+
+        #   Hashes are stored as bytes, anything else matches nothing
+        self.assertEqual(db.find_function(architecture='intel64',
+                                          h_sha256=function.sha256.upper()), function)
+        self.assertFalse(Function.objects.filter(sha256='not a hash').exists())
+
+        #   Opcodes are deleted with the last function using them
+        function.delete()
+        self.assertEqual(FunctionOpcodes.objects.count(), 1)
+        Function.objects.all().delete()
+        self.assertEqual(FunctionOpcodes.objects.count(), 0)
+
+    def test_compression(self):
+        for codec in [opcodes.NONE, opcodes.ZLIB]:
+            self.assertEqual(opcodes.decompress(*opcodes.compress(self.opcodes, codec)),
+                             self.opcodes)
+
+        with mock.patch('first_core.opcodes.CODEC', opcodes.ZLIB):
+            opcodes.store_opcodes({'aa' * 32 : self.opcodes})
+
+        row = FunctionOpcodes.objects.get()
+        self.assertEqual(row.compression, opcodes.ZLIB)
+        self.assertLess(len(row.data), len(self.opcodes))
+        self.assertEqual(opcodes.load_opcodes(['aa' * 32]), {'aa' * 32 : self.opcodes})
+
+
+class DefaultAddManyTests(SimpleTestCase):
+    class Engine(AbstractEngine):
+        _name = 'Failing'
+
+        def _add(self, function):
+            if function['id'] == 2:
+                raise ValueError('Invalid function')
+
+            self.added.append(function['id'])
+
+    def test_errors_raised(self):
+        engine = self.Engine({}, 1, 1)
+        engine.added = []
+        functions = [{'id' : x, 'apis' : [], 'opcodes' : b'', 'sha256' : '',
+                      'architecture' : 'intel32'} for x in [1, 2, 3]]
+
+        #   The remaining functions are added before the error is raised
+        with self.assertRaises(FIRSTEngineError) as e:
+            engine.add_many(functions)
+
+        self.assertEqual(engine.added, [1, 3])
+        self.assertIn('1 of 3', str(e.exception))